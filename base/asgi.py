@@ -11,7 +11,8 @@ import os
 
 from django.core.asgi import get_asgi_application
 from channels.routing import ProtocolTypeRouter, URLRouter
-from rooms import routings
+from commons.metrics import MetricsMiddleware
+from base import routings
 
 os.environ.setdefault("DJANGO_SETTINGS_MODULE", "base.settings")
 
@@ -19,7 +20,7 @@ asgi_app = get_asgi_application()
 
 application = ProtocolTypeRouter(
     {
-        "http": asgi_app,
+        "http": MetricsMiddleware(asgi_app),
         "websocket": URLRouter([*routings.websocket_urlpatterns]),
     }
 )
@@ -33,6 +33,10 @@ app.conf.update(
             "task": "posts.tasks.expire_post_recommended",
             "schedule": schedules.crontab(minute="*/1"),
         },
+        "reap_ghost_participants": {
+            "task": "rooms.tasks.reap_ghost_participants",
+            "schedule": schedules.crontab(minute="*/1"),
+        },
     }
 )
 app.conf.task_routes = {
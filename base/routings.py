@@ -0,0 +1,17 @@
+from channels.routing import URLRouter
+from django.urls import re_path
+
+from commons.consumers import MultiplexConsumer
+from rooms import routings as rooms_routings
+from users import routings as users_routings
+
+# 단독 경로로도 연결할 수 있고, ws/connect/ 하나에 stream으로 여러개를 태울 수도 있음
+streams = [
+    *rooms_routings.websocket_urlpatterns,
+    *users_routings.websocket_urlpatterns,
+]
+
+websocket_urlpatterns = [
+    *streams,
+    re_path(r"ws/connect/$", MultiplexConsumer.as_asgi(streams=URLRouter(streams))),
+]
@@ -19,6 +19,10 @@ from pathlib import Path
 from .restframework_settings import *
 from .db import *
 from .email import *
+from .caches import *
+from .rooms import *
+from .websockets import *
+from .users import *
 
 load_dotenv()
 
@@ -130,7 +134,7 @@ CACHES = {
 
 CHANNEL_LAYERS = {
     "default": {
-        "BACKEND": "channels_redis.core.RedisChannelLayer",
+        "BACKEND": "commons.layers.AffinityChannelLayer",
         "CONFIG": {
             "hosts": [(getenv("CHANNEL_LAYER_HOST"), 6379)],
         },
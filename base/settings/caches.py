@@ -0,0 +1,22 @@
+from os import getenv
+from dotenv import load_dotenv
+
+load_dotenv()
+
+# commons.lock의 get_redis / get_async_redis가 공유하는 커넥션풀 설정
+# 풀이 가득 차면 TIMEOUT초 동안 빈 커넥션을 기다림
+REDIS_POOL = {
+    "MAX_CONNECTIONS": int(getenv("REDIS_POOL_MAX_CONNECTIONS", 50)),
+    "TIMEOUT": float(getenv("REDIS_POOL_TIMEOUT", 5)),
+    "SOCKET_TIMEOUT": float(getenv("REDIS_SOCKET_TIMEOUT", 5)),
+    "SOCKET_CONNECT_TIMEOUT": float(getenv("REDIS_SOCKET_CONNECT_TIMEOUT", 5)),
+    "HEALTH_CHECK_INTERVAL": int(getenv("REDIS_HEALTH_CHECK_INTERVAL", 30)),
+}
+
+# JWT 인증 캐시. 검증된 토큰은 jti로, 유저는 user id로 워커 안에 캐싱함(초, 개수)
+# 유저는 redis에도 AUTH_USER_REDIS_TTL초 동안 저장되고, User가 저장되면 버전이 올라가 바로 무효화됨
+AUTH_TOKEN_CACHE_TTL = float(getenv("AUTH_TOKEN_CACHE_TTL", 300))
+AUTH_TOKEN_CACHE_SIZE = int(getenv("AUTH_TOKEN_CACHE_SIZE", 10000))
+AUTH_USER_CACHE_TTL = float(getenv("AUTH_USER_CACHE_TTL", 60))
+AUTH_USER_CACHE_SIZE = int(getenv("AUTH_USER_CACHE_SIZE", 10000))
+AUTH_USER_REDIS_TTL = float(getenv("AUTH_USER_REDIS_TTL", 600))
@@ -0,0 +1,30 @@
+from os import getenv
+from dotenv import load_dotenv
+
+load_dotenv()
+
+# 같은 상대에게 보내는 ICE candidate를 모아서 한번에 보내는 시간(초)과 최대 개수
+# 0으로 설정하면 모으지 않고 바로 보냄
+ROOM_CANDIDATE_FLUSH_WINDOW = float(getenv("ROOM_CANDIDATE_FLUSH_WINDOW", 0.03))
+ROOM_CANDIDATE_MAX_BATCH = int(getenv("ROOM_CANDIDATE_MAX_BATCH", 20))
+
+# 워커 안에서 방 참가자 목록을 캐싱하는 시간(초)과 최대 방 개수. 0이면 캐싱하지 않음
+# 변경은 redis pub/sub로 무효화되고, TTL은 구독이 잠깐 끊겼을때 놓친 무효화에 대한 안전장치
+ROOM_ROSTER_CACHE_TTL = float(getenv("ROOM_ROSTER_CACHE_TTL", 10))
+ROOM_ROSTER_CACHE_SIZE = int(getenv("ROOM_ROSTER_CACHE_SIZE", 10000))
+
+# 접속중인 참가자는 컨슈머가 주기적으로 lease를 연장하고, 만료된 참가자는 celery beat가 정리함
+ROOM_HEARTBEAT_INTERVAL = float(getenv("ROOM_HEARTBEAT_INTERVAL", 20))
+ROOM_PARTICIPANT_LEASE = float(getenv("ROOM_PARTICIPANT_LEASE", 60))
+
+# 짧은 시간에 여러번 바뀐 audio/video 상태는 마지막 값만 저장하고 알리는 시간(초). 0이면 바로 보냄
+ROOM_STREAM_STATUS_DEBOUNCE = float(getenv("ROOM_STREAM_STATUS_DEBOUNCE", 0.1))
+
+# 연결이 끊긴 참가자를 바로 내보내지 않고 재접속을 기다리는 시간(초). 0이면 바로 내보냄
+# 재접속한 클라이언트는 resume_token과 마지막으로 받은 seq로 놓친 이벤트만 다시 받음
+ROOM_RESUME_GRACE = float(getenv("ROOM_RESUME_GRACE", 15))
+# 방마다 남겨두는 이벤트 로그 개수
+ROOM_EVENT_LOG_SIZE = int(getenv("ROOM_EVENT_LOG_SIZE", 500))
+
+# 방 목록(/rooms/)에 패스워드가 걸린 방도 보여줄지. 기본은 패스워드가 없는 방만 보여줌
+ROOM_DIRECTORY_INCLUDE_PROTECTED = bool(getenv("ROOM_DIRECTORY_INCLUDE_PROTECTED"))
@@ -0,0 +1,15 @@
+from os import getenv
+from dotenv import load_dotenv
+
+load_dotenv()
+
+# 유저에게 보낸 이벤트를 남겨두는 개수와 보관 시간(초). 0개면 남기지 않음
+# 재접속한 클라이언트는 authorization에 마지막으로 받은 last_id를 보내서 놓친 이벤트를 한번에 받음
+USER_INBOX_SIZE = int(getenv("USER_INBOX_SIZE", 200))
+USER_INBOX_TTL = int(getenv("USER_INBOX_TTL", 60 * 60 * 24 * 7))
+
+# 접속 후 이 시간(초) 안에 authorization을 보내지 않은 소켓은 끊음
+USER_AUTH_TIMEOUT = float(getenv("USER_AUTH_TIMEOUT", 10))
+# 워커별 접속 유저 목록을 갱신하는 주기의 3배(초). 워커가 죽으면 이 시간 안에 오프라인이 됨
+# 0이면 접속 여부를 확인하지 않고 모든 유저에게 보냄
+USER_PRESENCE_TTL = float(getenv("USER_PRESENCE_TTL", 30))
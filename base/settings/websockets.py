@@ -0,0 +1,15 @@
+from os import getenv
+from dotenv import load_dotenv
+
+load_dotenv()
+
+# 컨슈머마다 클라이언트로 보낼 메세지를 쌓아두는 큐의 크기
+# 큐가 WEBSOCKET_OUTBOX_TIMEOUT초 넘게 가득 차 있으면 느린 클라이언트로 보고 연결을 끊음
+WEBSOCKET_OUTBOX_LIMIT = int(getenv("WEBSOCKET_OUTBOX_LIMIT", 256))
+WEBSOCKET_OUTBOX_TIMEOUT = float(getenv("WEBSOCKET_OUTBOX_TIMEOUT", 5))
+
+# 워커별 prometheus 메트릭을 응답하는 http 경로. 비워두면 응답하지 않음
+METRICS_PATH = getenv("METRICS_PATH", "/metrics")
+
+# ws/connect/ 하나의 연결에서 동시에 열 수 있는 stream 수
+WEBSOCKET_MULTIPLEX_MAX_STREAMS = int(getenv("WEBSOCKET_MULTIPLEX_MAX_STREAMS", 8))
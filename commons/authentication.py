@@ -1,28 +1,218 @@
-from rest_framework.request import Request
+import base64
+import copy
+import json
+import pickle
+import time
+from typing import Any, Callable, NamedTuple
 
+from django.conf import settings
+from django.utils.translation import gettext_lazy as _
 from rest_framework_simplejwt.authentication import JWTAuthentication
+from rest_framework_simplejwt.exceptions import AuthenticationFailed, InvalidToken
+from rest_framework_simplejwt.settings import api_settings
 from rest_framework_simplejwt.tokens import Token, RefreshToken
 from rest_framework_simplejwt.serializers import TokenObtainPairSerializer
+from rest_framework_simplejwt.utils import get_md5_hash_password
 
-from django.core.cache import cache
+from commons.caches import LocalCache, VersionedCache
+from commons.lock import get_redis
+from commons.metrics import registry
+
+USER_INVALIDATION_CHANNEL = "v1:auth:users:invalidate"
+
+auth_cache_requests = registry.counter(
+    "auth_cache_requests_total",
+    "JWT authentication cache lookups",
+    ["cache", "tier", "result"],
+)
+auth_cache_size = registry.gauge(
+    "auth_cache_entries", "Entries in the in-process authentication caches", ["cache"]
+)
+
+
+def user_key(user_id: Any):
+    return f"v1:auth:user:{user_id}"
+
+
+def user_version_key(user_id: Any):
+    return f"v1:auth:user:{user_id}:version"
+
+
+def read_jti(raw_token: bytes) -> str | None:
+    """서명을 확인하지 않고 payload의 jti만 읽음. 캐시 조회용으로만 사용"""
+    try:
+        payload = raw_token.split(b".")[1]
+        padded = payload + b"=" * (-len(payload) % 4)
+        claims = json.loads(base64.urlsafe_b64decode(padded))
+        return claims.get(api_settings.JTI_CLAIM)
+    except Exception:
+        return None
+
+
+class TokenCache:
+    """
+    검증이 끝난 토큰을 jti로 워커 안에 캐싱해서 매 요청마다 서명을 다시 확인하지 않음
+    같은 jti라도 원래 토큰과 바이트가 같을때만 쓰고, 만료 시간은 꺼낼때마다 확인함
+    """
+
+    def __init__(self, max_size: int, ttl: float):
+        self.entries = LocalCache[str, tuple[bytes, Token]](max_size, ttl)
+
+    def get(self, raw_token: bytes) -> Token | None:
+        token = self.lookup(raw_token)
+        auth_cache_requests.inc("token", "local", "hit" if token else "miss")
+        return token
+
+    def lookup(self, raw_token: bytes) -> Token | None:
+        if not (jti := read_jti(raw_token)):
+            return None
+        if not (entry := self.entries.get(jti)):
+            return None
+        cached_raw, token = entry
+        if cached_raw != raw_token:
+            return None
+        if token.get("exp", 0) <= time.time():
+            self.entries.delete(jti)
+            return None
+        return token
+
+    def put(self, raw_token: bytes, token: Token):
+        if jti := token.get(api_settings.JTI_CLAIM):
+            self.entries.set(jti, (raw_token, token))
+
+    def stats(self):
+        return self.entries.stats()
+
+
+class CachedUser(NamedTuple):
+    version: int
+    user: Any
+
+
+class UserCache(VersionedCache[CachedUser]):
+    """
+    인증된 유저를 user id로 캐싱함. 워커 안의 VersionedCache가 redis 앞에 있음
+    User가 저장될때마다 redis의 버전을 올리고 USER_INVALIDATION_CHANNEL로
+    "{user_id} {version}"을 publish해서 모든 워커에서 지움
+    redis에는 (버전, 유저)를 같이 저장하고 현재 버전과 다르면 버림
+    캐시된 User는 요청끼리 공유되므로 꺼낼때마다 복사본을 돌려줌
+    """
+
+    def __init__(self, max_size: int, ttl: float, redis_ttl: float):
+        super().__init__(max_size, ttl, USER_INVALIDATION_CHANNEL)
+        self.redis_ttl = redis_ttl
+        self.redis_hits = 0
+        self.redis_misses = 0
+
+    def get_local(self, user_id: Any):
+        if entry := super().get(str(user_id)):
+            auth_cache_requests.inc("user", "local", "hit")
+            return copy.copy(entry.user)
+        auth_cache_requests.inc("user", "local", "miss")
+        return None
+
+    def get(self, user_id: Any, load: Callable[[], Any]):
+        """로컬 -> redis -> load() 순서로 찾음. load에서 난 예외는 캐싱하지 않고 그대로 올림"""
+        if (user := self.get_local(user_id)) is not None:
+            return user
+        if self.redis_ttl <= 0:
+            return load()
+        client = get_redis()
+        version, blob = client.mget(user_version_key(user_id), user_key(user_id))
+        version = int(version or 0)
+        if blob and (entry := pickle.loads(blob)).version == version:
+            self.redis_hits += 1
+            auth_cache_requests.inc("user", "redis", "hit")
+        else:
+            self.redis_misses += 1
+            auth_cache_requests.inc("user", "redis", "miss")
+            # 읽는 도중에 저장되면 이전 버전으로 들어가서 다음 조회때 버려짐
+            entry = CachedUser(version, load())
+            client.set(user_key(user_id), pickle.dumps(entry), ex=int(self.redis_ttl))
+        self.put(str(user_id), entry)
+        return copy.copy(entry.user)
+
+    def invalidate(self, user_id: Any):
+        client = get_redis()
+        with client.pipeline() as pipe:
+            pipe.incr(user_version_key(user_id))
+            # 버전은 저장된 유저보다 오래 남아야 이전 버전이 다시 맞는 일이 없음
+            pipe.expire(user_version_key(user_id), int(self.redis_ttl * 2) or 1)
+            pipe.delete(user_key(user_id))
+            version, *_ = pipe.execute()
+        self.on_invalidate(f"{user_id} {version}")
+        client.publish(USER_INVALIDATION_CHANNEL, f"{user_id} {version}")
+
+    def stats(self):
+        return dict(
+            local=super().stats(),
+            redis=dict(hits=self.redis_hits, misses=self.redis_misses),
+        )
+
+
+token_cache = TokenCache(settings.AUTH_TOKEN_CACHE_SIZE, settings.AUTH_TOKEN_CACHE_TTL)
+user_cache = UserCache(
+    settings.AUTH_USER_CACHE_SIZE,
+    settings.AUTH_USER_CACHE_TTL,
+    settings.AUTH_USER_REDIS_TTL,
+)
+
+
+@registry.collect
+def collect_auth_cache():
+    auth_cache_size.set(token_cache.stats()["size"], "token")
+    auth_cache_size.set(user_cache.stats()["local"]["size"], "user")
 
 
 class CustomJWTAuthentication(JWTAuthentication):
+    """토큰 검증과 유저 조회를 token_cache, user_cache로 캐싱함"""
 
-    def authenticate(self, request: Request):
-        access = request.META.get("HTTP_AUTHORIZATION")
-        if data := self.get_cached_user(access):
-            return data
-        token = super().authenticate(request)
-        cache.set(access, token, timeout=600)
+    def get_validated_token(self, raw_token: bytes) -> Token:
+        if token := token_cache.get(raw_token):
+            return token
+        token = super().get_validated_token(raw_token)
+        token_cache.put(raw_token, token)
         return token
 
-    def get_cached_user(self, token: str):
-        return cache.get(token, None)
+    def get_user(self, validated_token: Token):
+        user_id = self.get_user_id(validated_token)
+        user = user_cache.get(user_id, lambda: self.load_user(user_id))
+        return self.check_user(user, validated_token)
+
+    def get_cached_user(self, validated_token: Token):
+        """워커 안의 캐시에만 있는 유저를 IO 없이 꺼냄. 없으면 None"""
+        user_id = self.get_user_id(validated_token)
+        if (user := user_cache.get_local(user_id)) is None:
+            return None
+        return self.check_user(user, validated_token)
+
+    def get_user_id(self, validated_token: Token):
+        try:
+            return validated_token[api_settings.USER_ID_CLAIM]
+        except KeyError:
+            raise InvalidToken(_("Token contained no recognizable user identification"))
+
+    def load_user(self, user_id: Any):
+        try:
+            return self.user_model.objects.get(**{api_settings.USER_ID_FIELD: user_id})
+        except self.user_model.DoesNotExist:
+            raise AuthenticationFailed(_("User not found"), code="user_not_found")
+
+    def check_user(self, user, validated_token: Token):
+        # 캐시된 유저도 토큰마다 simplejwt와 같은 검사를 거침
+        if not user.is_active:
+            raise AuthenticationFailed(_("User is inactive"), code="user_inactive")
+        if api_settings.CHECK_REVOKE_TOKEN and validated_token.get(
+            api_settings.REVOKE_TOKEN_CLAIM
+        ) != get_md5_hash_password(user.password):
+            raise AuthenticationFailed(
+                _("The user's password has been changed."), code="password_changed"
+            )
+        return user
 
 
 class CustomTokenObtainPairSerializer(TokenObtainPairSerializer):
     @classmethod
     def get_token(cls, user) -> RefreshToken:
         token = super().get_token(user)
-        return token  # type:ignore
+        return token  # type: ignore
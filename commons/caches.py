@@ -1,18 +1,69 @@
-from collections import Counter, defaultdict
+from collections import OrderedDict
 from datetime import datetime
 import json
-from typing import Generic, TypeVar, TypedDict
+import threading
+import time
+from typing import Any, Callable, Generic, Hashable, TypeVar, TypedDict
 
 from django.utils.timezone import localtime
 
 from commons.lock import get_redis
 
 
+# LRUCache는 최근 값 목록(list)과 값별 등장 횟수(sorted set)를 같이 유지함
+# KEYS: list, freq. 이전 버전처럼 freq가 없는 list가 있으면 list로부터 다시 만듦
+LRU_REBUILD = """
+if redis.call('EXISTS', KEYS[2]) == 0 and redis.call('EXISTS', KEYS[1]) == 1 then
+    for _, value in ipairs(redis.call('LRANGE', KEYS[1], 0, -1)) do
+        redis.call('ZINCRBY', KEYS[2], 1, value)
+    end
+end
+local function forget(values)
+    for _, value in ipairs(values) do
+        if tonumber(redis.call('ZINCRBY', KEYS[2], -1, value)) <= 0 then
+            redis.call('ZREM', KEYS[2], value)
+        end
+    end
+end
+"""
+
+# ARGV: max_size, values... 뒤에 넣고 max_size를 넘은 만큼 앞에서 지움
+LRU_ADD_SCRIPT = LRU_REBUILD + """
+local max_size = tonumber(ARGV[1])
+for i = 2, #ARGV do
+    redis.call('RPUSH', KEYS[1], ARGV[i])
+    redis.call('ZINCRBY', KEYS[2], 1, ARGV[i])
+end
+local exceed = redis.call('LLEN', KEYS[1]) - max_size
+if 0 < exceed then
+    forget(redis.call('LRANGE', KEYS[1], 0, exceed - 1))
+    redis.call('LTRIM', KEYS[1], exceed, -1)
+end
+return redis.call('LLEN', KEYS[1])
+"""
+
+# ARGV: length
+LRU_POP_SCRIPT = LRU_REBUILD + """
+local values = redis.call('LRANGE', KEYS[1], 0, tonumber(ARGV[1]) - 1)
+forget(values)
+redis.call('LTRIM', KEYS[1], #values, -1)
+return values
+"""
+
+LRU_COUNTER_SCRIPT = LRU_REBUILD + """
+return redis.call('ZREVRANGE', KEYS[2], 0, -1)
+"""
+
+
 class LRUCache:
     def __init__(self, key: str, max_size: int):
         self.client = get_redis()
         self.key = key
+        self.freq_key = f"{key}:freq"
         self.max_size = max_size
+        self.add_script = self.client.register_script(LRU_ADD_SCRIPT)
+        self.pop_script = self.client.register_script(LRU_POP_SCRIPT)
+        self.counter_script = self.client.register_script(LRU_COUNTER_SCRIPT)
 
     def __enter__(self):
         return self
@@ -20,8 +71,12 @@ class LRUCache:
     def __exit__(self, *args, **kwargs):
         self.client.close()
 
+    @property
+    def keys(self):
+        return [self.key, self.freq_key]
+
     def trunc(self):
-        self.client.delete(self.key)
+        self.client.delete(*self.keys)
 
     def all(self) -> list[int]:
         values = self.client.lrange(self.key, 0, -1)
@@ -29,22 +84,18 @@ class LRUCache:
         return encoded
 
     def lpop(self, length: int = 1):
-        return self.client.lpop(self.key, length)
+        return self.pop_script(keys=self.keys, args=[length]) or None
 
     def add(self, *values: int):
-        new_length = len(values)
-        already = len(self.all())
-        exceed = already + new_length - self.max_size
-        if 0 < exceed:
-            self.lpop(exceed)
-        if self.max_size < new_length:
-            values = values[new_length - self.max_size : new_length]
-        self.client.rpush(self.key, *values)
+        if not values:
+            return
+        # 넣을 값이 max_size보다 많으면 어차피 지워질 앞부분은 보내지 않음
+        values = values[max(len(values) - self.max_size, 0) :]
+        self.add_script(keys=self.keys, args=[self.max_size, *values])
 
     def counter(self):
-        all = self.all()
-        counter = Counter(all)
-        return list(map(lambda x: x[0], sorted(counter.items(), key=lambda x: -x[1])))
+        """자주 나온 순서. 횟수가 같으면 값을 문자열로 비교한 역순"""
+        return list(map(int, self.counter_script(keys=self.keys)))  # type:ignore
 
 
 T = TypeVar("T")
@@ -76,11 +127,107 @@ class Container(TypedDict, Generic[T]):
 pivot_time_minute = int(datetime(year=2024, month=1, day=1).timestamp() / 60)
 
 
+# TimeoutCache는 항목을 c(분)를 점수로 하는 sorted set에 저장해서 오래된 항목을 범위로 지움
+# member는 16자리 순번 뒤에 Container json을 붙인 값으로, 같은 값도 따로 저장되고
+# 같은 분 안에서는 넣은 순서대로 정렬됨
+# 값별 가중치 합은 counts sorted set(json으로 인코딩한 값 -> 합)에 넣고 뺄때마다 같이 바꿈
+# KEYS: 이전 버전의 list, items, seq, counts, migrated
+# 이전 list가 남아있으면 먼저 옮기고 지우며, migrated 표시가 없으면 counts를 items로부터
+# 한번만 다시 만듦. 합이 모두 0 이하여서 counts가 비어도 다시 계산하지 않음
+TIMEOUT_MIGRATE = """
+local function member(seq, item)
+    return string.format('%016d', seq) .. item
+end
+-- json.dumps(dict(v=..., c=..., w=...))의 v 부분을 다시 인코딩하지 않고 그대로 꺼냄
+local function parse(item)
+    local value, weight = string.match(
+        item, '^{"v": (.*), "c": %-?%d+, "w": ([^,}]+)}$'
+    )
+    return value, tonumber(weight)
+end
+local function count(item, sign)
+    local value, weight = parse(item)
+    if not value or not weight then
+        return
+    end
+    local total = redis.call('ZINCRBY', KEYS[4], sign * weight, value)
+    -- 음수 가중치도 있으므로 합이 정확히 0일때만 지움
+    if tonumber(total) == 0 then
+        redis.call('ZREM', KEYS[4], value)
+    end
+end
+if redis.call('TYPE', KEYS[1]).ok == 'list' then
+    for _, item in ipairs(redis.call('LRANGE', KEYS[1], 0, -1)) do
+        local seq = redis.call('INCR', KEYS[3])
+        redis.call('ZADD', KEYS[2], cjson.decode(item)['c'], member(seq, item))
+        if redis.call('EXISTS', KEYS[5]) == 1 then
+            count(item, 1)
+        end
+    end
+    redis.call('DEL', KEYS[1])
+end
+if redis.call('EXISTS', KEYS[5]) == 0 then
+    redis.call('DEL', KEYS[4])
+    for _, item in ipairs(redis.call('ZRANGE', KEYS[2], 0, -1)) do
+        count(string.sub(item, 17), 1)
+    end
+    redis.call('SET', KEYS[5], 1)
+end
+"""
+
+# ARGV: c, item...
+TIMEOUT_ADD_SCRIPT = TIMEOUT_MIGRATE + """
+for i = 2, #ARGV do
+    local seq = redis.call('INCR', KEYS[3])
+    redis.call('ZADD', KEYS[2], ARGV[1], member(seq, ARGV[i]))
+    count(ARGV[i], 1)
+end
+"""
+
+TIMEOUT_ALL_SCRIPT = TIMEOUT_MIGRATE + """
+return redis.call('ZRANGE', KEYS[2], 0, -1)
+"""
+
+# ARGV: expire_minute, min_items_count
+# c가 expire_minute보다 작은 항목을 오래된 것부터 지우되 min_items_count개는 남김
+TIMEOUT_REMOVE_SCRIPT = TIMEOUT_MIGRATE + """
+local removal = redis.call('ZCARD', KEYS[2]) - tonumber(ARGV[2])
+if removal <= 0 then
+    return 0
+end
+local outdated = redis.call('ZCOUNT', KEYS[2], '-inf', '(' .. ARGV[1])
+local removed = math.min(outdated, removal)
+if 0 < removed then
+    for _, item in ipairs(redis.call('ZRANGE', KEYS[2], 0, removed - 1)) do
+        count(string.sub(item, 17), -1)
+    end
+    redis.call('ZREMRANGEBYRANK', KEYS[2], 0, removed - 1)
+end
+return removed
+"""
+
+# ARGV: limit (-1이면 전부)
+TIMEOUT_COUNTER_SCRIPT = TIMEOUT_MIGRATE + """
+return redis.call('ZREVRANGE', KEYS[4], 0, tonumber(ARGV[1]))
+"""
+
+# member 앞의 순번 길이
+SEQ_WIDTH = 16
+
+
 class TimeoutCache(Generic[T]):
 
     def __init__(self, key: str):
         self.client = get_redis()
         self.key = key
+        self.items_key = f"{key}:items"
+        self.seq_key = f"{key}:seq"
+        self.counts_key = f"{key}:counts"
+        self.migrated_key = f"{key}:migrated"
+        self.add_script = self.client.register_script(TIMEOUT_ADD_SCRIPT)
+        self.all_script = self.client.register_script(TIMEOUT_ALL_SCRIPT)
+        self.remove_script = self.client.register_script(TIMEOUT_REMOVE_SCRIPT)
+        self.counter_script = self.client.register_script(TIMEOUT_COUNTER_SCRIPT)
 
     _pivot_time_minute: int | None = None
 
@@ -96,21 +243,21 @@ class TimeoutCache(Generic[T]):
     def minute_timestamp(dt: datetime):
         return int(dt.timestamp() / 60)
 
-    def remove_out_dated(self, expire: datetime, min_items_count=100):
+    @property
+    def keys(self):
+        return [
+            self.key,
+            self.items_key,
+            self.seq_key,
+            self.counts_key,
+            self.migrated_key,
+        ]
+
+    def remove_out_dated(self, expire: datetime, min_items_count=100) -> int:
         expire_minute = self.minute_timestamp(expire) - self.pivot_time_minute
-        all = self.all()
-        outdateds: list[Container[T]] = []
-        for item in all:
-            if item["c"] < expire_minute:
-                outdateds.append(item)
-
-        current_size = all.__len__()  # 120
-        removal_size = current_size - min_items_count  # 20
-        if 0 < removal_size:
-            outdateds = outdateds[:removal_size]
-
-            for outdated in outdateds:
-                self.client.lrem(self.key, 0, json.dumps(outdated, default=dumper))
+        return self.remove_script(
+            keys=self.keys, args=[expire_minute, min_items_count]
+        )  # type:ignore
 
     def __enter__(self):
         return self
@@ -119,17 +266,19 @@ class TimeoutCache(Generic[T]):
         self.client.close()
 
     def trunc(self):
-        self.client.delete(self.key)
+        self.client.delete(*self.keys)
 
-    def decode(self, value: str) -> Container[T]:
-        loads: Container[T] = json.loads(value)
+    def decode(self, value: str | bytes) -> Container[T]:
+        loads: Container[T] = json.loads(value[SEQ_WIDTH:])
         return loads
 
     def all(self) -> list[Container[T]]:
-        values = self.client.lrange(self.key, 0, -1)
+        values = self.all_script(keys=self.keys)
         return list(map(self.decode, values))  # type:ignore
 
     def add(self, *values: T, weights=1, created_at: datetime | None = None):
+        if not values:
+            return
         if created_at == None:
             created_at = localtime()
         c = self.minute_timestamp(created_at) - self.pivot_time_minute
@@ -139,12 +288,205 @@ class TimeoutCache(Generic[T]):
                 values,
             )
         )
-        self.client.rpush(self.key, *date_wrapped)
+        self.add_script(keys=self.keys, args=[c, *date_wrapped])
+
+    def counter(self, limit: int | None = None) -> list[T]:
+        """
+        가중치 합이 큰 순서로 값을 limit개까지 돌려줌. 합은 add와 remove_out_dated에서
+        미리 계산되어 있으므로 전체 항목을 읽지 않음. 합이 같으면 json 문자열의 역순
+        """
+        if limit is not None and limit <= 0:
+            return []
+        stop = -1 if limit is None else limit - 1
+        values = self.counter_script(keys=self.keys, args=[stop])
+        return [json.loads(value) for value in values]  # type:ignore
+
+
+K = TypeVar("K", bound=Hashable)
+V = TypeVar("V")
+
+
+class LocalCache(Generic[K, V]):
+    """
+    프로세스(워커) 안에서만 쓰는 TTL + LRU 캐시
+    pub/sub 리스너 스레드에서도 지우기 때문에 lock으로 보호함
+    """
+
+    def __init__(self, max_size: int = 1024, ttl: float = 60):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.items = OrderedDict[K, tuple[float, V]]()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key: K) -> V | None:
+        with self.lock:
+            if (item := self.items.get(key)) is None:
+                self.misses += 1
+                return None
+            expire_at, value = item
+            if expire_at < time.monotonic():
+                del self.items[key]
+                self.misses += 1
+                return None
+            self.items.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def peek(self, key: K) -> V | None:
+        """통계와 LRU 순서에 영향을 주지 않고 조회"""
+        with self.lock:
+            if (item := self.items.get(key)) is None or item[0] < time.monotonic():
+                return None
+            return item[1]
+
+    def set(self, key: K, value: V):
+        if self.max_size <= 0 or self.ttl <= 0:
+            return
+        with self.lock:
+            self.items[key] = (time.monotonic() + self.ttl, value)
+            self.items.move_to_end(key)
+            while self.max_size < len(self.items):
+                self.items.popitem(last=False)
+
+    def delete(self, key: K):
+        with self.lock:
+            self.items.pop(key, None)
+
+    def clear(self):
+        with self.lock:
+            self.items.clear()
+
+    def stats(self):
+        return dict(size=len(self.items), hits=self.hits, misses=self.misses)
+
+
+class VersionedCache(Generic[V]):
+    """
+    버전이 붙은 항목(entry.version)을 키로 워커 안에 캐싱함. 값이 바뀔때마다 버전을 올리고
+    channel로 "{key} {version}"을 publish하면 모든 워커에서 지워짐
+    """
+
+    def __init__(self, max_size: int, ttl: float, channel: str):
+        self.entries = LocalCache[str, V](max_size, ttl)
+        # 무효화로 알게된 가장 최신 버전. 늦게 도착한 이전 버전의 조회 결과를 넣지 않기 위해 사용
+        self.versions = LocalCache[str, int](max_size, ttl)
+        self.listener = get_invalidation_listener(channel)
+        self.listener.subscribe(self.on_invalidate, self.clear)
+
+    def get(self, key: str) -> V | None:
+        if not self.listener.alive:
+            return None
+        return self.entries.get(key)
+
+    def put(self, key: str, entry: V) -> V:
+        version = entry.version  # type:ignore
+        if version < (self.versions.peek(key) or 0):
+            return entry
+        self.versions.set(key, version)
+        if self.listener.alive:
+            self.entries.set(key, entry)
+        return entry
+
+    def delete(self, key: str):
+        self.entries.delete(key)
+
+    def on_invalidate(self, message: str):
+        key, version = message.rsplit(" ", 1)
+        if (self.versions.peek(key) or 0) < int(version):
+            self.versions.set(key, int(version))
+        if (entry := self.entries.peek(key)) and entry.version < int(version):
+            self.entries.delete(key)
+
+    def clear(self):
+        self.entries.clear()
+        self.versions.clear()
+
+    def stats(self):
+        return self.entries.stats()
+
+
+class InvalidationListener:
+    """
+    redis pub/sub 채널로 오는 무효화 메시지를 워커마다 하나의 백그라운드 스레드에서 받음
+    구독이 끊겨있는 동안에는 alive가 False이므로 로컬 캐시를 사용하지 않아야함
+    끊기면 같은 스레드에서 간격을 늘려가며 다시 구독함
+    """
+
+    retry_delay = 1.0
+    max_retry_delay = 30.0
+
+    def __init__(self, channel: str):
+        self.channel = channel
+        self.callbacks: list[Callable[[str], Any]] = []
+        self.resets: list[Callable[[], Any]] = []
+        self.thread: threading.Thread | None = None
+        self.connected = False
+        self.lock = threading.Lock()
+
+    @property
+    def alive(self):
+        # 이벤트루프에서 불리므로 IO 없이 상태만 확인함. 구독은 리스너 스레드에서 함
+        if not (self.thread and self.thread.is_alive()):
+            self.start()
+            return False
+        return self.connected
+
+    def subscribe(self, callback: Callable[[str], Any], reset: Callable[[], Any]):
+        """reset은 (재)구독될때 호출되어 그 사이에 놓친 무효화를 대신함"""
+        self.callbacks.append(callback)
+        self.resets.append(reset)
+
+    def handle(self, message: dict):
+        data = message["data"]
+        if isinstance(data, bytes):
+            data = data.decode()
+        for callback in self.callbacks:
+            callback(data)
+
+    def start(self):
+        """리스너 스레드만 띄움. fork된 프로세스에서는 스레드가 없으므로 다시 띄움"""
+        with self.lock:
+            if self.thread and self.thread.is_alive():
+                return
+            self.connected = False
+            self.thread = threading.Thread(
+                target=self.run, name=f"invalidation-{self.channel}", daemon=True
+            )
+            self.thread.start()
+
+    def run(self):
+        delay = self.retry_delay
+        while True:
+            pubsub = None
+            try:
+                pubsub = get_redis().pubsub(ignore_subscribe_messages=True)
+                pubsub.subscribe(**{self.channel: self.handle})
+                for reset in self.resets:
+                    reset()
+                self.connected = True
+                delay = self.retry_delay
+                while True:
+                    pubsub.get_message(timeout=1)
+            except Exception:
+                # 구독이 끊긴 동안의 메시지는 유실되므로 다시 구독할때 reset함
+                self.connected = False
+            finally:
+                if pubsub is not None:
+                    try:
+                        pubsub.close()
+                    except Exception:
+                        pass
+            time.sleep(delay)
+            delay = min(delay * 2, self.max_retry_delay)
+
+
+_listeners: dict[str, InvalidationListener] = {}
+
+
+def get_invalidation_listener(channel: str):
+    if channel not in _listeners:
+        _listeners[channel] = InvalidationListener(channel)
+    return _listeners[channel]
 
-    def counter(self):
-        all = self.all()
-        res = defaultdict[T, int](int)
-        for item in all:
-            res[item["v"]] += item["w"]
-        sorted_res = sorted(res.items(), key=lambda x: -x[1])
-        return list(map(lambda x: x[0], sorted_res))
@@ -0,0 +1,315 @@
+import asyncio
+import json
+import time
+from collections import deque
+from typing import Any, Hashable
+
+import msgpack
+
+from django.conf import settings
+
+from channels.generic.websocket import (
+    AsyncJsonWebsocketConsumer,
+    AsyncWebsocketConsumer,
+)
+
+from .metrics import connections, messages_sent
+
+MSGPACK_SUBPROTOCOL = "webrtc.msgpack"
+
+# content, 이미 인코딩된 msgpack frame, 보낸 후 연결을 닫을지
+Outgoing = tuple[dict | None, bytes | None, bool]
+
+
+class Outbox:
+    """
+    클라이언트로 보낼 메세지 큐. 메세지는 넣은 순서대로 보내고,
+    key가 주어진 메세지는 아직 보내지 않은 같은 key의 메세지를 제자리에서 바꿔서 마지막 값만 남김
+    limit을 넘은 상태가 timeout초 동안 계속되면 put이 False를 돌려줌
+    """
+
+    def __init__(self, limit: int, timeout: float):
+        self.limit = limit
+        self.timeout = timeout
+        # [key, item]. 같은 key의 새 값은 이 자리에 덮어씀
+        self.items: deque[list] = deque()
+        self.latest: dict[Hashable, list] = {}
+        self.ready = asyncio.Event()
+        self.over_since: float | None = None
+
+    def __len__(self):
+        return len(self.items)
+
+    def put(self, item: Outgoing, key: Hashable | None = None):
+        if key is not None and (slot := self.latest.get(key)):
+            # 뒤로 옮기지 않아야 같은 sender의 이후 메세지(퇴장, sdp)보다 늦게 가지 않음
+            slot[1] = item
+        else:
+            slot = [key, item]
+            self.items.append(slot)
+            if key is not None:
+                self.latest[key] = slot
+        self.ready.set()
+        if len(self) <= self.limit:
+            self.over_since = None
+            return True
+        now = time.monotonic()
+        if self.over_since is None:
+            self.over_since = now
+        return now - self.over_since < self.timeout
+
+    def pop(self) -> Outgoing | None:
+        if not self.items:
+            self.ready.clear()
+            return None
+        key, item = self.items.popleft()
+        if key is not None:
+            del self.latest[key]
+        if len(self) <= self.limit:
+            self.over_since = None
+        return item
+
+
+class NegotiatedJsonWebsocketConsumer(AsyncJsonWebsocketConsumer):
+    """
+    클라이언트가 webrtc.msgpack 서브프로토콜을 요청하면 바이너리 MessagePack 프레임으로,
+    아니면 기존처럼 JSON 텍스트 프레임으로 주고받음
+
+    보내는 메세지는 Outbox에 쌓고 writer 태스크가 따로 보내서, 느린 클라이언트 때문에
+    채널 레이어의 메세지를 받지 못해 버려지는 일이 없도록 함
+    """
+
+    binary = False
+    # 메트릭의 consumer 라벨
+    metrics_name = "websocket"
+    accepted = False
+    # 최신 값만 의미가 있어서 보낼때 sender별로 마지막 것만 남기는 type
+    coalesce_types: frozenset[str] = frozenset()
+    outbox: Outbox | None = None
+    writer: asyncio.Task | None = None
+    slow = False
+
+    async def accept(self, subprotocol=None, headers=None):
+        if subprotocol is None and MSGPACK_SUBPROTOCOL in self.scope.get(
+            "subprotocols", []
+        ):
+            subprotocol = MSGPACK_SUBPROTOCOL
+        self.binary = subprotocol == MSGPACK_SUBPROTOCOL
+        await super().accept(subprotocol, headers)
+        if not self.accepted:
+            self.accepted = True
+            connections.inc(self.metrics_name)
+        self.outbox = Outbox(
+            settings.WEBSOCKET_OUTBOX_LIMIT, settings.WEBSOCKET_OUTBOX_TIMEOUT
+        )
+        self.writer = asyncio.create_task(self.write_outbox(self.outbox))
+
+    async def websocket_disconnect(self, message):
+        self.stop_writer()
+        try:
+            await super().websocket_disconnect(message)
+        finally:
+            # disconnect에서 accepted를 볼 수 있도록 끝난 뒤에 내림 (StopConsumer로 끝남)
+            if self.accepted:
+                self.accepted = False
+                connections.dec(self.metrics_name)
+
+    async def receive(self, text_data=None, bytes_data=None, **kwargs):
+        if bytes_data is not None and self.binary:
+            # JSON과 같이 검증된 payload만 전달되도록 원본 프레임은 넘기지 않음
+            return await self.receive_json(msgpack.unpackb(bytes_data), **kwargs)
+        return await super().receive(text_data, bytes_data, **kwargs)
+
+    async def send_json(self, content, close=False):
+        await self.send_frame(content, None, close)
+
+    async def send_frame(
+        self, content: dict | None, frame: bytes | None = None, close=False
+    ):
+        """content나 이미 인코딩된 msgpack frame 중 있는것으로 보냄"""
+        if self.slow:
+            return
+        messages_sent.inc(self.metrics_name, content.get("type", "") if content else "")
+        if self.outbox is None:
+            return await self.write(content, frame, close)
+        if not self.outbox.put((content, frame, close), self.coalesce_key(content)):
+            await self.close_slow_consumer()
+
+    def coalesce_key(self, content: dict | None) -> Hashable | None:
+        if content and content.get("type") in self.coalesce_types:
+            return (content["type"], content.get("sender"), content.get("media"))
+        return None
+
+    async def write(self, content: dict | None, frame: bytes | None, close=False):
+        if frame is None:
+            if self.binary:
+                return await self.send(bytes_data=msgpack.packb(content), close=close)
+            return await super().send_json(content, close)
+        if self.binary:
+            return await self.send(bytes_data=frame, close=close)
+        return await super().send_json(msgpack.unpackb(frame), close)
+
+    async def write_outbox(self, outbox: Outbox):
+        while True:
+            if (item := outbox.pop()) is None:
+                await outbox.ready.wait()
+                continue
+            await self.write(*item)
+            if item[2]:
+                return
+
+    def stop_writer(self):
+        if self.writer:
+            if self.writer.done() and not self.writer.cancelled():
+                # 클라이언트가 먼저 끊어서 보내다 실패한 경우
+                self.writer.exception()
+            self.writer.cancel()
+        self.writer = None
+        self.outbox = None
+
+    async def close_slow_consumer(self):
+        # 보내지 못한 메세지는 버리고 연결을 끊어서 클라이언트가 다시 접속하도록 함
+        self.slow = True
+        self.stop_writer()
+        await self.close(code=4008)
+
+
+class MultiplexConsumer(AsyncWebsocketConsumer):
+    """
+    하나의 웹소켓에 여러 컨슈머를 stream으로 나눠서 태움
+    클라이언트는 {"stream": "rooms/{room_id}/", "payload": {...}} 처럼 기존 ws/ 뒤의 경로를
+    stream으로 보내고, 처음 보낸 stream마다 streams 앱의 컨슈머가 하나씩 만들어짐
+    컨슈머가 보내는 메세지는 같은 모양으로 감싸서 보내고, stream이 닫히면
+    {"stream": ..., "close": code}를 보냄. 클라이언트도 close로 stream만 닫을 수 있음
+    """
+
+    # 바깥 연결은 채널 레이어를 쓰지 않고 각 stream의 컨슈머가 따로 채널을 가짐
+    channel_layer_alias = None
+    streams: Any = None
+    metrics_name = "multiplex"
+
+    def __init__(self, *args, streams: Any = None, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.streams = streams or self.streams
+        self.binary = False
+        self.accepted = False
+        self.children: dict[str, Stream] = {}
+
+    async def connect(self):
+        subprotocols = self.scope.get("subprotocols", [])
+        self.binary = MSGPACK_SUBPROTOCOL in subprotocols
+        await self.accept(MSGPACK_SUBPROTOCOL if self.binary else None)
+        self.accepted = True
+        connections.inc(self.metrics_name)
+
+    async def disconnect(self, code):
+        children = list(self.children.values())
+        self.children.clear()
+        for child in children:
+            child.queue.put_nowait(dict(type="websocket.disconnect", code=code))
+        # 방 퇴장처럼 disconnect에서 해야하는 일이 끝날때까지 기다림
+        await asyncio.gather(
+            *(child.task for child in children), return_exceptions=True
+        )
+        if self.accepted:
+            self.accepted = False
+            connections.dec(self.metrics_name)
+
+    async def receive(self, text_data=None, bytes_data=None):
+        try:
+            if bytes_data is not None:
+                content = msgpack.unpackb(bytes_data)
+            else:
+                content = json.loads(text_data or "")
+            name = content["stream"]
+            assert isinstance(name, str)
+        except Exception:
+            return
+        if content.get("close"):
+            if child := self.children.pop(name, None):
+                child.queue.put_nowait(dict(type="websocket.disconnect", code=1000))
+            return
+        if "payload" not in content:
+            return
+        if not (child := self.children.get(name)) and not (
+            child := self.open_stream(name)
+        ):
+            return await self.send_stream_close(name, 4009)
+        if child.binary:
+            message = dict(
+                type="websocket.receive", bytes=msgpack.packb(content["payload"])
+            )
+        else:
+            message = dict(
+                type="websocket.receive", text=json.dumps(content["payload"])
+            )
+        child.queue.put_nowait(message)
+
+    def open_stream(self, name: str):
+        if settings.WEBSOCKET_MULTIPLEX_MAX_STREAMS <= len(self.children):
+            return None
+        scope = dict(self.scope, path=f"/ws/{name}", root_path="")
+        scope.pop("path_remaining", None)
+        scope.pop("url_route", None)
+        scope["subprotocols"] = [MSGPACK_SUBPROTOCOL] if self.binary else []
+        child = Stream(name)
+        child.queue.put_nowait(dict(type="websocket.connect"))
+        child.task = asyncio.create_task(
+            self.run_stream(child, scope), name=f"stream {name}"
+        )
+        self.children[name] = child
+        return child
+
+    async def run_stream(self, child: "Stream", scope: dict):
+        async def send(message: dict):
+            await self.send_from_stream(child, message)
+
+        try:
+            await self.streams(scope, child.queue.get, send)
+        except ValueError:
+            # 연결할 수 있는 경로가 아님
+            child.closed = child.closed or 4004
+        except Exception:
+            child.closed = child.closed or 1011
+        finally:
+            if self.children.get(child.name) is child:
+                del self.children[child.name]
+                await self.send_stream_close(child.name, child.closed or 1000)
+
+    async def send_from_stream(self, child: "Stream", message: dict):
+        if message["type"] == "websocket.accept":
+            child.binary = message.get("subprotocol") == MSGPACK_SUBPROTOCOL
+        elif message["type"] == "websocket.send":
+            if self.children.get(child.name) is child:
+                await self.send_wrapped(child.name, message)
+        elif message["type"] == "websocket.close":
+            child.closed = message.get("code") or 1000
+            # 실제 소켓처럼 close 후에는 disconnect를 받아서 컨슈머가 끝나도록 함
+            child.queue.put_nowait(dict(type="websocket.disconnect", code=child.closed))
+
+    async def send_wrapped(self, name: str, message: dict):
+        text, frame = message.get("text"), message.get("bytes")
+        if self.binary:
+            if frame is None:
+                frame = msgpack.packb(json.loads(text or "null"))
+            # payload는 이미 인코딩된 프레임을 다시 인코딩하지 않고 map 뒤에 그대로 붙임
+            header = b"\x82" + msgpack.packb("stream") + msgpack.packb(name)
+            return await self.send(bytes_data=header + msgpack.packb("payload") + frame)
+        if text is None:
+            text = json.dumps(msgpack.unpackb(frame or b"\xc0"))
+        await self.send(text_data=f'{{"stream":{json.dumps(name)},"payload":{text}}}')
+
+    async def send_stream_close(self, name: str, code: int):
+        content = dict(stream=name, close=code)
+        if self.binary:
+            return await self.send(bytes_data=msgpack.packb(content))
+        await self.send(text_data=json.dumps(content))
+
+
+class Stream:
+    def __init__(self, name: str):
+        self.name = name
+        self.queue = asyncio.Queue[dict]()
+        self.task: asyncio.Task | None = None
+        self.binary = False
+        self.closed: int | None = None
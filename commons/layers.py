@@ -0,0 +1,310 @@
+import asyncio
+import collections
+import functools
+import time
+from typing import Iterable, NamedTuple
+
+from channels.exceptions import ChannelFull
+from channels_redis.core import BoundedQueue, RedisChannelLayer
+from redis.exceptions import RedisError
+
+from .metrics import layer_send_failures
+
+# 여러 메세지를 채널 키마다 넣고 각각 넣었는지(1) 가득 찼는지(0)를 돌려줌
+# 같은 키가 여러번 나올 수 있으므로 하나씩 순서대로 용량을 확인함
+GROUP_SEND_MANY_SCRIPT = """
+local now = tonumber(ARGV[1])
+local expiry = tonumber(ARGV[2])
+local result = {}
+for i = 1, #KEYS do
+    local key = KEYS[i]
+    redis.call('ZREMRANGEBYSCORE', key, 0, math.floor(now) - expiry)
+    if redis.call('ZCOUNT', key, '-inf', '+inf') < tonumber(ARGV[i * 2 + 2]) then
+        redis.call('ZADD', key, now, ARGV[i * 2 + 1])
+        redis.call('EXPIRE', key, expiry)
+        result[i] = 1
+    else
+        result[i] = 0
+    end
+end
+return result
+"""
+
+
+class GroupSendResult(NamedTuple):
+    delivered: int  # 하나 이상의 채널에 들어간 메세지 수
+    skipped: int  # 그룹에 채널이 없거나 모든 채널이 가득 차서 버려진 메세지 수
+
+
+class AffinityChannelLayer(RedisChannelLayer):
+    """
+    같은 프로세스 안의 채널로 보내는 메세지는 redis를 거치지 않고 바로 넣어줌
+    redis로 오는 메세지는 프로세스당 하나의 pump 태스크가 받아서 채널별 큐로 나눠줌
+    nginx에서 방 단위로 워커를 고정하면 대부분의 시그널링이 프로세스 안에서 끝남
+    채널별 큐에는 (만료 시각, 메세지)를 넣고 redis처럼 expiry가 지난 메세지는 버림
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.local_buffer: dict[str, BoundedQueue] = collections.defaultdict(
+            functools.partial(BoundedQueue, self.capacity)
+        )
+        # 채널마다 마지막으로 넣은 메세지의 만료 시각. 받는 컨슈머가 없는 큐를 지울때 사용
+        self.local_expires: dict[str, float] = {}
+        self.local_receiving: set[str] = set()
+        self.next_sweep = 0.0
+        self.pump_task: asyncio.Task | None = None
+        self.pump_loop: asyncio.AbstractEventLoop | None = None
+
+    def is_local(self, channel: str):
+        return "!" in channel and self.non_local_name(channel).endswith(
+            self.client_prefix + "!"
+        )
+
+    async def send(self, channel, message):
+        if not self.is_local(channel):
+            try:
+                return await super().send(channel, message)
+            except ChannelFull:
+                layer_send_failures.inc("full")
+                raise
+            except (OSError, RedisError):
+                layer_send_failures.inc("redis")
+                raise
+        assert isinstance(message, dict), "message is not a dict"
+        if not self.send_local(channel, message):
+            raise ChannelFull()
+
+    def send_local(self, channel: str, message: dict):
+        queue = self.local_buffer[channel]
+        if queue.qsize() >= self.get_capacity(channel):
+            layer_send_failures.inc("full")
+            return False
+        loop = asyncio.get_running_loop()
+        if self.pump_loop is None or self.pump_loop is loop:
+            self.put_local(channel, message)
+        else:
+            # 다른 이벤트루프(async_to_sync 등)에서 보낸 경우 받는 쪽 루프에서 넣음
+            self.pump_loop.call_soon_threadsafe(self.put_local, channel, message)
+        return True
+
+    def put_local(self, channel: str, message: dict):
+        now = time.time()
+        self.local_buffer[channel].put_nowait((now + self.expiry, message))
+        self.local_expires[channel] = now + self.expiry
+        if now >= self.next_sweep:
+            self.next_sweep = now + self.expiry
+            self.sweep_local(now)
+
+    def sweep_local(self, now: float):
+        """컨슈머가 사라진 채널의 큐는 받아가지 않으므로 메세지가 모두 만료되면 지움"""
+        for channel, expires_at in list(self.local_expires.items()):
+            if expires_at <= now and channel not in self.local_receiving:
+                self.local_buffer.pop(channel, None)
+                del self.local_expires[channel]
+
+    async def group_send(self, group, message):
+        try:
+            return await super().group_send(group, message)
+        except (OSError, RedisError):
+            layer_send_failures.inc("redis")
+            raise
+
+    async def group_send_many(
+        self, messages: Iterable[tuple[str, dict]], batch_size: int = 500
+    ):
+        """
+        (group, message) 여러개를 한번에 보냄. 그룹 조회와 전송을 redis 샤드마다
+        batch_size개씩 묶어서 보내므로 group_send를 반복하는 것보다 왕복이 훨씬 적음
+        """
+        messages = list(messages)
+        for group, _ in messages:
+            assert self.valid_group_name(group), "Group name not valid"
+        try:
+            members = await self.group_members_many(
+                [g for g, _ in messages], batch_size
+            )
+            # 샤드별 (채널 키, 직렬화된 메세지, 용량, 메세지 번호)
+            entries = collections.defaultdict(list)
+            reached = [0] * len(messages)
+            for index, ((_, message), channels) in enumerate(zip(messages, members)):
+                remote = []
+                for channel in channels:
+                    if self.is_local(channel):
+                        reached[index] += self.send_local(channel, message)
+                    else:
+                        remote.append(channel)
+                if not remote:
+                    continue
+                by_connection, serialized, capacity = (
+                    self._map_channel_keys_to_connection(remote, message)
+                )
+                for connection_index, keys in by_connection.items():
+                    entries[connection_index].extend(
+                        (key, serialized[key], capacity[key], index) for key in keys
+                    )
+            for connection_index, items in entries.items():
+                connection = self.connection(connection_index)
+                for start in range(0, len(items), batch_size):
+                    batch = items[start : start + batch_size]
+                    args = [time.time(), int(self.expiry)]
+                    for _, value, capacity, _ in batch:
+                        args += [value, capacity]
+                    results = await connection.eval(
+                        GROUP_SEND_MANY_SCRIPT,
+                        len(batch),
+                        *[key for key, *_ in batch],
+                        *args,
+                    )
+                    for (*_, index), ok in zip(batch, results):
+                        reached[index] += ok
+                        if not ok:
+                            layer_send_failures.inc("full")
+        except (OSError, RedisError):
+            layer_send_failures.inc("redis")
+            raise
+        delivered = sum(1 for count in reached if count)
+        return GroupSendResult(delivered, len(messages) - delivered)
+
+    async def group_members_many(self, groups: list[str], batch_size: int):
+        """그룹마다 만료되지 않은 채널 목록을 샤드별 pipeline으로 가져옴"""
+        members: list[list[str]] = [[] for _ in groups]
+        by_connection = collections.defaultdict(list)
+        for index, group in enumerate(groups):
+            by_connection[self.consistent_hash(group)].append(index)
+        expired = int(time.time()) - self.group_expiry
+        for connection_index, indexes in by_connection.items():
+            connection = self.connection(connection_index)
+            for start in range(0, len(indexes), batch_size):
+                batch = indexes[start : start + batch_size]
+                pipe = connection.pipeline(transaction=False)
+                for index in batch:
+                    key = self._group_key(groups[index])
+                    pipe.zremrangebyscore(key, min=0, max=expired)
+                    pipe.zrange(key, 0, -1)
+                results = await pipe.execute()
+                for index, channels in zip(batch, results[1::2]):
+                    members[index] = [channel.decode("utf8") for channel in channels]
+        return members
+
+    async def receive(self, channel):
+        if not self.is_local(channel):
+            return await super().receive(channel)
+        self.local_receiving.add(channel)
+        try:
+            self.start_pump()
+            queue = self.local_buffer[channel]
+            while True:
+                expires_at, message = await queue.get()
+                if expires_at > time.time():
+                    break
+            if queue.empty():
+                self.discard_local(channel)
+            return message
+        except asyncio.CancelledError:
+            if (queue := self.local_buffer.get(channel)) and queue.empty():
+                self.discard_local(channel)
+            raise
+        finally:
+            self.local_receiving.discard(channel)
+
+    def discard_local(self, channel: str):
+        self.local_buffer.pop(channel, None)
+        self.local_expires.pop(channel, None)
+
+    def start_pump(self):
+        """
+        pump는 한번 띄우면 close_pools/flush까지 계속 돌림
+        받는 중에 취소하면 bzpopmin과 백업 큐 사이에서 메세지를 잃을 수 있으므로
+        메세지마다 멈추지 않음. 루프가 닫혀서 끝난 pump만 새로 띄움
+        """
+        loop = asyncio.get_running_loop()
+        if (
+            self.pump_task
+            and not self.pump_task.done()
+            and self.pump_loop
+            and not self.pump_loop.is_closed()
+        ):
+            if self.pump_loop is not loop:
+                raise RuntimeError(
+                    "Two event loops are trying to receive() on one channel layer at once!"
+                )
+            return
+        self.pump_loop = loop
+        self.pump_task = loop.create_task(self.pump())
+
+    async def flush(self):
+        self.local_buffer.clear()
+        self.local_expires.clear()
+        # 마지막에 close_pools를 부르므로 pump도 같이 멈춤
+        await super().flush()
+
+    async def close_pools(self):
+        """
+        pump를 멈추고 커넥션을 닫음. bzpopmin은 취소가 타임아웃과 겹치면 None으로
+        바뀌어 무시될 수 있으므로, 커넥션을 닫아서 pump가 에러를 받고 끝나게 함
+        """
+        task, self.pump_task, self.pump_loop = self.pump_task, None, None
+        if task is asyncio.current_task():
+            # 루프가 닫히면서 취소된 pump가 스스로 부른 경우
+            task = None
+        if task and not task.done():
+            task.cancel()
+        await super().close_pools()
+        if task and not task.done() and task.get_loop() is asyncio.get_running_loop():
+            await asyncio.wait([task], timeout=1)
+
+    async def pump(self):
+        channel = f"specific.{self.client_prefix}!"
+        task = asyncio.current_task()
+        while self.pump_task is task:
+            receiving = asyncio.ensure_future(self.receive_single(channel))
+            try:
+                await asyncio.wait([receiving])
+            except asyncio.CancelledError:
+                # asyncio.run 종료처럼 close_pools 없이 취소되어도 receive_single이
+                # 끝나도록 커넥션을 닫음
+                receiving.cancel()
+                if self.pump_task is task:
+                    await self.close_pools()
+                raise
+            try:
+                message_channel, message = receiving.result()
+            except (OSError, RedisError):
+                if self.pump_task is not task:
+                    return
+                # redis가 잠깐 끊겨도 기다리는 컨슈머들이 멈추지 않도록 다시 시도함
+                await asyncio.sleep(1)
+                continue
+            if isinstance(message_channel, list):
+                for name in message_channel:
+                    self.put_local(name, message)
+            else:
+                self.put_local(message_channel, message)
+
+
+def is_local_channel(layer, channel: str) -> bool:
+    return isinstance(layer, AffinityChannelLayer) and layer.is_local(channel)
+
+
+async def send_or_drop(layer, channel: str, message: dict) -> bool:
+    """group_send처럼 가득 찬 채널로 가는 메세지는 버림. 버렸으면 False"""
+    try:
+        await layer.send(channel, message)
+    except ChannelFull:
+        if not isinstance(layer, AffinityChannelLayer):
+            # AffinityChannelLayer는 send에서 이미 셈
+            layer_send_failures.inc("full")
+        return False
+    return True
+
+
+async def group_send_many(layer, messages: Iterable[tuple[str, dict]]):
+    """group_send_many를 지원하지 않는 레이어에서는 그룹마다 보내고 모두 전달된 것으로 셈"""
+    if isinstance(layer, AffinityChannelLayer):
+        return await layer.group_send_many(messages)
+    count = 0
+    for group, message in messages:
+        await layer.group_send(group, message)
+        count += 1
+    return GroupSendResult(count, 0)
@@ -1,15 +1,165 @@
+import asyncio
+import contextvars
 from functools import wraps
+import inspect
+import threading
+import weakref
 import redis, os
 from typing import Generic, TypeVar, ParamSpec, Callable
 
+import redis.asyncio
 import redis.lock
+from django.conf import settings
+
+from .metrics import registry
 
 T = TypeVar("T")
 P = ParamSpec("P")
 
 
+class CountingConnectionPool(redis.BlockingConnectionPool):
+    """
+    사용중인 커넥션 수를 세서 풀이 포화되는지 볼 수 있게 함
+    여러 스레드에서 쓰므로 카운터는 lock을 잡고 바꿈. 풀의 _lock은 make_connection을
+    부를때 잡혀있을 수 있고 재진입이 안되므로 따로 둠
+    """
+
+    def reset(self):
+        super().reset()
+        self.stats_lock = threading.Lock()
+        self.created = 0
+        self.in_use = 0
+        self.max_in_use = 0
+
+    def make_connection(self):
+        with self.stats_lock:
+            self.created += 1
+        return super().make_connection()
+
+    def get_connection(self, *args, **kwargs):
+        connection = super().get_connection(*args, **kwargs)
+        with self.stats_lock:
+            self.in_use += 1
+            self.max_in_use = max(self.max_in_use, self.in_use)
+        return connection
+
+    def release(self, connection):
+        with self.stats_lock:
+            self.in_use -= 1
+        return super().release(connection)
+
+    def stats(self):
+        return dict(
+            max_connections=self.max_connections,
+            created=self.created,
+            in_use=self.in_use,
+            max_in_use=self.max_in_use,
+        )
+
+
+class AsyncCountingConnectionPool(redis.asyncio.BlockingConnectionPool):
+    created = 0
+    in_use = 0
+    max_in_use = 0
+
+    def make_connection(self):
+        self.created += 1
+        return super().make_connection()
+
+    async def get_connection(self, *args, **kwargs):
+        connection = await super().get_connection(*args, **kwargs)
+        self.in_use += 1
+        self.max_in_use = max(self.max_in_use, self.in_use)
+        return connection
+
+    async def release(self, connection):
+        self.in_use -= 1
+        return await super().release(connection)
+
+    def stats(self):
+        return dict(
+            max_connections=self.max_connections,
+            created=self.created,
+            in_use=self.in_use,
+            max_in_use=self.max_in_use,
+        )
+
+
+def get_pool_options():
+    options = settings.REDIS_POOL
+    return dict(
+        max_connections=options["MAX_CONNECTIONS"],
+        timeout=options["TIMEOUT"],
+        socket_timeout=options["SOCKET_TIMEOUT"],
+        socket_connect_timeout=options["SOCKET_CONNECT_TIMEOUT"],
+        health_check_interval=options["HEALTH_CHECK_INTERVAL"],
+    )
+
+
+# 프로세스 전체에서 하나의 커넥션풀을 공유함 (fork된 워커에서는 redis-py가 알아서 새로 만듦)
+_pool: CountingConnectionPool | None = None
+
+
+def get_pool():
+    global _pool
+    if _pool is None:
+        _pool = CountingConnectionPool.from_url(
+            os.getenv("CACHE_HOST"), **get_pool_options()
+        )
+    return _pool
+
+
 def get_redis():
-    return redis.from_url(os.getenv("CACHE_HOST"))
+    return redis.Redis(connection_pool=get_pool())
+
+
+# asyncio 커넥션은 이벤트 루프에 묶여있으므로 루프마다 풀을 하나씩 공유함
+_async_pools = weakref.WeakKeyDictionary[
+    asyncio.AbstractEventLoop, AsyncCountingConnectionPool
+]()
+
+
+def get_async_pool():
+    loop = asyncio.get_running_loop()
+    if (pool := _async_pools.get(loop)) is None:
+        pool = AsyncCountingConnectionPool.from_url(
+            os.getenv("CACHE_HOST"), **get_pool_options()
+        )
+        _async_pools[loop] = pool
+    return pool
+
+
+def get_async_redis():
+    return redis.asyncio.Redis(connection_pool=get_async_pool())
+
+
+def pool_stats():
+    return dict(
+        sync=_pool.stats() if _pool else None,
+        asyncio=[pool.stats() for pool in list(_async_pools.values())],
+    )
+
+
+redis_pool_connections = registry.gauge(
+    "redis_pool_connections",
+    "Shared redis connection pool usage. asyncio pools are summed over event loops",
+    ["pool", "state"],
+)
+
+
+@registry.collect
+def collect_pool_stats():
+    stats = pool_stats()
+    pools = dict(asyncio=stats["asyncio"])
+    if stats["sync"]:
+        pools["sync"] = [stats["sync"]]
+    for name, values in pools.items():
+        if not values:
+            continue
+        for state in ("max_connections", "created", "in_use"):
+            redis_pool_connections.set(sum(v[state] for v in values), name, state)
+        max_in_use = max(v["max_in_use"] for v in values)
+        redis_pool_connections.set(max_in_use, name, "max_in_use")
 
 
 def _with_lock(key: str | Callable[P, str], blocking_timeout: int | None = None):
@@ -21,7 +171,7 @@ def _with_lock(key: str | Callable[P, str], blocking_timeout: int | None = None)
         def wrapper(*args: P.args, **kwargs: P.kwargs):
 
             _key = key if isinstance(key, str) else key(*args, **kwargs)
-            with redis.from_url(os.getenv("CACHE_HOST")) as client:
+            with get_redis() as client:
                 with client.lock(name=_key, blocking_timeout=5):
                     return func(*args, **kwargs)
 
@@ -31,7 +181,12 @@ def _with_lock(key: str | Callable[P, str], blocking_timeout: int | None = None)
 
 
 class with_lock(Generic[P, T]):
-    lock: redis.lock.Lock
+    """
+    데코레이터로 쓰면 key가 callable일때 함수 인자로 key를 만듦
+    with / async with로 쓸때는 인자가 없으므로 문자열 key만 받음
+    잡은 lock은 인스턴스 대신 컨텍스트(스레드, 태스크)마다 보관해서
+    같은 인스턴스를 동시에 써도 섞이지 않음
+    """
 
     def __init__(
         self, key: str | Callable[P, str], blocking_timeout: int | None = None
@@ -39,8 +194,12 @@ class with_lock(Generic[P, T]):
         self.blocking_timeout = 5 if blocking_timeout == None else blocking_timeout
         self.blocking_timeout = blocking_timeout
         self.key = key
+        self.held = contextvars.ContextVar[tuple](f"with_lock-{id(self)}", default=())
 
     def __call__(self, func: Callable[P, T]) -> Callable[P, T]:
+        if inspect.iscoroutinefunction(func):
+            return self.async_call(func)
+
         def wrapper(*args: P.args, **kwargs: P.kwargs) -> T:
             key = self.key if isinstance(self.key, str) else self.key(*args, **kwargs)
             with get_redis() as client:
@@ -49,13 +208,46 @@ class with_lock(Generic[P, T]):
 
         return wrapper
 
+    def async_call(self, func):
+        async def wrapper(*args, **kwargs):
+            key = self.key if isinstance(self.key, str) else self.key(*args, **kwargs)
+            client = get_async_redis()
+            async with client.lock(name=key, blocking_timeout=self.blocking_timeout):
+                return await func(*args, **kwargs)
+
+        return wrapper
+
+    def context_key(self) -> str:
+        if not isinstance(self.key, str):
+            raise TypeError("callable key can only be used as a decorator")
+        return self.key
+
+    def push(self, lock):
+        self.held.set((*self.held.get(), lock))
+
+    def pop(self):
+        *held, lock = self.held.get()
+        self.held.set(tuple(held))
+        return lock
+
     def __enter__(self):
-        key = self.key if isinstance(self.key, str) else ""
-        self.client = get_redis()
-        self.lock = self.client.lock(name=key, blocking_timeout=self.blocking_timeout)
-        self.lock.__enter__()
-        return self.lock
+        lock = get_redis().lock(
+            name=self.context_key(), blocking_timeout=self.blocking_timeout
+        )
+        lock.__enter__()
+        self.push(lock)
+        return lock
 
     def __exit__(self, *args, **kwargs):
-        self.lock.__exit__(*args, **kwargs)
-        self.client.close()
+        self.pop().__exit__(*args, **kwargs)
+
+    async def __aenter__(self):
+        lock = get_async_redis().lock(
+            name=self.context_key(), blocking_timeout=self.blocking_timeout
+        )
+        await lock.__aenter__()
+        self.push(lock)
+        return lock
+
+    async def __aexit__(self, *args, **kwargs):
+        await self.pop().__aexit__(*args, **kwargs)
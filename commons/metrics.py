@@ -0,0 +1,257 @@
+import bisect
+import time
+from collections import defaultdict
+from typing import Any, Callable, Iterable, Sequence
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+
+Labels = tuple[str, ...]
+
+# 초 단위 지연시간
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1)
+# group_send 한번에 받는 채널 수
+FANOUT_BUCKETS = (1, 2, 4, 8, 16, 32, 64, 128)
+
+
+def escape(value: str):
+    return value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def format_labels(names: Sequence[str], values: Iterable[Any]):
+    pairs = [f'{name}="{escape(str(value))}"' for name, value in zip(names, values)]
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+def format_value(value: float):
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Metric:
+    kind = "untyped"
+
+    def __init__(self, name: str, documentation: str, labels: Sequence[str] = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labels = tuple(labels)
+
+    def samples(self) -> Iterable[tuple[str, Sequence[str], Iterable, float]]:
+        raise NotImplementedError
+
+    def render(self):
+        lines = [
+            f"# HELP {self.name} {self.documentation}",
+            f"# TYPE {self.name} {self.kind}",
+        ]
+        for name, label_names, label_values, value in self.samples():
+            labels = format_labels(label_names, label_values)
+            lines.append(f"{name}{labels} {format_value(value)}")
+        return "\n".join(lines)
+
+
+class Counter(Metric):
+    """
+    워커 안에서만 쓰는 카운터. 이벤트루프에서 dict 값을 더하기만 하므로 락을 잡지 않음
+    여러 워커의 값은 prometheus에서 합침
+    """
+
+    kind = "counter"
+
+    def __init__(self, name: str, documentation: str, labels: Sequence[str] = ()):
+        super().__init__(name, documentation, labels)
+        self.values: defaultdict[Labels, float] = defaultdict(int)
+
+    def inc(self, *labels: str, value: float = 1):
+        self.values[labels] += value
+
+    def samples(self):
+        for labels, value in list(self.values.items()):
+            yield self.name, self.labels, labels, value
+
+
+class Gauge(Counter):
+    kind = "gauge"
+
+    def set(self, value: float, *labels: str):
+        self.values[labels] = value
+
+    def dec(self, *labels: str, value: float = 1):
+        # 방 단위처럼 라벨이 계속 늘어나는 값은 0이 되면 지움
+        if (current := self.values[labels] - value) == 0:
+            del self.values[labels]
+        else:
+            self.values[labels] = current
+
+
+class Histogram(Metric):
+    kind = "histogram"
+
+    def __init__(
+        self,
+        name: str,
+        documentation: str,
+        labels: Sequence[str] = (),
+        buckets: Sequence[float] = LATENCY_BUCKETS,
+    ):
+        super().__init__(name, documentation, labels)
+        self.buckets = tuple(buckets)
+        # 라벨별 버킷 카운트(마지막은 +Inf)와 합계. 누적은 출력할때 계산함
+        self.counts: dict[Labels, list[int]] = {}
+        self.sums: defaultdict[Labels, float] = defaultdict(float)
+
+    def observe(self, value: float, *labels: str):
+        if (counts := self.counts.get(labels)) is None:
+            counts = self.counts[labels] = [0] * (len(self.buckets) + 1)
+        counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sums[labels] += value
+
+    def samples(self):
+        bucket_labels = self.labels + ("le",)
+        for labels, counts in list(self.counts.items()):
+            total = 0
+            for bound, count in zip((*self.buckets, float("inf")), counts):
+                total += count
+                yield f"{self.name}_bucket", bucket_labels, (
+                    *labels,
+                    format_value(bound),
+                ), total
+            yield f"{self.name}_sum", self.labels, labels, self.sums[labels]
+            yield f"{self.name}_count", self.labels, labels, total
+
+
+class Registry:
+    def __init__(self):
+        self.metrics: list[Metric] = []
+        # 출력하기 직전에 호출해서 다른 곳에서 세고 있는 값을 메트릭에 옮김
+        self.collectors: list[Callable[[], Any]] = []
+
+    def register(self, metric: Metric):
+        self.metrics.append(metric)
+        return metric
+
+    def counter(self, name: str, documentation: str, labels: Sequence[str] = ()):
+        return self.register(Counter(name, documentation, labels))
+
+    def gauge(self, name: str, documentation: str, labels: Sequence[str] = ()):
+        return self.register(Gauge(name, documentation, labels))
+
+    def histogram(
+        self,
+        name: str,
+        documentation: str,
+        labels: Sequence[str] = (),
+        buckets: Sequence[float] = LATENCY_BUCKETS,
+    ):
+        return self.register(Histogram(name, documentation, labels, buckets))
+
+    def collect(self, collector: Callable[[], Any]):
+        self.collectors.append(collector)
+        return collector
+
+    def render(self):
+        for collector in self.collectors:
+            collector()
+        return "\n".join(metric.render() for metric in self.metrics) + "\n"
+
+
+registry = Registry()
+
+connections = registry.gauge(
+    "websocket_connections", "Open websocket connections", ["consumer"]
+)
+room_connections = registry.gauge(
+    "room_connections", "Open websocket connections per room", ["room"]
+)
+messages_received = registry.counter(
+    "websocket_messages_received_total",
+    "Routed websocket messages received",
+    ["consumer", "type"],
+)
+messages_rejected = registry.counter(
+    "websocket_messages_rejected_total",
+    "Websocket messages with an unknown type or an invalid payload",
+    ["consumer"],
+)
+messages_sent = registry.counter(
+    "websocket_messages_sent_total", "Websocket messages sent", ["consumer", "type"]
+)
+handler_seconds = registry.histogram(
+    "websocket_handler_seconds", "Websocket handler latency", ["consumer", "type"]
+)
+handler_errors = registry.counter(
+    "websocket_handler_errors_total",
+    "Websocket handlers that raised",
+    ["consumer", "type"],
+)
+group_send_fanout = registry.histogram(
+    "channel_group_send_fanout",
+    "Channels reached by one group send",
+    ["consumer"],
+    FANOUT_BUCKETS,
+)
+layer_send_failures = registry.counter(
+    "channel_layer_send_failures_total", "Failed channel layer sends", ["reason"]
+)
+sync_to_async_seconds = registry.histogram(
+    "sync_to_async_seconds",
+    "Time spent in sync_to_async calls including the thread pool wait",
+    ["function"],
+)
+
+
+def instrument_router(router, consumer: str):
+    """MessageRouter의 처리 시간과 type별 수신 수, 버려진 메세지 수를 메트릭에 남김"""
+
+    def hook(message_type: str, elapsed: float, ok: bool):
+        messages_received.inc(consumer, message_type)
+        handler_seconds.observe(elapsed, consumer, message_type)
+        if not ok:
+            handler_errors.inc(consumer, message_type)
+
+    def reject_hook(message_type: str | None):
+        messages_rejected.inc(consumer)
+
+    router.add_hook(hook)
+    router.add_reject_hook(reject_hook)
+    return router
+
+
+def timed_sync_to_async(func: Callable, **kwargs):
+    """스레드풀을 기다리는 시간까지 포함해서 sync_to_async 호출 시간을 남김"""
+    wrapped = sync_to_async(func, **kwargs)
+    name = getattr(func, "__qualname__", repr(func))
+
+    async def call(*args, **kw):
+        started = time.perf_counter()
+        try:
+            return await wrapped(*args, **kw)
+        finally:
+            sync_to_async_seconds.observe(time.perf_counter() - started, name)
+
+    return call
+
+
+class MetricsMiddleware:
+    """http 요청 중 METRICS_PATH만 django를 거치지 않고 prometheus 텍스트로 응답함"""
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        path = settings.METRICS_PATH
+        if not path or scope["type"] != "http" or scope["path"] != path:
+            return await self.app(scope, receive, send)
+        body = registry.render().encode()
+        await send(
+            {
+                "type": "http.response.start",
+                "status": 200,
+                "headers": [
+                    (b"content-type", b"text/plain; version=0.0.4; charset=utf-8"),
+                    (b"content-length", str(len(body)).encode()),
+                ],
+            }
+        )
+        await send({"type": "http.response.body", "body": body})
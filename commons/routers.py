@@ -0,0 +1,137 @@
+import inspect
+import time
+from typing import Any, Callable, Literal, get_args, get_origin, get_type_hints
+
+from pydantic import TypeAdapter, ValidationError
+
+Hook = Callable[[str, float, bool], Any]
+RejectHook = Callable[[str | None], Any]
+
+
+def literal_values(schema: type) -> list[str]:
+    """TypedDict의 type 필드에 선언된 Literal 값들"""
+    annotation = get_type_hints(schema).get("type")
+    if get_origin(annotation) is Literal:
+        return list(get_args(annotation))
+    # Literal["a"] | Literal["b"]
+    return [value for arg in get_args(annotation) for value in get_args(arg)]
+
+
+class RouteStats:
+    __slots__ = ("count", "invalid", "errors", "seconds")
+
+    def __init__(self):
+        self.count = 0
+        self.invalid = 0
+        self.errors = 0
+        self.seconds = 0.0
+
+    def as_dict(self):
+        return {name: getattr(self, name) for name in self.__slots__}
+
+
+class Route:
+    __slots__ = ("handler", "adapter", "pass_kwargs")
+
+    def __init__(self, handler: Callable, schema: type):
+        self.handler = handler
+        # 검증기는 등록할때 한번만 만들어둠
+        self.adapter = TypeAdapter(schema)
+        parameters = inspect.signature(handler).parameters.values()
+        self.pass_kwargs = len(parameters) > 2 or any(
+            p.kind is p.VAR_KEYWORD for p in parameters
+        )
+
+
+class MessageRouter:
+    """
+    웹소켓 메세지를 type 필드로 찾은 핸들러에 넘겨줌
+    핸들러마다 TypedDict 스키마로 검증하고, 등록되지 않은 type은 바로 버림
+
+        router = MessageRouter()
+
+        class Consumer(AsyncJsonWebsocketConsumer):
+            @router.route(SendSDP)
+            async def handle_send_sdp(self, content: SendSDP): ...
+
+            async def receive_json(self, content, **kwargs):
+                await router.dispatch(self, content, **kwargs)
+    """
+
+    def __init__(self, default: str | None = None):
+        # type 필드가 없는 메세지를 처리할 type
+        self.default = default
+        self.routes: dict[str, tuple[Route, RouteStats]] = {}
+        self.rejected = 0
+        self.hooks: list[Hook] = []
+        self.reject_hooks: list[RejectHook] = []
+
+    def route(self, schema: type, *types: str):
+        """types를 생략하면 스키마의 type Literal 값들로 등록함"""
+
+        def decorator(handler: Callable):
+            route = Route(handler, schema)
+            for message_type in types or literal_values(schema):
+                if message_type in self.routes:
+                    raise ValueError(f"{message_type} is already routed")
+                self.routes[message_type] = (route, RouteStats())
+            return handler
+
+        return decorator
+
+    def add_hook(self, hook: Hook):
+        """처리가 끝날때마다 hook(type, 걸린 시간, 성공 여부)를 호출함"""
+        self.hooks.append(hook)
+
+    def add_reject_hook(self, hook: RejectHook):
+        """버려진 메세지마다 hook(type)을 호출함. type을 알 수 없으면 None"""
+        self.reject_hooks.append(hook)
+
+    def reject(self, message_type: str | None):
+        for hook in self.reject_hooks:
+            hook(message_type)
+        return False
+
+    async def dispatch(self, consumer: Any, content: Any, **kwargs):
+        if not isinstance(content, dict):
+            self.rejected += 1
+            return self.reject(None)
+        message_type = content.get("type", self.default)
+        if not isinstance(message_type, str):
+            self.rejected += 1
+            return self.reject(None)
+        if (routed := self.routes.get(message_type)) is None:
+            self.rejected += 1
+            return self.reject(message_type)
+        route, stats = routed
+        try:
+            payload = route.adapter.validate_python(content)
+        except ValidationError:
+            stats.invalid += 1
+            return self.reject(message_type)
+        started = time.perf_counter()
+        ok = False
+        try:
+            if route.pass_kwargs:
+                await route.handler(consumer, payload, **kwargs)
+            else:
+                await route.handler(consumer, payload)
+            ok = True
+        finally:
+            elapsed = time.perf_counter() - started
+            stats.count += 1
+            stats.seconds += elapsed
+            if not ok:
+                stats.errors += 1
+            for hook in self.hooks:
+                hook(message_type, elapsed, ok)
+        return True
+
+    def stats(self):
+        return dict(
+            rejected=self.rejected,
+            types={
+                message_type: stats.as_dict()
+                for message_type, (_, stats) in self.routes.items()
+            },
+        )
@@ -1,8 +1,12 @@
+import asyncio
 import base64
 import os
+import time
 from time import sleep
 import redis
 
+from asgiref.sync import async_to_sync
+from django.conf import settings
 
 from django.test import TestCase
 from django.core.cache import cache
@@ -42,6 +46,133 @@ class TestCommon(TestCase):
             something = client.get(key)
             self.assertEqual(something, None)
 
+    def test_with_lock(self):
+        from .lock import get_redis, with_lock
+        from .metrics import registry
+
+        # 같은 인스턴스를 여러 태스크에서 써도 각자 잡은 lock을 풀어줌
+        lock = with_lock("v1:test:lock")
+
+        async def hold():
+            async with lock:
+                await asyncio.sleep(0.01)
+
+        async def run():
+            await asyncio.gather(hold(), hold())
+
+        async_to_sync(run)()
+        self.assertFalse(get_redis().exists("v1:test:lock"))
+
+        # callable key는 인자를 알 수 없으므로 with로는 쓸 수 없음
+        with self.assertRaises(TypeError):
+            with with_lock(lambda: "v1:test:lock"):
+                pass
+
+        with lock:
+            pass
+        text = registry.render()
+        self.assertIn('redis_pool_connections{pool="sync",state="in_use"}', text)
+        self.assertIn('redis_pool_connections{pool="sync",state="max_in_use"}', text)
+
+    def test_lru_cache(self):
+        from .caches import LRUCache
+
+        with LRUCache("test:lru", 4) as lru:
+            lru.trunc()
+            lru.add(1, 2, 2)
+            lru.add(3, 2, 1)
+            self.assertEqual(lru.all(), [2, 3, 2, 1])
+            self.assertEqual(lru.counter(), [2, 3, 1])
+            self.assertEqual(lru.lpop(), [b"2"])
+            self.assertEqual(lru.counter(), [3, 2, 1])
+            lru.add(*range(10))
+            self.assertEqual(lru.all(), [6, 7, 8, 9])
+
+            # 횟수 집합이 없던 이전 목록은 처음 쓸때 다시 만듦
+            lru.client.delete(lru.freq_key)
+            lru.add(9)
+            self.assertEqual(lru.counter(), [9, 8, 7])
+            lru.trunc()
+
+    def test_timeout_cache(self):
+        import json
+        from datetime import timedelta
+
+        from django.utils.timezone import localtime
+
+        from .caches import TimeoutCache
+
+        now = localtime()
+        with TimeoutCache[int]("test:timeout") as cache:
+            cache.trunc()
+            # 이전 버전의 list 형식은 처음 쓸때 옮겨짐
+            old = cache.minute_timestamp(now - timedelta(hours=2))
+            old -= cache.pivot_time_minute
+            cache.client.rpush(cache.key, json.dumps(dict(v=1, c=old, w=1)))
+            cache.add(2, created_at=now - timedelta(hours=1))
+            cache.add(3, 3)
+            self.assertEqual([item["v"] for item in cache.all()], [1, 2, 3, 3])
+            self.assertFalse(cache.client.exists(cache.key))
+
+            # 최소 개수를 남기면서 오래된 것부터 지움
+            removed = cache.remove_out_dated(now - timedelta(minutes=30), 3)
+            self.assertEqual(removed, 1)
+            self.assertEqual([item["v"] for item in cache.all()], [2, 3, 3])
+            self.assertEqual(cache.remove_out_dated(now - timedelta(minutes=30), 0), 1)
+            self.assertEqual(cache.counter(), [3])
+
+            # 가중치 합은 넣고 지울때 같이 바뀌고 limit개만 읽음
+            cache.add("a", weights=5)
+            cache.add({"b": [1, 2]}, weights=3, created_at=now - timedelta(hours=3))
+            self.assertEqual(cache.counter(), ["a", {"b": [1, 2]}, 3])
+            self.assertEqual(cache.counter(limit=1), ["a"])
+            cache.remove_out_dated(now - timedelta(hours=1), 0)
+            self.assertEqual(cache.counter(), ["a", 3])
+            # counts가 없던 이전 형식은 항목에서 다시 계산함
+            cache.client.delete(cache.counts_key, cache.migrated_key)
+            self.assertEqual(cache.counter(limit=2), ["a", 3])
+            # 옮긴 뒤에는 counts가 비어도 항목을 다시 읽지 않음
+            cache.client.delete(cache.counts_key)
+            self.assertEqual(cache.counter(), [])
+            cache.trunc()
+
+            # 음수 가중치가 섞여도 합이 0 이하가 되는 중간에 잃지 않음
+            cache.add("x", weights=-3, created_at=now - timedelta(hours=2))
+            cache.add("x", weights=5)
+            cache.add("y", weights=-2)
+            cache.add("z", weights=1)
+            self.assertEqual(cache.counter(), ["x", "z", "y"])
+            cache.remove_out_dated(now - timedelta(hours=1), 0)
+            self.assertEqual(cache.counter(), ["x", "z", "y"])
+            self.assertEqual(cache.client.zscore(cache.counts_key, '"x"'), 5)
+            cache.add("y", weights=2)
+            self.assertEqual(cache.counter(), ["x", "z"])
+            cache.trunc()
+
+    def test_invalidation_listener(self):
+        from .caches import InvalidationListener
+        from .lock import get_redis
+
+        channel = "v1:test:invalidate"
+        received, resets = [], []
+        listener = InvalidationListener(channel)
+        listener.subscribe(received.append, lambda: resets.append(True))
+        # 구독은 리스너 스레드에서 하므로 처음 확인은 기다리지 않고 False를 돌려줌
+        self.assertFalse(listener.alive)
+        for _ in range(40):
+            if listener.alive:
+                break
+            sleep(0.05)
+        self.assertTrue(listener.alive)
+        self.assertEqual(resets, [True])
+
+        get_redis().publish(channel, "key 1")
+        for _ in range(40):
+            if received:
+                break
+            sleep(0.05)
+        self.assertEqual(received, ["key 1"])
+
     def test_celery(self):
         from .tasks import debug_task
 
@@ -51,3 +182,324 @@ class TestCommon(TestCase):
         three = debug_task.delay()
 
         print(one.get(), two.get(), three.get())
+
+    def test_affinity_layer(self):
+        from .layers import AffinityChannelLayer, is_local_channel, send_or_drop
+
+        config = settings.CHANNEL_LAYERS["default"]["CONFIG"]
+        # 같은 워커와 다른 워커의 레이어
+        local = AffinityChannelLayer(**config)
+        remote = AffinityChannelLayer(**config)
+
+        async def run():
+            channel = await local.new_channel()
+            self.assertTrue(is_local_channel(local, channel))
+            self.assertFalse(is_local_channel(remote, channel))
+
+            # 같은 프로세스의 채널은 redis를 거치지 않고 바로 들어감
+            await local.send(channel, {"type": "local"})
+            self.assertEqual(local.local_buffer[channel].qsize(), 1)
+            self.assertEqual(await local.receive(channel), {"type": "local"})
+
+            # 다른 워커에서 보낸 메세지는 pump를 통해 받음
+            await remote.send(channel, {"type": "remote"})
+            self.assertEqual(await local.receive(channel), {"type": "remote"})
+
+            # pump는 메세지마다 다시 띄우지 않고 계속 돌림
+            pump = local.pump_task
+            for i in range(20):
+                await remote.send(channel, {"type": "remote", "i": i})
+            for i in range(20):
+                self.assertEqual(await local.receive(channel), {"type": "remote", "i": i})
+                self.assertIs(local.pump_task, pump)
+
+            # 가득 찬 채널로 가는 메세지는 예외 없이 버림
+            full = AffinityChannelLayer(**config, capacity=1)
+            target = await full.new_channel()
+            self.assertTrue(await send_or_drop(full, target, {"type": "first"}))
+            self.assertFalse(await send_or_drop(full, target, {"type": "second"}))
+            self.assertEqual(await full.receive(target), {"type": "first"})
+
+            # 받아가는 컨슈머가 없는 채널의 큐는 메세지가 만료되면 지워짐
+            gone = await local.new_channel()
+            await local.send(gone, {"type": "gone"})
+            local.sweep_local(time.time())
+            self.assertIn(gone, local.local_buffer)
+            local.sweep_local(time.time() + local.expiry)
+            self.assertNotIn(gone, local.local_buffer)
+
+            await local.close_pools()
+            self.assertIsNone(local.pump_task)
+            self.assertTrue(pump.done())
+            await full.close_pools()
+
+        async_to_sync(run)()
+
+    def test_channels_redis_internals(self):
+        """AffinityChannelLayer가 쓰는 channels_redis 내부 구현이 바뀌면 실패함"""
+        import inspect
+        from channels_redis.core import RedisChannelLayer
+
+        from .layers import AffinityChannelLayer
+
+        for name, parameters in [
+            ("receive_single", ["self", "channel"]),
+            ("_map_channel_keys_to_connection", ["self", "channel_names", "message"]),
+            ("_group_key", ["self", "group"]),
+            ("consistent_hash", ["self", "value"]),
+            ("connection", ["self", "index"]),
+            ("non_local_name", ["self", "name"]),
+            ("get_capacity", ["self", "channel"]),
+        ]:
+            method = getattr(RedisChannelLayer, name)
+            self.assertEqual(list(inspect.signature(method).parameters), parameters)
+
+        config = settings.CHANNEL_LAYERS["default"]["CONFIG"]
+        local = AffinityChannelLayer(**config)
+        remote = AffinityChannelLayer(**config)
+        mapped = remote._map_channel_keys_to_connection(
+            ["specific.a!b", "specific.a!c"], {"type": "x"}
+        )
+        by_connection, serialized, capacity = mapped
+        keys = [key for keys in by_connection.values() for key in keys]
+        self.assertEqual(set(keys), set(serialized))
+        self.assertEqual(set(keys), set(capacity))
+
+        async def run():
+            # 같은 워커의 채널 여러개로 가는 group_send는 채널 목록(__asgi_channel__)으로 한번만 옴
+            first = await local.new_channel()
+            second = await local.new_channel()
+            for channel in (first, second):
+                await local.group_add("internals", channel)
+            await remote.group_send("internals", {"type": "group"})
+            self.assertEqual(await local.receive(first), {"type": "group"})
+            self.assertEqual(await local.receive(second), {"type": "group"})
+            for channel in (first, second):
+                await local.group_discard("internals", channel)
+            await local.close_pools()
+            await remote.close_pools()
+
+        async_to_sync(run)()
+
+    def test_group_send_many(self):
+        from .layers import AffinityChannelLayer
+
+        config = settings.CHANNEL_LAYERS["default"]["CONFIG"]
+        local = AffinityChannelLayer(**config)
+        remote = AffinityChannelLayer(**config)
+
+        async def run():
+            here = await local.new_channel()
+            there = await remote.new_channel()
+            await local.group_add("bulk-1", here)
+            await local.group_add("bulk-2", there)
+            await local.group_add("bulk-2", here)
+            result = await local.group_send_many(
+                [
+                    ("bulk-1", {"type": "one"}),
+                    ("bulk-2", {"type": "two"}),
+                    ("bulk-empty", {"type": "none"}),
+                ],
+                batch_size=1,
+            )
+            self.assertEqual((result.delivered, result.skipped), (2, 1))
+            # 같은 프로세스의 채널은 redis를 거치지 않음
+            self.assertEqual(local.local_buffer[here].qsize(), 2)
+            self.assertEqual(await remote.receive(there), {"type": "two"})
+            for group in ("bulk-1", "bulk-2"):
+                await local.group_discard(group, here)
+            await local.group_discard("bulk-2", there)
+
+        async_to_sync(run)()
+
+    def test_multiplex(self):
+        from channels.routing import URLRouter
+        from channels.testing import WebsocketCommunicator
+        from django.test import override_settings
+
+        from base.routings import websocket_urlpatterns
+        from users.consumers import UserConsumer
+        from users.models import User
+        from users.stores import ack_key, inbox_key
+
+        from .authentication import CustomTokenObtainPairSerializer, user_cache
+        from .lock import get_redis
+
+        # post_save로 celery 작업이 예약되지 않도록 bulk_create로 만듦
+        (user,) = User.objects.bulk_create(
+            [User(username="multiplex", email="multiplex@test.com")]
+        )
+        user_cache.invalidate(user.pk)
+        get_redis().delete(inbox_key(user.pk), ack_key(user.pk))
+        token = CustomTokenObtainPairSerializer.get_token(user)
+        access = str(token.access_token)  # type:ignore
+        app = URLRouter(websocket_urlpatterns)
+
+        async def run():
+            client = WebsocketCommunicator(app, "/ws/connect/")
+            connected, _ = await client.connect()
+            self.assertTrue(connected)
+            room = "rooms/multiplex/"
+            await client.send_json_to(
+                dict(
+                    stream=room,
+                    payload=dict(
+                        type="authentication", password="", user_id="1", username="a"
+                    ),
+                )
+            )
+            response = await client.receive_json_from()
+            self.assertEqual(response["stream"], room)
+            self.assertEqual(response["payload"]["type"], "authentication")
+            self.assertTrue(response["payload"]["result"])
+
+            # 같은 연결로 유저 알림도 받음
+            notifications = f"users/{user.pk}/"
+            await client.send_json_to(
+                dict(stream=notifications, payload=dict(access=access))
+            )
+            await asyncio.sleep(0.2)
+            result = await UserConsumer.asend_events(
+                [(user.pk, UserConsumer.notification_event(dict(id=1)))]
+            )
+            self.assertEqual(result.delivered, 1)
+            response = await client.receive_json_from()
+            self.assertEqual(response["stream"], notifications)
+            self.assertEqual(response["payload"]["notification"], dict(id=1))
+
+            # 없는 경로는 stream만 닫힘
+            await client.send_json_to(dict(stream="nothing/", payload=dict()))
+            self.assertEqual(
+                await client.receive_json_from(), dict(stream="nothing/", close=4004)
+            )
+            await client.disconnect()
+
+        with override_settings(ROOM_RESUME_GRACE=0):
+            async_to_sync(run)()
+
+    def test_message_router(self):
+        from typing import Literal
+        from typing_extensions import TypedDict
+        from .routers import MessageRouter
+
+        class Ping(TypedDict):
+            type: Literal["ping"] | Literal["pong"]
+            value: int
+
+        router = MessageRouter()
+        received = []
+        timings = []
+        rejects = []
+        router.add_hook(lambda message_type, *_: timings.append(message_type))
+        router.add_reject_hook(rejects.append)
+
+        class Consumer:
+            @router.route(Ping)
+            async def handle_ping(self, content: Ping, **kwargs):
+                received.append((content, kwargs))
+
+        async def run():
+            consumer = Consumer()
+            self.assertTrue(
+                await router.dispatch(consumer, dict(type="ping", value="1", extra=1))
+            )
+            self.assertTrue(
+                await router.dispatch(consumer, dict(type="pong", value=2), frame=b"")
+            )
+            # 모르는 type이나 형식이 틀린 메세지는 핸들러까지 가지 않음
+            self.assertFalse(await router.dispatch(consumer, dict(type="unknown")))
+            self.assertFalse(await router.dispatch(consumer, dict(type=["ping"])))
+            self.assertFalse(
+                await router.dispatch(consumer, dict(type="ping", value="x"))
+            )
+
+        async_to_sync(run)()
+        self.assertEqual(
+            received,
+            [
+                (dict(type="ping", value=1), {}),
+                (dict(type="pong", value=2), dict(frame=b"")),
+            ],
+        )
+        self.assertEqual(timings, ["ping", "pong"])
+        self.assertEqual(rejects, ["unknown", None, "ping"])
+        stats = router.stats()
+        self.assertEqual(stats["rejected"], 2)
+        self.assertEqual(stats["types"]["ping"]["count"], 1)
+        self.assertEqual(stats["types"]["ping"]["invalid"], 1)
+        self.assertEqual(stats["types"]["pong"]["count"], 1)
+
+    def test_outbox(self):
+        from .consumers import Outbox
+
+        outbox = Outbox(limit=3, timeout=0)
+        sdp = (dict(type="sendsdp"), None, False)
+        status = lambda status: (dict(type="streamstatus", status=status), None, False)
+        self.assertTrue(outbox.put(sdp))
+        self.assertTrue(outbox.put(status(True), key="1"))
+        self.assertTrue(outbox.put(status(False), key="1"))
+        # 같은 key는 마지막 값만 남음
+        self.assertEqual(len(outbox), 2)
+        self.assertTrue(outbox.put(sdp))
+        # 바뀐 값은 처음 넣은 자리에서 나가므로 뒤에 넣은 메세지보다 늦지 않음
+        self.assertEqual(
+            [outbox.pop(), outbox.pop(), outbox.pop(), outbox.pop()],
+            [sdp, status(False), sdp, None],
+        )
+        # 보낸 뒤에 들어온 같은 key는 새로 뒤에 들어감
+        self.assertTrue(outbox.put(status(True), key="1"))
+        self.assertTrue(outbox.put(sdp))
+        self.assertTrue(outbox.put(status(False), key="1"))
+        self.assertEqual([outbox.pop(), outbox.pop()], [status(False), sdp])
+        self.assertIsNone(outbox.pop())
+
+        # limit을 넘은 상태가 timeout 동안 계속되면 느린 클라이언트로 판단
+        for _ in range(3):
+            self.assertTrue(outbox.put(sdp))
+        self.assertFalse(outbox.put(sdp))
+        self.assertEqual(len(outbox), 4)
+
+    def test_metrics(self):
+        from channels.testing import HttpCommunicator
+        from .metrics import MetricsMiddleware, Registry, timed_sync_to_async
+
+        registry = Registry()
+        counter = registry.counter("messages_total", "Messages", ["type"])
+        gauge = registry.gauge("connections", "Connections", ["room"])
+        histogram = registry.histogram("seconds", "Latency", ["type"], [0.1, 1])
+        counter.inc("sendsdp")
+        counter.inc("sendsdp", value=2)
+        gauge.inc('a"b')
+        gauge.inc("c")
+        gauge.dec("c")
+        for value in [0.05, 0.5, 5]:
+            histogram.observe(value, "sendsdp")
+        text = registry.render()
+        self.assertIn('messages_total{type="sendsdp"} 3', text)
+        self.assertIn('connections{room="a\\"b"} 1', text)
+        # 0이 된 라벨은 지워짐
+        self.assertNotIn('room="c"', text)
+        self.assertIn('seconds_bucket{type="sendsdp",le="0.1"} 1', text)
+        self.assertIn('seconds_bucket{type="sendsdp",le="1"} 2', text)
+        self.assertIn('seconds_bucket{type="sendsdp",le="+Inf"} 3', text)
+        self.assertIn('seconds_count{type="sendsdp"} 3', text)
+        self.assertIn("# TYPE seconds histogram", text)
+
+        def add(a, b):
+            return a + b
+
+        self.assertEqual(async_to_sync(timed_sync_to_async(add))(1, 2), 3)
+
+        async def fallback(scope, receive, send):
+            await send({"type": "http.response.start", "status": 404, "headers": []})
+            await send({"type": "http.response.body", "body": b""})
+
+        app = MetricsMiddleware(fallback)
+        response = async_to_sync(
+            HttpCommunicator(app, "GET", "/metrics").get_response
+        )()
+        self.assertEqual(response["status"], 200)
+        self.assertIn(b"sync_to_async_seconds_count", response["body"])
+        self.assertIn(b"test_metrics.<locals>.add", response["body"])
+        response = async_to_sync(HttpCommunicator(app, "GET", "/other").get_response)()
+        self.assertEqual(response["status"], 404)
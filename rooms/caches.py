@@ -0,0 +1,29 @@
+from typing import Any, NamedTuple
+
+from django.conf import settings
+
+from commons.caches import VersionedCache
+
+INVALIDATION_CHANNEL = "v3:rooms:invalidate"
+
+
+class RosterEntry(NamedTuple):
+    version: int
+    room: Any  # services.Room
+    channels: dict[str, str]
+    participants: list[dict]  # 저장소에서 풀어낸 참가자. 그대로 클라이언트 응답에 씀
+
+
+class RosterCache(VersionedCache[RosterEntry]):
+    """
+    워커 안에서 방 상태를 캐싱함. 방이 바뀔때마다 저장소 스크립트가 버전을 올리고
+    INVALIDATION_CHANNEL로 "{key} {version}"을 publish하면 모든 워커에서 지워짐
+    """
+
+    def __init__(self, max_size: int, ttl: float):
+        super().__init__(max_size, ttl, INVALIDATION_CHANNEL)
+
+
+roster_cache = RosterCache(
+    settings.ROOM_ROSTER_CACHE_SIZE, settings.ROOM_ROSTER_CACHE_TTL
+)
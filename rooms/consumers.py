@@ -1,13 +1,24 @@
+import asyncio
 import json
-from typing import Any, Literal, TypedDict
+import logging
+from typing import Any, Literal
+from typing_extensions import NotRequired, TypedDict
 from asgiref.sync import async_to_sync, sync_to_async
+from redis.exceptions import RedisError
 
+from django.conf import settings
 
+from channels.consumer import get_handler_name
 from channels.layers import InMemoryChannelLayer
 from channels.layers import get_channel_layer
 from channels.generic.websocket import AsyncJsonWebsocketConsumer
 
-from .services import RoomService
+from commons.consumers import NegotiatedJsonWebsocketConsumer
+from commons.layers import is_local_channel, send_or_drop
+from commons.metrics import group_send_fanout, instrument_router, room_connections
+from commons.routers import MessageRouter
+
+from .services import AsyncRoomService, Session
 
 
 class Authentication(TypedDict):
@@ -15,10 +26,18 @@ class Authentication(TypedDict):
     password: str
     user_id: str
     username: str
+    batch_candidates: NotRequired[bool]  # candidates 프레임을 받을 수 있는 클라이언트
+    audio_on: NotRequired[bool]
+    video_on: NotRequired[bool]
+    # 끊겼던 연결을 이어받을때 이전 authentication 응답의 resume_token과 마지막으로 받은 seq
+    # 재접속 직전의 이벤트는 로그와 채널로 두번 올 수 있으므로 클라이언트는 받은 seq 이하는 무시함
+    resume_token: NotRequired[str]
+    last_seq: NotRequired[int]
 
 
 class NotifyParticipant(TypedDict):
     type: Literal["notifyparticipant"]
+    sender: str
     user_id: str
     username: str
 
@@ -37,6 +56,13 @@ class SendCandidate(TypedDict):
     candidate: dict
 
 
+class SendCandidates(TypedDict):
+    type: Literal["candidates"]
+    sender: str
+    receiver: str
+    candidates: list[dict]
+
+
 class StreamStatus(TypedDict):
     type: Literal["streamstatus"]
     sender: str
@@ -44,114 +70,285 @@ class StreamStatus(TypedDict):
     status: bool
 
 
-class RoomConsumer(AsyncJsonWebsocketConsumer):
+logger = logging.getLogger(__name__)
+
+router = instrument_router(MessageRouter(), "rooms")
+# 컨슈머가 끝난 뒤에도 grace 기간 후 퇴장 처리가 취소되지 않도록 참조를 잡아둠
+pending_leaves: set[asyncio.Task] = set()
+
+
+class RoomConsumer(NegotiatedJsonWebsocketConsumer):
     channel_layer: InMemoryChannelLayer
     signed = False
     user_id: None | str
+    batch_candidates = False
+    metrics_name = "rooms"
+    # 상태 알림은 마지막 값만 보내고, sdp/candidate는 버리지 않고 순서대로 보냄
+    coalesce_types = frozenset(["streamstatus", "notifyparticipant"])
 
     def __init__(self, *args, **kwargs):
         self.user_id = None
+        self.candidate_buffers: dict[str, list[dict]] = {}
+        self.candidate_flushers: dict[str, asyncio.Task] = {}
+        self.heartbeat_task: asyncio.Task | None = None
+        self.pending_status: dict[str, bool] = {}
+        self.status_flusher: asyncio.Task | None = None
         super().__init__(*args, **kwargs)
 
     @staticmethod
-    def get_group_name(user_id: int | str):
-        return f"message_user-{user_id}"
+    def get_group_name(room_id: int | str):
+        # 유저 알림 그룹(message_user-)과 겹치지 않도록 따로 씀
+        return f"room-{room_id}"
 
     async def connect(self):
         self.room_name = self.scope["url_route"]["kwargs"]["room_id"]
-        self.service = RoomService(self.room_name)
+        self.service = AsyncRoomService(self.room_name)
         self.group_name = self.get_group_name(self.room_name)
         if self.channel_layer:
             await self.channel_layer.group_add(self.group_name, self.channel_name)
         await self.accept()
+        room_connections.inc(self.room_name)
 
     async def disconnect(self, close_code):
+        if self.accepted:
+            room_connections.dec(self.room_name)
+        for flusher in self.candidate_flushers.values():
+            flusher.cancel()
+        self.candidate_flushers.clear()
+        if self.heartbeat_task:
+            self.heartbeat_task.cancel()
+        if self.status_flusher:
+            self.status_flusher.cancel()
         if self.channel_layer:
             if self.user_id:
-                room = await sync_to_async(self.service.remove_participant)(
-                    self.user_id
-                )
-                if room.participants:
-                    await self.channel_layer.group_send(
-                        self.group_name,
-                        dict(
-                            type="emit",
-                            data=dict(type="userdisconnected", sender=self.user_id),
-                        ),
-                    )
-                else:
-                    await sync_to_async(self.service.drop_room)()
+                await self.leave_or_wait()
             await self.channel_layer.group_discard(self.group_name, self.channel_name)
 
-    async def handle_authentication(self, content: Authentication):
-        room = await sync_to_async(self.service.authenticate)(content["password"])
-        if room == False:
-            return await self.send_authentication_success(False, dict())
-        elif room == "empty":
-            room = await sync_to_async(self.service.create_room)(
-                content["user_id"], content["password"]
+    async def leave_or_wait(self):
+        if settings.ROOM_RESUME_GRACE > 0 and await self.service.set_away(
+            self.user_id, self.channel_name
+        ):
+            # 바로 내보내지 않고 재접속을 기다림
+            task = asyncio.create_task(self.leave_later())
+            pending_leaves.add(task)
+            task.add_done_callback(pending_leaves.discard)
+            return
+        await self.leave()
+
+    async def leave(self):
+        left, participants = await self.service.remove_participant(
+            self.user_id, self.channel_name
+        )
+        if left and participants:
+            await self.broadcast(
+                dict(
+                    type="emit",
+                    data=dict(type="userdisconnected", sender=self.user_id),
+                ),
             )
+
+    async def leave_later(self):
+        await asyncio.sleep(settings.ROOM_RESUME_GRACE)
+        try:
+            # 그동안 다른 채널로 재접속했다면 스크립트에서 내보내지 않음
+            await self.leave()
+        except RedisError:
+            # lease가 grace 기간으로 줄어있어서 reap_ghost_participants가 정리함
+            pass
+
+    @router.route(Authentication)
+    async def handle_authentication(self, content: Authentication):
         participant = self.service.Participant(
             user_id=content["user_id"],
             username=content["username"],
-            audio_on=False,
-            video_on=False,
+            audio_on=content.get("audio_on", False),
+            video_on=content.get("video_on", False),
         )
+        # 인증, 방 생성, 참가자/채널 등록을 한번에 처리
+        session = await self.service.join_session(
+            participant, content["password"], self.channel_name
+        )
+        if session == False:
+            return await self.send_authentication_success(False, dict())
         self.user_id = content["user_id"]
-        room = await sync_to_async(self.service.add_participant)(participant)
-        return await self.send_authentication_success(
-            True, room.model_dump()["participants"]
+        self.room = session.room
+        self.batch_candidates = content.get("batch_candidates", False)
+        if not self.heartbeat_task:
+            self.heartbeat_task = asyncio.create_task(self.keep_alive())
+        events = None
+        if session.previous_channel not in ("", self.channel_name):
+            events = await self.resume_events(content, session)
+            if events is None:
+                # 이어받지 못한 재접속. 다른 참가자들이 이전 연결을 정리하고 새로 연결하도록 알림
+                await self.broadcast(
+                    dict(
+                        type="send_to_others",
+                        data=dict(type="userdisconnected", sender=self.user_id),
+                    )
+                )
+        await self.send_authentication_success(
+            True,
+            session.participants,
+            resume_token=self.service.resume_token(session.room, self.user_id),
+            seq=session.seq,
+            resumed=events is not None,
         )
+        # 끊겨있는 동안 놓친 이벤트를 순서대로 다시 보냄
+        for seq, message in events or []:
+            message["data"] = dict(message["data"], seq=seq)
+            await getattr(self, get_handler_name(message))(message)
+
+    async def resume_events(self, content: Authentication, session: Session):
+        if "last_seq" not in content or not self.service.check_resume_token(
+            session.room, content["user_id"], content.get("resume_token", "")
+        ):
+            return None
+        return await self.service.events_after(content["last_seq"], session.seq)
 
-    async def send_authentication_success(self, result: bool, data: dict):
-        await self.send_json(dict(type="authentication", result=result, data=data))
+    async def keep_alive(self):
+        # 접속해 있는 동안 lease를 연장함. 연장하지 못하면 reap_ghost_participants가 정리함
+        while True:
+            await asyncio.sleep(settings.ROOM_HEARTBEAT_INTERVAL)
+            try:
+                alive = await self.service.heartbeat(self.user_id, self.channel_name)
+            except RedisError:
+                continue
+            if not alive:
+                # 이미 정리되었거나 다른 연결로 재접속함. 클라이언트가 다시 참가하도록 끊음
+                self.heartbeat_task = None
+                return await self.close()
+            # resume_token은 유효기간이 있으므로 접속해 있는 동안 새로 발급함
+            await self.send_json(
+                dict(
+                    type="resume_token",
+                    resume_token=self.service.resume_token(self.room, self.user_id),
+                )
+            )
 
+    async def send_authentication_success(self, result: bool, data, **extra):
+        await self.send_json(
+            dict(type="authentication", result=result, data=data, **extra)
+        )
+
+    @router.route(NotifyParticipant)
     async def handle_notify_participant(self, content: NotifyParticipant):
         if not self.user_id:
             return
-        await self.channel_layer.group_send(
-            self.group_name, dict(type="send_to_others", data=content)
+        await self.broadcast(dict(type="send_to_others", data=content))
+
+    async def broadcast(self, message: dict):
+        # 순번을 붙여 이벤트 로그에 남기고 보냄. 재접속한 참가자는 놓친 이벤트를 로그에서 받음
+        if seq := await self.service.log_event(message):
+            message = dict(message, data=dict(message["data"], seq=seq))
+        # 방의 모든 참가자가 이 워커에 있으면 redis를 거치지 않고 각 채널로 바로 보냄
+        channels = await self.service.get_channels()
+        group_send_fanout.observe(len(channels), self.metrics_name)
+        if self.all_local(channels):
+            # 캐시된 목록에는 다른 워커에서 방금 참가한 사람이 빠져있을 수 있으므로 버전을 확인함
+            channels = await self.service.get_fresh_channels()
+            if self.all_local(channels):
+                for channel in channels:
+                    # group_send처럼 가득 찬 채널은 건너뜀
+                    self.channel_layer.send_local(channel, message)
+                return
+        await self.channel_layer.group_send(self.group_name, message)
+
+    def all_local(self, channels: list[str]):
+        return bool(channels) and all(
+            is_local_channel(self.channel_layer, channel) for channel in channels
         )
 
+    async def send_to_peer(self, receiver: str, message: dict):
+        # 받는 사람의 채널로만 보냄. 같은 워커의 채널이면 레이어에서 redis를 거치지 않음
+        # 받는 쪽 큐가 가득 찼으면 group_send처럼 버리고 보내는 쪽 연결은 유지함
+        if channel_name := await self.service.get_channel(receiver):
+            await send_or_drop(self.channel_layer, channel_name, message)
+        elif await self.service.is_participant(receiver):
+            # 재접속을 기다리는 참가자. 로그에 남겨두면 이어받을때 받음
+            await self.service.log_event(message)
+        else:
+            # 방에 없는 참가자. 방 전체로 보내지 않고 버림
+            logger.debug("dropped %s to unknown receiver %s", message["type"], receiver)
+
+    @router.route(SendSDP)
     async def handle_send_sdp(self, content: SendSDP):
         if not self.user_id:
             return
-        await self.channel_layer.group_send(
-            self.group_name, dict(type="send_sdp", data=content)
+        # 먼저 모아둔 candidate를 보내서 순서를 지킴
+        await self.flush_candidates(content["receiver"])
+        await self.send_to_peer(
+            content["receiver"], dict(type="send_sdp", data=content)
         )
 
-    async def handle_send_candidate(self, content: SendCandidate):
+    @router.route(SendCandidate)
+    @router.route(SendCandidates)
+    async def handle_send_candidate(self, content: SendCandidate | SendCandidates):
         if not self.user_id:
             return
-        await self.channel_layer.group_send(
-            self.group_name, dict(type="send_sdp", data=content)
+        receiver = content["receiver"]
+        buffer = self.candidate_buffers.setdefault(receiver, [])
+        if content["type"] == "candidates":
+            buffer.extend(content["candidates"])
+        else:
+            buffer.append(content["candidate"])
+        if (
+            settings.ROOM_CANDIDATE_FLUSH_WINDOW <= 0
+            or settings.ROOM_CANDIDATE_MAX_BATCH <= len(buffer)
+        ):
+            return await self.flush_candidates(receiver)
+        if receiver not in self.candidate_flushers:
+            self.candidate_flushers[receiver] = asyncio.create_task(
+                self.flush_candidates_later(receiver)
+            )
+
+    async def flush_candidates_later(self, receiver: str):
+        await asyncio.sleep(settings.ROOM_CANDIDATE_FLUSH_WINDOW)
+        self.candidate_flushers.pop(receiver, None)
+        await self.flush_candidates(receiver)
+
+    async def flush_candidates(self, receiver: str):
+        if flusher := self.candidate_flushers.pop(receiver, None):
+            flusher.cancel()
+        if not (candidates := self.candidate_buffers.pop(receiver, None)):
+            return
+        data = SendCandidates(
+            type="candidates",
+            sender=self.user_id or "",
+            receiver=receiver,
+            candidates=candidates,
         )
+        await self.send_to_peer(receiver, dict(type="send_sdp", data=data))
 
+    @router.route(StreamStatus)
     async def handle_stream_status(self, content: StreamStatus):
         if not self.user_id:
             return
-        await self.channel_layer.group_send(
-            self.group_name, dict(type="send_to_others", data=content)
-        )
+        # 방 참가자 목록에 저장해서 새로 들어온 사람은 authentication 응답으로 받음
+        # 빠르게 여러번 바뀌면 마지막 값만 저장하고 알림
+        self.pending_status[content["media"]] = content["status"]
+        if settings.ROOM_STREAM_STATUS_DEBOUNCE <= 0:
+            return await self.flush_stream_status()
+        if not self.status_flusher:
+            self.status_flusher = asyncio.create_task(self.flush_stream_status_later())
+
+    async def flush_stream_status_later(self):
+        await asyncio.sleep(settings.ROOM_STREAM_STATUS_DEBOUNCE)
+        self.status_flusher = None
+        await self.flush_stream_status()
 
-    async def receive_json(
-        self,
-        content: (
-            Authentication | NotifyParticipant | SendSDP | SendCandidate | StreamStatus
-        ),
-        **kwargs,
-    ):
-        print(content["type"])
-        if content["type"] == "authentication":
-            await self.handle_authentication(content)
-        elif content["type"] == "notifyparticipant":
-            await self.handle_notify_participant(content)
-        elif content["type"] == "sendsdp" or content["type"] == "answersdp":
-            await self.handle_send_sdp(content)
-        elif content["type"] == "sendcandidate":
-            await self.handle_send_candidate(content)
-        elif content["type"] == "streamstatus":
-            await self.handle_stream_status(content)
+    async def flush_stream_status(self):
+        pending, self.pending_status = self.pending_status, {}
+        for media, status in pending.items():
+            if not await self.service.set_media(self.user_id, media, status):
+                continue
+            data = StreamStatus(
+                type="streamstatus", sender=self.user_id, media=media, status=status
+            )
+            await self.broadcast(dict(type="send_to_others", data=data))
+
+    async def receive_json(self, content, **kwargs):
+        # type별로 등록된 핸들러로 검증 후 전달함. 모르는 type은 버림
+        await router.dispatch(self, content, **kwargs)
 
     async def emit(self, data):
         await self.send_json(data["data"])
@@ -163,6 +360,18 @@ class RoomConsumer(AsyncJsonWebsocketConsumer):
         receiver_id = d["receiver"]
         if self.user_id != receiver_id:
             return
+        if d["type"] == "candidates" and not self.batch_candidates:
+            # 이전 클라이언트에는 candidate를 하나씩 풀어서 보냄
+            for candidate in d["candidates"]:
+                await self.send_json(
+                    dict(
+                        type="sendcandidate",
+                        sender=d["sender"],
+                        receiver=receiver_id,
+                        candidate=candidate,
+                    )
+                )
+            return
         await self.send_json(d)
 
     async def send_to_others(self, data: dict):
@@ -0,0 +1,102 @@
+import json
+import time
+from typing import Callable
+
+from django.core.management.base import BaseCommand
+
+from rooms.services import BaseRoomService, Participant, Room
+from rooms.stores import RoomState
+
+
+def make_state(size: int, encode: Callable[[Participant], bytes | str]):
+    participants = {}
+    for i in range(size):
+        participant = Participant(
+            user_id=str(i), username=f"user-{i}", audio_on=i % 2 == 0, video_on=True
+        )
+        participants[participant.user_id] = encode(participant)
+    meta = dict(password="", room_id="benchmark", owner="0")
+    return RoomState(1, meta, participants, {})
+
+
+def pydantic_encode(participant: Participant):
+    return participant.model_dump_json()
+
+
+def pydantic_decode(state: RoomState):
+    # 이전 방식: 참가자마다 json 검증 후 Room을 다시 검증하고 model_dump로 응답을 만듦
+    room = Room(
+        password=state.meta["password"],
+        room_id=state.meta["room_id"],
+        owner=state.meta["owner"],
+        participants=[
+            Participant.model_validate_json(p) for p in state.participants.values()
+        ],
+    )
+    return room.model_dump()["participants"]
+
+
+def msgpack_decode(state: RoomState):
+    participants = BaseRoomService.to_participants(state.participants)
+    BaseRoomService.to_room(state, participants)
+    return participants
+
+
+CODECS = {
+    "pydantic": (pydantic_encode, pydantic_decode),
+    "msgpack": (BaseRoomService.encode_participant, msgpack_decode),
+}
+
+
+def measure(func: Callable, iterations: int):
+    started = time.perf_counter()
+    for _ in range(iterations):
+        func()
+    return (time.perf_counter() - started) / iterations * 1e6
+
+
+class Command(BaseCommand):
+    help = (
+        "방 참가자 목록을 저장 형식으로 인코딩하고, 읽어서 클라이언트 응답으로 만드는 "
+        "비용을 참가자 수별로 비교함"
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--sizes", type=str, default="2,8,32,128")
+        parser.add_argument("--iterations", type=int, default=2000)
+        parser.add_argument("--output", type=str, default=None)
+
+    def handle(self, *args, **options):
+        iterations = options["iterations"]
+        results = []
+        for size in [int(size) for size in options["sizes"].split(",")]:
+            for name, (encode, decode) in CODECS.items():
+                state = make_state(size, encode)
+                participants = [
+                    Participant(
+                        user_id=str(i),
+                        username=f"user-{i}",
+                        audio_on=True,
+                        video_on=True,
+                    )
+                    for i in range(size)
+                ]
+                result = dict(
+                    codec=name,
+                    participants=size,
+                    encode_us=round(
+                        measure(lambda: [encode(p) for p in participants], iterations),
+                        2,
+                    ),
+                    decode_us=round(measure(lambda: decode(state), iterations), 2),
+                    stored_bytes=sum(len(v) for v in state.participants.values()),
+                )
+                results.append(result)
+                self.stdout.write(
+                    f"[{name}] {size} participants: encode {result['encode_us']}us, "
+                    f"decode {result['decode_us']}us, {result['stored_bytes']} bytes"
+                )
+        if output := options["output"]:
+            with open(output, "w") as f:
+                json.dump(dict(iterations=iterations, results=results), f, indent=2)
+            self.stdout.write(self.style.SUCCESS(f"saved {output}"))
@@ -0,0 +1,418 @@
+import asyncio
+import contextlib
+import json
+import subprocess
+import time
+import uuid
+from collections import Counter
+from datetime import datetime, timezone
+
+import msgpack
+import redis
+import redis.asyncio
+from channels.routing import URLRouter
+from channels.testing import WebsocketCommunicator
+from channels_redis.core import RedisChannelLayer
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.test import override_settings
+from django.utils.module_loading import import_string
+
+from commons.consumers import MSGPACK_SUBPROTOCOL
+
+MEMORY_LAYER = {"BACKEND": "channels.layers.InMemoryChannelLayer"}
+# 모든 채널을 redis로 보내는 기본 레이어와 같은 프로세스 안에서는 바로 전달하는 레이어
+REDIS_LAYERS = {
+    "redis": "channels_redis.core.RedisChannelLayer",
+    "affinity": "commons.layers.AffinityChannelLayer",
+}
+
+
+def percentile(values: list[float], q: float):
+    if not values:
+        return None
+    values = sorted(values)
+    index = min(len(values) - 1, max(0, round(q / 100 * len(values)) - 1))
+    return values[index]
+
+
+def summarize(values: list[float]):
+    # 초 단위로 모아서 ms로 보고함
+    return {
+        "count": len(values),
+        "p50_ms": ms(percentile(values, 50)),
+        "p95_ms": ms(percentile(values, 95)),
+        "p99_ms": ms(percentile(values, 99)),
+        "max_ms": ms(max(values, default=None)),
+    }
+
+
+def ms(value: float | None):
+    return None if value is None else round(value * 1000, 3)
+
+
+class RoundTripCounter:
+    """
+    redis 클라이언트의 명령 실행을 세어서 단계별 round-trip 수를 구함
+    pipeline은 한번의 round-trip으로 셈
+    """
+
+    targets = [
+        (redis.Redis, "execute_command"),
+        (redis.client.Pipeline, "execute"),
+        (redis.asyncio.Redis, "execute_command"),
+        (redis.asyncio.client.Pipeline, "execute"),
+    ]
+
+    def __init__(self):
+        self.counts = Counter[str]()
+        self.phase = "setup"
+
+    def wrap(self, func):
+        counter = self
+
+        if asyncio.iscoroutinefunction(func):
+
+            async def async_wrapper(*args, **kwargs):
+                counter.counts[counter.phase] += 1
+                return await func(*args, **kwargs)
+
+            return async_wrapper
+
+        def wrapper(*args, **kwargs):
+            counter.counts[counter.phase] += 1
+            return func(*args, **kwargs)
+
+        return wrapper
+
+    @contextlib.contextmanager
+    def patch(self):
+        originals = [(cls, name, cls.__dict__[name]) for cls, name in self.targets]
+        for cls, name, func in originals:
+            setattr(cls, name, self.wrap(func))
+        try:
+            yield self
+        finally:
+            for cls, name, func in originals:
+                setattr(cls, name, func)
+
+
+class Peer:
+    def __init__(self, app, room_id: str, user_id: str, binary: bool, batch: bool):
+        self.room_id = room_id
+        self.user_id = user_id
+        self.binary = binary
+        self.batch = batch
+        self.communicator = WebsocketCommunicator(
+            app,
+            f"/ws/rooms/{room_id}/",
+            subprotocols=[MSGPACK_SUBPROTOCOL] if binary else None,
+        )
+        self.latencies: list[float] = []
+        self.frames = 0
+
+    async def send(self, content: dict):
+        if self.binary:
+            return await self.communicator.send_to(bytes_data=msgpack.packb(content))
+        return await self.communicator.send_json_to(content)
+
+    async def receive(self, timeout: float) -> dict:
+        frame = await self.communicator.receive_from(timeout)
+        self.frames += 1
+        if isinstance(frame, bytes):
+            return msgpack.unpackb(frame)
+        return json.loads(frame)
+
+    async def join(self, timeout: float):
+        started = time.perf_counter()
+        connected, _ = await self.communicator.connect(timeout)
+        if not connected:
+            raise CommandError(f"connection refused: {self.room_id}/{self.user_id}")
+        await self.send(
+            dict(
+                type="authentication",
+                password="",
+                user_id=self.user_id,
+                username=f"bench-{self.user_id}",
+                batch_candidates=self.batch,
+            )
+        )
+        response = await self.receive(timeout)
+        if response.get("type") != "authentication" or not response.get("result"):
+            raise CommandError(f"authentication failed: {response}")
+        return time.perf_counter() - started
+
+    async def expect(self, types: set[str], count: int, timeout: float):
+        # sdp는 1개, candidates 프레임은 안에 든 candidate 수만큼 셈
+        received = 0
+        while received < count:
+            content = await self.receive(timeout)
+            now = time.perf_counter()
+            if content["type"] not in types:
+                continue
+            if content["type"] == "candidates":
+                items = content["candidates"]
+            elif content["type"] == "sendcandidate":
+                items = [content["candidate"]]
+            else:
+                items = [dict(sent_at=float(content["sdp"].split(":", 1)[1]))]
+            for item in items:
+                self.latencies.append(now - item["sent_at"])
+            received += len(items)
+
+    async def leave(self):
+        await self.communicator.disconnect()
+
+
+class Command(BaseCommand):
+    help = (
+        "RoomConsumer에 R개 방 x N명을 붙여서 참가, offer/answer, candidate 교환, 퇴장을 "
+        "돌리고 처리량/지연시간/redis round-trip을 JSON으로 저장함"
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--rooms", type=int, default=10)
+        parser.add_argument("--participants", type=int, default=4)
+        parser.add_argument(
+            "--candidates", type=int, default=8, help="peer 연결당 보내는 candidate 수"
+        )
+        parser.add_argument(
+            "--layer", choices=["memory", *REDIS_LAYERS, "all"], default="all"
+        )
+        parser.add_argument("--msgpack", action="store_true")
+        parser.add_argument(
+            "--no-batch",
+            action="store_true",
+            help="candidates 프레임을 받지 못하는 이전 클라이언트로 접속",
+        )
+        parser.add_argument("--timeout", type=float, default=10)
+        parser.add_argument("--output", type=str, default=None)
+
+    def handle(self, *args, **options):
+        commit = self.get_commit()
+        results = []
+        for name, layer in self.get_layers(options["layer"]):
+            self.stdout.write(f"running {name} layer...")
+            result = asyncio.run(self.run(layer, options))
+            results.append(dict(layer=name, **result))
+            self.report(name, result)
+        output = options["output"] or f"signaling-benchmark-{commit or 'local'}.json"
+        with open(output, "w") as f:
+            json.dump(
+                dict(
+                    commit=commit,
+                    created_at=datetime.now(timezone.utc).isoformat(),
+                    options={
+                        key: options[key]
+                        for key in [
+                            "rooms",
+                            "participants",
+                            "candidates",
+                            "msgpack",
+                            "no_batch",
+                        ]
+                    },
+                    settings=dict(
+                        ROOM_CANDIDATE_FLUSH_WINDOW=settings.ROOM_CANDIDATE_FLUSH_WINDOW,
+                        ROOM_CANDIDATE_MAX_BATCH=settings.ROOM_CANDIDATE_MAX_BATCH,
+                    ),
+                    results=results,
+                ),
+                f,
+                indent=2,
+            )
+        self.stdout.write(self.style.SUCCESS(f"saved {output}"))
+
+    @staticmethod
+    def get_commit():
+        try:
+            return subprocess.run(
+                ["git", "rev-parse", "--short", "HEAD"],
+                capture_output=True,
+                text=True,
+                check=True,
+            ).stdout.strip()
+        except (OSError, subprocess.CalledProcessError):
+            return None
+
+    def get_layers(self, layer: str):
+        if layer in ("memory", "all"):
+            yield "memory", MEMORY_LAYER
+        names = [name for name in REDIS_LAYERS if layer in (name, "all")]
+        if not names:
+            return
+        default = settings.CHANNEL_LAYERS.get("default", {})
+        backend = import_string(default.get("BACKEND", MEMORY_LAYER["BACKEND"]))
+        if not issubclass(backend, RedisChannelLayer):
+            if layer != "all":
+                raise CommandError("CHANNEL_LAYERS default is not a redis layer")
+            return
+        # 운영중인 메세지와 섞이지 않도록 별도 prefix를 씀
+        config = dict(default.get("CONFIG", {}), prefix="asgi-benchmark")
+        for name in names:
+            redis_layer = dict(BACKEND=REDIS_LAYERS[name], CONFIG=config)
+            if asyncio.run(self.is_available(redis_layer)):
+                yield name, redis_layer
+            elif layer != "all":
+                raise CommandError("redis channel layer is not reachable")
+            else:
+                self.stdout.write(self.style.WARNING(f"{name} layer skipped"))
+
+    @staticmethod
+    async def is_available(layer: dict):
+        backend = import_string(layer["BACKEND"])(**layer.get("CONFIG", {}))
+        try:
+            await asyncio.wait_for(
+                backend.group_discard("benchmark", "benchmark.probe"), 2
+            )
+            return True
+        except (OSError, asyncio.TimeoutError, redis.RedisError):
+            return False
+
+    async def run(self, layer: dict, options: dict):
+        from rooms import routings
+
+        app = URLRouter(routings.websocket_urlpatterns)
+        timeout = options["timeout"]
+        run_id = uuid.uuid4().hex[:8]
+        rooms = [
+            [
+                Peer(
+                    app,
+                    f"benchmark_{run_id}_{r}",
+                    str(p),
+                    options["msgpack"],
+                    not options["no_batch"],
+                )
+                for p in range(options["participants"])
+            ]
+            for r in range(options["rooms"])
+        ]
+        peers = [peer for room in rooms for peer in room]
+        counter = RoundTripCounter()
+        elapsed = {}
+
+        async def phase(name: str, coros):
+            counter.phase = name
+            started = time.perf_counter()
+            result = await asyncio.gather(*coros)
+            elapsed[name] = time.perf_counter() - started
+            return result
+
+        # 퇴장 단계에서 재접속을 기다리지 않고 바로 정리되도록 함
+        with override_settings(
+            CHANNEL_LAYERS={"default": layer}, ROOM_RESUME_GRACE=0
+        ), counter.patch():
+            joins = await phase("join", [self.join(room, timeout) for room in rooms])
+            await phase("sdp", [self.negotiate(room, timeout) for room in rooms])
+            await phase(
+                "candidates",
+                [self.trickle(room, options["candidates"], timeout) for room in rooms],
+            )
+            await phase("leave", [peer.leave() for peer in peers])
+
+        n = options["participants"]
+        sdp_messages = len(rooms) * n * (n - 1)
+        candidate_messages = sdp_messages * options["candidates"]
+        join_latencies = [latency for room in joins for latency in room]
+        signaling = [latency for peer in peers for latency in peer.latencies]
+        signaling_elapsed = elapsed["sdp"] + elapsed["candidates"]
+        return dict(
+            participants=len(peers),
+            messages=sdp_messages + candidate_messages,
+            frames=sum(peer.frames for peer in peers),
+            elapsed_s={key: round(value, 4) for key, value in elapsed.items()},
+            messages_per_sec=(
+                round((sdp_messages + candidate_messages) / signaling_elapsed, 1)
+                if signaling_elapsed
+                else None
+            ),
+            join_latency=summarize(join_latencies),
+            delivery_latency=summarize(signaling),
+            redis_round_trips=dict(counter.counts),
+            redis_round_trips_per_join=(
+                round(counter.counts["join"] / len(peers), 2) if peers else None
+            ),
+        )
+
+    @staticmethod
+    async def join(room: list[Peer], timeout: float):
+        # 같은 방은 순서대로 들어가고 방끼리는 동시에 진행함
+        return [await peer.join(timeout) for peer in room]
+
+    @staticmethod
+    async def negotiate(room: list[Peer], timeout: float):
+        # 모든 쌍이 offer를 보내고 answer를 받음. 각자 n-1개의 sdp를 받게 됨
+        async def offer(peer: Peer, others: list[Peer]):
+            for other in others:
+                await peer.send(
+                    dict(
+                        type="sendsdp",
+                        sender=peer.user_id,
+                        receiver=other.user_id,
+                        sdp=f"offer:{time.perf_counter()}",
+                    )
+                )
+
+        async def answer(peer: Peer, others: list[Peer]):
+            for other in others:
+                await peer.send(
+                    dict(
+                        type="answersdp",
+                        sender=peer.user_id,
+                        receiver=other.user_id,
+                        sdp=f"answer:{time.perf_counter()}",
+                    )
+                )
+
+        await asyncio.gather(
+            *[offer(peer, room[i + 1 :]) for i, peer in enumerate(room)],
+            *[peer.expect({"sendsdp"}, i, timeout) for i, peer in enumerate(room)],
+        )
+        await asyncio.gather(
+            *[answer(peer, room[:i]) for i, peer in enumerate(room)],
+            *[
+                peer.expect({"answersdp"}, len(room) - i - 1, timeout)
+                for i, peer in enumerate(room)
+            ],
+        )
+
+    @staticmethod
+    async def trickle(room: list[Peer], candidates: int, timeout: float):
+        async def send(peer: Peer):
+            for index in range(candidates):
+                for other in room:
+                    if other is peer:
+                        continue
+                    await peer.send(
+                        dict(
+                            type="sendcandidate",
+                            sender=peer.user_id,
+                            receiver=other.user_id,
+                            candidate=dict(
+                                candidate=f"candidate:{index}",
+                                sent_at=time.perf_counter(),
+                            ),
+                        )
+                    )
+
+        count = candidates * (len(room) - 1)
+        await asyncio.gather(
+            *[send(peer) for peer in room],
+            *[
+                peer.expect({"candidates", "sendcandidate"}, count, timeout)
+                for peer in room
+            ],
+        )
+
+    def report(self, name: str, result: dict):
+        latency = result["delivery_latency"]
+        join = result["join_latency"]
+        self.stdout.write(
+            f"[{name}] {result['messages']} messages, "
+            f"{result['messages_per_sec']} msgs/sec, "
+            f"delivery p50/p95/p99 {latency['p50_ms']}/{latency['p95_ms']}/"
+            f"{latency['p99_ms']} ms, "
+            f"join p50/p95 {join['p50_ms']}/{join['p95_ms']} ms, "
+            f"redis round-trips/join {result['redis_round_trips_per_join']}"
+        )
@@ -1,11 +1,16 @@
-from typing import Concatenate
+import json
+import time
+from typing import NamedTuple
 from uuid import uuid4
+import msgpack
 from pydantic import BaseModel, computed_field
 
-from django.core.cache import cache
+from django.conf import settings
+from django.core import signing
 from rest_framework import exceptions
 
-from commons.lock import with_lock
+from .caches import RosterEntry, roster_cache
+from .stores import ROOM_INDEXES, RoomState, RoomStore, AsyncRoomStore
 
 
 class Participant(BaseModel):
@@ -27,59 +32,435 @@ class Room(BaseModel):
         return bool(self.password)
 
 
-class RoomService:
+class RoomListing(BaseModel):
+    name: str
+    participant_count: int
+    last_activity: float
+    has_password: bool
+
+
+class Session(NamedTuple):
+    room: Room
+    # 클라이언트로 보낼 참가자 목록. 워커 캐시와 공유하므로 수정하지 않음
+    participants: list[dict]
+    # 참가 시점의 이벤트 순번
+    seq: int
+    # 이미 다른 채널로 참가중이었거나 끊겨서 재접속을 기다리던 채널
+    previous_channel: str
+
+
+class BaseRoomService:
     Participant = Participant
     Room = Room
+    store: RoomStore | AsyncRoomStore
+
+    key_prefix = "v3:rooms:"
 
     def __init__(self, room_name: str):
         self.room_name = room_name
-        self.room_key = f"v3:rooms:{self.room_name}"
+        self.room_key = f"{self.key_prefix}{self.room_name}"
 
-    def authenticate(self, password: str):
-        if room := self.get_room_info():
-            if room.password and room.password != password:
-                return False
-            return room
-        return "empty"
-
-    @with_lock["Concatenate[RoomService,str,str,...]", Room](
-        lambda self, user, password: self.room_key
-    )
-    def create_room(self, user_id: str, password: str):
-        if not (authenticate := self.authenticate(password)):
-            raise exceptions.ValidationError(
-                dict(password=["패스워드가 일치하지 않습니다."])
+    @staticmethod
+    def lease_until():
+        return time.time() + settings.ROOM_PARTICIPANT_LEASE
+
+    # 참가자는 [user_id, username, audio_on, video_on] 고정 배열을 MessagePack으로 저장함
+    # 읽을때는 dict로 풀어서 그대로 클라이언트 응답에 쓰고, Room은 그 dict들로 만듦
+    participant_fields = ("user_id", "username", "audio_on", "video_on")
+
+    @staticmethod
+    def encode_participant(participant: Participant) -> bytes:
+        return msgpack.packb(
+            [
+                participant.user_id,
+                participant.username,
+                participant.audio_on,
+                participant.video_on,
+            ]
+        )
+
+    @classmethod
+    def decode_participant(cls, value: bytes) -> dict:
+        if value[:1] == b"{":
+            # 이전 버전에서 json으로 저장한 참가자
+            return json.loads(value)
+        return dict(zip(cls.participant_fields, msgpack.unpackb(value)))
+
+    @classmethod
+    def to_participants(cls, participants: dict[str, bytes]):
+        return [cls.decode_participant(p) for p in participants.values()]
+
+    @staticmethod
+    def to_room(state: RoomState, participants: list[dict]):
+        # 참가자마다 Participant(...)를 만들지 않고 model_validate 한번으로 만듦
+        # 참가자도 모두 검증되므로 검증 비용 자체는 참가자 수에 비례함
+        return Room.model_validate(
+            dict(
+                password=state.meta["password"],
+                room_id=state.meta["room_id"],
+                owner=state.meta["owner"],
+                participants=participants,
             )
-        if isinstance(authenticate, Room):
-            return authenticate
+        )
+
+    def remember(self, state: RoomState | None):
+        """저장소에서 읽거나 스크립트가 돌려준 최신 상태를 워커 캐시에 넣음"""
+        if not state:
+            roster_cache.delete(self.store.meta_key)
+            return None
+        participants = self.to_participants(state.participants)
+        entry = RosterEntry(
+            state.version,
+            self.to_room(state, participants),
+            state.channels,
+            participants,
+        )
+        return roster_cache.put(self.store.meta_key, entry)
+
+    def cached(self):
+        return roster_cache.get(self.store.meta_key)
 
-        room = Room(password=password, owner=user_id, room_id=str(uuid4()))
-        cache.set(self.room_key, room.model_dump(), timeout=None)
+    def forget(self, version: int):
+        """직접 쓴 변경은 pub/sub를 기다리지 않고 이 워커의 캐시에서 바로 지움"""
+        if version:
+            roster_cache.on_invalidate(f"{self.store.meta_key} {version}")
+
+    @staticmethod
+    def resume_token(room: Room, user_id: str):
+        # 방이 다시 만들어지면 room_id가 바뀌므로 이전 방의 토큰으로는 이어받을 수 없음
+        # 발급 시각이 같이 서명되고, 접속해 있는 동안은 heartbeat마다 새로 발급함
+        return signing.dumps([room.room_id, user_id], salt="rooms.resume")
+
+    @staticmethod
+    def check_resume_token(room: Room, user_id: str, token: str):
+        # 마지막 heartbeat 뒤에 끊기고 grace 기간 안에 돌아온 경우만 받음
+        max_age = settings.ROOM_PARTICIPANT_LEASE + settings.ROOM_RESUME_GRACE
+        try:
+            value = signing.loads(token, salt="rooms.resume", max_age=max_age)
+        except signing.BadSignature:
+            return False
+        return value == [room.room_id, user_id]
+
+    @staticmethod
+    def media_field(media: str):
+        return dict(audio="audio_on", video="video_on")[media]
+
+    @staticmethod
+    def check_password(room: Room | None, password: str):
+        if not room:
+            return "empty"
+        if room.password and room.password != password:
+            return False
         return room
 
+    @staticmethod
+    def password_not_matched():
+        return exceptions.ValidationError(
+            dict(password=["패스워드가 일치하지 않습니다."])
+        )
+
+
+class RoomService(BaseRoomService):
+    def __init__(self, room_name: str):
+        super().__init__(room_name)
+        self.store = RoomStore(self.room_key)
+
+    def get_entry(self):
+        return self.cached() or self.remember(self.store.get())
+
+    def authenticate(self, password: str):
+        return self.check_password(self.get_room_info() or None, password)
+
+    @classmethod
+    def active_rooms(cls):
+        for room_key in RoomStore.active_room_keys():
+            yield cls(room_key.removeprefix(cls.key_prefix))
+
+    def create_room(self, user_id: str, password: str):
+        state = self.store.join(
+            user_id, password, str(uuid4()), lease_until=self.lease_until()
+        )
+        if not state:
+            raise self.password_not_matched()
+        return self.remember(state).room
+
+    def join(self, participant: Participant, password: str, channel_name: str = ""):
+        """방이 없으면 만들고 참가자와 채널을 등록함. 패스워드가 틀리면 False"""
+        state = self.store.join(
+            participant.user_id,
+            password,
+            str(uuid4()),
+            participant=self.encode_participant(participant),
+            channel_name=channel_name,
+            lease_until=self.lease_until(),
+        )
+        if not state:
+            return False
+        return self.remember(state).room
+
     def get_room_info(self):
-        if room := cache.get(self.room_key, None):
-            return Room(**room)
+        if entry := self.get_entry():
+            return entry.room
         return False
 
     def drop_room(self):
-        return cache.delete(self.room_key)
+        result = self.store.drop()
+        self.remember(None)
+        return result
 
     def add_participant(self, participant: Participant):
-        if not (room := self.get_room_info()):
-            raise
-        if not next(
-            filter(lambda x: x.user_id == participant.user_id, room.participants), None
+        state = self.store.join(
+            participant.user_id,
+            "",
+            "",
+            create=False,
+            participant=self.encode_participant(participant),
+            lease_until=self.lease_until(),
+        )
+        if not state:
+            raise exceptions.NotFound
+        return self.remember(state).room
+
+    def remove_participant(self, user_id: str, channel_name: str = ""):
+        """
+        channel_name이 주어지면 그 채널로 접속한 참가자일때만 내보냄
+        마지막 참가자가 나가면 방도 삭제됨
+        """
+        left, state = self.store.leave(user_id, channel_name)
+        if entry := self.remember(state):
+            return left, entry.room.participants
+        return left, []
+
+    # user_id -> channel_name 디렉토리. sdp/candidate를 받는 사람에게만 보내기 위해 사용
+    def set_channel(self, user_id: str, channel_name: str):
+        self.forget(self.store.set_channel(user_id, channel_name))
+
+    def get_channel(self, user_id: str) -> str | None:
+        if (entry := self.get_entry()) and (channel := entry.channels.get(user_id)):
+            return channel
+        # 다른 워커에서 방금 참가해서 캐시에 아직 없을 수 있음
+        return self.store.get_channel(user_id)
+
+    def get_channels(self) -> list[str]:
+        if entry := self.get_entry():
+            return list(entry.channels.values())
+        return []
+
+    def remove_channel(self, user_id: str, channel_name: str):
+        # 재접속으로 이미 다른 채널이 등록되었다면 지우지 않음
+        self.forget(self.store.remove_channel(user_id, channel_name))
+
+    def set_media(self, user_id: str, media: str, status: bool):
+        """참가자의 audio/video 상태를 저장함. 실제로 바뀌었을때만 True"""
+        version = self.store.set_media(user_id, self.media_field(media), status)
+        self.forget(version)
+        return bool(version)
+
+    def heartbeat(self, user_id: str, channel_name: str):
+        """lease를 연장함. 이미 정리되었거나 다른 연결로 재접속했다면 False"""
+        return self.store.heartbeat(user_id, channel_name, self.lease_until())
+
+    def reap(self):
+        """lease가 만료된 참가자를 내보냄. 내보낸 user_id -> channel_name과 남은 참가자"""
+        removed, state = self.store.reap(time.time())
+        if not removed:
+            return removed, []
+        if entry := self.remember(state):
+            return removed, entry.room.participants
+        return removed, []
+
+    def log_event(self, message: dict) -> int:
+        """채널 레이어 메세지를 이벤트 로그에 남기고 순번을 돌려줌. 방이 없으면 0"""
+        if settings.ROOM_EVENT_LOG_SIZE <= 0:
+            return 0
+        return self.store.log_event(
+            msgpack.packb(message), settings.ROOM_EVENT_LOG_SIZE
+        )
+
+
+class RoomDirectory:
+    """
+    참가자 수(size)나 마지막 참가/퇴장 시각(recent)으로 정렬된 활성 방 인덱스
+    ROOM_DIRECTORY_INCLUDE_PROTECTED가 꺼져있으면 패스워드가 없는 방만 보여줌
+    DRF 페이지네이션이 queryset처럼 count()와 슬라이스로 한 페이지만 읽어감
+    """
+
+    orderings = tuple(ROOM_INDEXES)
+
+    def __init__(self, ordering: str = "recent"):
+        if ordering not in ROOM_INDEXES:
+            raise ValueError(ordering)
+        self.ordering = ordering
+        # 패스워드가 걸린 방은 설정으로 켰을때만 보여줌
+        self.protected = settings.ROOM_DIRECTORY_INCLUDE_PROTECTED
+
+    def count(self):
+        return RoomStore.count_indexed(self.protected)
+
+    def __getitem__(self, index: slice):
+        start = index.start or 0
+        entries = RoomStore.list_indexed(
+            self.ordering, start, index.stop, self.protected
+        )
+        return [
+            RoomListing(
+                name=entry.room_key.removeprefix(RoomService.key_prefix),
+                participant_count=entry.participant_count,
+                last_activity=entry.last_activity,
+                has_password=entry.has_password,
+            )
+            for entry in entries
+        ]
+
+
+class AsyncRoomService(BaseRoomService):
+    """
+    RoomService의 asyncio 버전. 컨슈머에서 sync_to_async로 스레드풀을 거치지 않고
+    공유 커넥션풀의 asyncio redis 클라이언트로 바로 호출함
+    """
+
+    def __init__(self, room_name: str):
+        super().__init__(room_name)
+        self.store = AsyncRoomStore(self.room_key)
+
+    async def get_entry(self):
+        return self.cached() or self.remember(await self.store.get())
+
+    async def authenticate(self, password: str):
+        return self.check_password(await self.get_room_info() or None, password)
+
+    async def create_room(self, user_id: str, password: str):
+        state = await self.store.join(
+            user_id, password, str(uuid4()), lease_until=self.lease_until()
+        )
+        if not state:
+            raise self.password_not_matched()
+        return self.remember(state).room
+
+    async def join(
+        self, participant: Participant, password: str, channel_name: str = ""
+    ):
+        state = await self.store.join(
+            participant.user_id,
+            password,
+            str(uuid4()),
+            participant=self.encode_participant(participant),
+            channel_name=channel_name,
+            lease_until=self.lease_until(),
+        )
+        if not state:
+            return False
+        return self.remember(state).room
+
+    async def get_room_info(self):
+        if entry := await self.get_entry():
+            return entry.room
+        return False
+
+    async def drop_room(self):
+        result = await self.store.drop()
+        self.remember(None)
+        return result
+
+    async def add_participant(self, participant: Participant):
+        state = await self.store.join(
+            participant.user_id,
+            "",
+            "",
+            create=False,
+            participant=self.encode_participant(participant),
+            lease_until=self.lease_until(),
+        )
+        if not state:
+            raise exceptions.NotFound
+        return self.remember(state).room
+
+    async def remove_participant(self, user_id: str, channel_name: str = ""):
+        left, state = await self.store.leave(user_id, channel_name)
+        if entry := self.remember(state):
+            return left, entry.room.participants
+        return left, []
+
+    async def set_channel(self, user_id: str, channel_name: str):
+        self.forget(await self.store.set_channel(user_id, channel_name))
+
+    async def get_channel(self, user_id: str) -> str | None:
+        if (entry := await self.get_entry()) and (
+            channel := entry.channels.get(user_id)
         ):
-            room.participants.append(participant)
-            cache.set(self.room_key, room.model_dump(), timeout=None)
-        return room
+            return channel
+        return await self.store.get_channel(user_id)
+
+    async def get_channels(self) -> list[str]:
+        if entry := await self.get_entry():
+            return list(entry.channels.values())
+        return []
+
+    async def get_fresh_channels(self) -> list[str]:
+        """저장소의 버전과 같을때만 캐시를 쓰고, 다르면 방 상태를 다시 읽음"""
+        entry = self.cached()
+        if not entry or entry.version != await self.store.get_version():
+            entry = self.remember(await self.store.get())
+        return list(entry.channels.values()) if entry else []
 
-    def remove_participant(self, user_id: str):
-        if not (room := self.get_room_info()):
-            raise
-        room.participants = list(
-            filter(lambda x: x.user_id != user_id, room.participants)
+    async def remove_channel(self, user_id: str, channel_name: str):
+        self.forget(await self.store.remove_channel(user_id, channel_name))
+
+    async def set_media(self, user_id: str, media: str, status: bool):
+        version = await self.store.set_media(user_id, self.media_field(media), status)
+        self.forget(version)
+        return bool(version)
+
+    async def heartbeat(self, user_id: str, channel_name: str):
+        return await self.store.heartbeat(user_id, channel_name, self.lease_until())
+
+    async def join_session(
+        self, participant: Participant, password: str, channel_name: str
+    ):
+        """join과 같지만 이벤트 순번과 이전에 등록되어 있던 채널도 돌려줌"""
+        state, previous_channel = await self.store.resume(
+            participant.user_id,
+            password,
+            str(uuid4()),
+            self.encode_participant(participant),
+            channel_name,
+            self.lease_until(),
         )
-        cache.set(self.room_key, room.model_dump(), timeout=None)
-        return room
+        if not state:
+            return False
+        entry = self.remember(state)
+        return Session(entry.room, entry.participants, state.seq, previous_channel)
+
+    async def set_away(self, user_id: str, channel_name: str):
+        """
+        연결이 끊긴 참가자를 ROOM_RESUME_GRACE초 동안 방에 남겨둠
+        lease도 그만큼으로 줄여서 퇴장 처리가 실패해도 reap_ghost_participants가 정리함
+        """
+        lease_until = time.time() + settings.ROOM_RESUME_GRACE
+        version = await self.store.away(user_id, channel_name, lease_until)
+        self.forget(version)
+        return bool(version)
+
+    async def is_participant(self, user_id: str):
+        if entry := await self.get_entry():
+            return any(p.user_id == user_id for p in entry.room.participants)
+        return False
+
+    async def log_event(self, message: dict) -> int:
+        """채널 레이어 메세지를 이벤트 로그에 남기고 순번을 돌려줌. 방이 없으면 0"""
+        if settings.ROOM_EVENT_LOG_SIZE <= 0:
+            return 0
+        return await self.store.log_event(
+            msgpack.packb(message), settings.ROOM_EVENT_LOG_SIZE
+        )
+
+    async def events_after(self, last_seq: int, until: int):
+        """
+        last_seq 다음부터 until까지의 이벤트. 로그가 잘려서 빠진 이벤트가 있으면 None
+        """
+        if last_seq > until:
+            return None
+        events = await self.store.events(last_seq, until)
+        if len(events) != until - last_seq:
+            return None
+        return [(event.seq, msgpack.unpackb(event.message)) for event in events]
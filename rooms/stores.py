@@ -0,0 +1,637 @@
+from typing import Any, NamedTuple
+
+from commons.lock import get_async_redis, get_redis
+
+from .caches import INVALIDATION_CHANNEL
+
+ACTIVE_ROOMS_KEY = "v3:rooms:active"
+ROOMS_BY_SIZE_KEY = "v3:rooms:index:size"
+ROOMS_BY_ACTIVITY_KEY = "v3:rooms:index:activity"
+PUBLIC_ROOMS_BY_SIZE_KEY = "v3:rooms:index:public:size"
+PUBLIC_ROOMS_BY_ACTIVITY_KEY = "v3:rooms:index:public:activity"
+
+# 방 상태를 하나의 캐시값으로 통째로 읽고 쓰는 대신 redis hash로 나눠서 저장함
+# {room_key}:meta         password, room_id, owner
+# {room_key}:participants user_id -> [user_id, username, audio_on, video_on] msgpack (이전 버전은 json)
+# {room_key}:channels     user_id -> channel_name
+# {room_key}:version      바뀔때마다 올라가는 버전. 워커 캐시 무효화에 사용하고 방이 삭제되어도 하루동안 유지
+# {room_key}:leases       user_id -> lease 만료 시각(unix time). 컨슈머의 heartbeat로 연장됨
+# v3:rooms:active         참가자가 있는 방의 meta 키 목록. 만료된 참가자를 정리할때 순회함
+# {room_key}:away         user_id -> 연결이 끊긴 채널. 재접속을 기다리는 동안 참가자 목록에는 남아있음
+# {room_key}:events       방 이벤트 로그. "{seq}-0" id의 capped stream으로 재접속한 참가자가 놓친 이벤트를 받음
+# {room_key}:seq          이벤트 순번
+# v3:rooms:index:size     meta 키 -> 참가자 수. 방 목록을 큰 순서로 조회할때 사용
+# v3:rooms:index:activity meta 키 -> 마지막으로 참가/퇴장이 있었던 시각(unix time)
+# v3:rooms:index:public:* 패스워드가 없는 방만 넣은 같은 인덱스. 방 목록은 기본적으로 이것만 보여줌
+# 참가/퇴장은 lua 스크립트로 한번에 처리하고 바뀐 방 상태를 돌려받음
+# KEYS는 항상 meta, participants, channels, version, leases, active, away, events, seq,
+# index:size, index:activity, index:public:size, index:public:activity 순서이고
+# ARGV의 마지막은 무효화 채널
+
+BUMP = """
+local function bump()
+    local version = redis.call('INCR', KEYS[4])
+    redis.call('PERSIST', KEYS[4])
+    redis.call('PUBLISH', ARGV[#ARGV], KEYS[1] .. ' ' .. version)
+    return version
+end
+local function reindex()
+    local password = redis.call('HGET', KEYS[1], 'password')
+    if not password then
+        for i = 10, 13 do
+            redis.call('ZREM', KEYS[i], KEYS[1])
+        end
+        return
+    end
+    local size = redis.call('HLEN', KEYS[2])
+    local now = redis.call('TIME')
+    now = now[1] .. '.' .. string.format('%06d', now[2])
+    redis.call('ZADD', KEYS[10], size, KEYS[1])
+    redis.call('ZADD', KEYS[11], now, KEYS[1])
+    if password == '' then
+        redis.call('ZADD', KEYS[12], size, KEYS[1])
+        redis.call('ZADD', KEYS[13], now, KEYS[1])
+    end
+end
+local function state(version)
+    return {
+        redis.call('HGETALL', KEYS[1]),
+        redis.call('HGETALL', KEYS[2]),
+        redis.call('HGETALL', KEYS[3]),
+        version,
+        redis.call('GET', KEYS[9]),
+    }
+end
+"""
+
+# ARGV: user_id, password, room_id, create(0|1), participant, channel_name, lease_until
+# create=1 이면 방이 없을때 만들고 패스워드를 확인함
+# create=0 이면 이미 있는 방에만 추가하고 패스워드를 확인하지 않음
+# channel_name이 주어지면 이전에 등록되어 있던(혹은 끊긴) 채널도 돌려줌
+# return: {0} 패스워드 불일치, {-1} 방이 없음, {1, state, previous_channel}
+JOIN_SCRIPT = BUMP + """
+local password = redis.call('HGET', KEYS[1], 'password')
+if not password then
+    if ARGV[4] == '0' then
+        return {-1}
+    end
+    redis.call('HSET', KEYS[1], 'password', ARGV[2], 'room_id', ARGV[3], 'owner', ARGV[1])
+elseif ARGV[4] == '1' and password ~= '' and password ~= ARGV[2] then
+    return {0}
+end
+if ARGV[5] ~= '' then
+    -- 다시 참가하면 새로 보낸 이름과 미디어 상태로 바꿈
+    redis.call('HSET', KEYS[2], ARGV[1], ARGV[5])
+end
+local previous = ''
+if ARGV[6] ~= '' then
+    previous = redis.call('HGET', KEYS[3], ARGV[1]) or redis.call('HGET', KEYS[7], ARGV[1]) or ''
+    redis.call('HSET', KEYS[3], ARGV[1], ARGV[6])
+    redis.call('HDEL', KEYS[7], ARGV[1])
+end
+redis.call('ZADD', KEYS[5], ARGV[7], ARGV[1])
+redis.call('SADD', KEYS[6], KEYS[1])
+reindex()
+return {1, state(bump()), previous}
+"""
+
+# ARGV: user_id, channel_name
+# channel_name이 주어지면 그 채널로 등록된(혹은 그 채널로 끊긴) 참가자일때만 퇴장시킴 (재접속한 경우 유지)
+# 마지막 참가자가 나가면 방을 삭제함
+# return: {left(0|1), state}
+LEAVE_SCRIPT = BUMP + """
+if ARGV[2] ~= '' and (redis.call('HGET', KEYS[3], ARGV[1]) or redis.call('HGET', KEYS[7], ARGV[1])) ~= ARGV[2] then
+    return {0, state(tonumber(redis.call('GET', KEYS[4]) or 0))}
+end
+redis.call('HDEL', KEYS[2], ARGV[1])
+redis.call('HDEL', KEYS[3], ARGV[1])
+redis.call('HDEL', KEYS[7], ARGV[1])
+redis.call('ZREM', KEYS[5], ARGV[1])
+if redis.call('HLEN', KEYS[2]) == 0 then
+    redis.call('DEL', KEYS[1], KEYS[2], KEYS[3], KEYS[5], KEYS[7], KEYS[8], KEYS[9])
+    redis.call('SREM', KEYS[6], KEYS[1])
+end
+reindex()
+local version = bump()
+if redis.call('EXISTS', KEYS[1]) == 0 then
+    redis.call('EXPIRE', KEYS[4], 86400)
+end
+return {1, state(version)}
+"""
+
+DROP_SCRIPT = BUMP + """
+redis.call('DEL', KEYS[1], KEYS[2], KEYS[3], KEYS[5], KEYS[7], KEYS[8], KEYS[9])
+redis.call('SREM', KEYS[6], KEYS[1])
+reindex()
+bump()
+redis.call('EXPIRE', KEYS[4], 86400)
+return 1
+"""
+
+# ARGV: user_id, channel_name
+SET_CHANNEL_SCRIPT = BUMP + """
+if redis.call('EXISTS', KEYS[1]) == 0 then
+    return 0
+end
+redis.call('HSET', KEYS[3], ARGV[1], ARGV[2])
+return bump()
+"""
+
+# ARGV: user_id, channel_name
+REMOVE_CHANNEL_SCRIPT = BUMP + """
+if redis.call('HGET', KEYS[3], ARGV[1]) ~= ARGV[2] then
+    return 0
+end
+redis.call('HDEL', KEYS[3], ARGV[1])
+return bump()
+"""
+
+# ARGV: user_id, channel_name, lease_until
+# 연결이 끊긴 참가자를 채널 디렉토리에서 away로 옮기고 lease를 grace 기간으로 줄임
+# 참가자 목록에는 남겨서 다른 참가자들이 연결을 끊지 않도록 함
+# 이미 다른 채널로 재접속했다면 0
+AWAY_SCRIPT = BUMP + """
+if redis.call('HGET', KEYS[3], ARGV[1]) ~= ARGV[2] then
+    return 0
+end
+redis.call('HDEL', KEYS[3], ARGV[1])
+redis.call('HSET', KEYS[7], ARGV[1], ARGV[2])
+redis.call('ZADD', KEYS[5], ARGV[3], ARGV[1])
+return bump()
+"""
+
+# ARGV: message, max_length
+# 이벤트에 순번을 붙여 로그에 남김. 방 상태는 바뀌지 않으므로 버전은 올리지 않음
+# return: seq, 방이 없으면 0
+LOG_EVENT_SCRIPT = """
+if redis.call('EXISTS', KEYS[1]) == 0 then
+    return 0
+end
+local seq = redis.call('INCR', KEYS[9])
+redis.call('XADD', KEYS[8], 'MAXLEN', '~', ARGV[2], seq .. '-0', 'message', ARGV[1])
+return seq
+"""
+
+# ARGV: user_id, field, value(0|1)
+# 참가자의 audio_on/video_on을 바꿈. 바뀌었으면 버전, 참가자가 없거나 같은 값이면 0
+# 이전 버전의 json 참가자는 이때 msgpack 배열로 바꿔서 저장함
+SET_MEDIA_SCRIPT = BUMP + """
+local participant = redis.call('HGET', KEYS[2], ARGV[1])
+if not participant then
+    return 0
+end
+local data
+if string.sub(participant, 1, 1) == '{' then
+    local legacy = cjson.decode(participant)
+    data = {legacy.user_id, legacy.username, legacy.audio_on, legacy.video_on}
+else
+    data = cmsgpack.unpack(participant)
+end
+local index = ({audio_on = 3, video_on = 4})[ARGV[2]]
+local value = ARGV[3] == '1'
+if data[index] == value then
+    return 0
+end
+data[index] = value
+redis.call('HSET', KEYS[2], ARGV[1], cmsgpack.pack(data))
+return bump()
+"""
+
+# ARGV: user_id, channel_name, lease_until
+# 그 채널로 등록된 참가자일때만 lease를 연장함. 이미 정리되었거나 재접속했다면 0
+HEARTBEAT_SCRIPT = """
+if redis.call('HGET', KEYS[3], ARGV[1]) ~= ARGV[2] then
+    return 0
+end
+redis.call('ZADD', KEYS[5], ARGV[3], ARGV[1])
+return 1
+"""
+
+# ARGV: now
+# lease가 만료된 참가자를 내보내고 비게 된 방은 삭제함
+# return: {{}} 만료된 참가자 없음, {{user_id, channel_name, ...}, state}
+REAP_SCRIPT = BUMP + """
+local expired = redis.call('ZRANGEBYSCORE', KEYS[5], '-inf', ARGV[1])
+if redis.call('EXISTS', KEYS[1]) == 0 then
+    redis.call('DEL', KEYS[5])
+    redis.call('SREM', KEYS[6], KEYS[1])
+    reindex()
+    return {{}}
+end
+if #expired == 0 then
+    -- 인덱스가 생기기 전부터 있던 방을 채워넣음
+    if not redis.call('ZSCORE', KEYS[11], KEYS[1])
+        or (redis.call('HGET', KEYS[1], 'password') == '' and not redis.call('ZSCORE', KEYS[13], KEYS[1])) then
+        reindex()
+    end
+    return {{}}
+end
+local removed = {}
+for _, user_id in ipairs(expired) do
+    table.insert(removed, user_id)
+    table.insert(removed, redis.call('HGET', KEYS[3], user_id) or redis.call('HGET', KEYS[7], user_id) or '')
+    redis.call('HDEL', KEYS[2], user_id)
+    redis.call('HDEL', KEYS[3], user_id)
+    redis.call('HDEL', KEYS[7], user_id)
+    redis.call('ZREM', KEYS[5], user_id)
+end
+if redis.call('HLEN', KEYS[2]) == 0 then
+    redis.call('DEL', KEYS[1], KEYS[2], KEYS[3], KEYS[5], KEYS[7], KEYS[8], KEYS[9])
+    redis.call('SREM', KEYS[6], KEYS[1])
+end
+reindex()
+local version = bump()
+if redis.call('EXISTS', KEYS[1]) == 0 then
+    redis.call('EXPIRE', KEYS[4], 86400)
+end
+return {removed, state(version)}
+"""
+
+
+def decode(value: bytes | str) -> str:
+    if isinstance(value, bytes):
+        return value.decode()
+    return value
+
+
+def pairs(values: list | dict) -> dict[str, str]:
+    # HGETALL 결과 [k1, v1, k2, v2...] 혹은 dict를 str dict로 변환
+    if isinstance(values, dict):
+        return {decode(k): decode(v) for k, v in values.items()}
+    return {decode(values[i]): decode(values[i + 1]) for i in range(0, len(values), 2)}
+
+
+def raw_pairs(values: list | dict) -> dict[str, bytes]:
+    # 값은 msgpack 그대로 두고 키만 str로 변환
+    if isinstance(values, dict):
+        return {decode(k): v for k, v in values.items()}
+    return {decode(values[i]): values[i + 1] for i in range(0, len(values), 2)}
+
+
+class RoomState(NamedTuple):
+    version: int
+    meta: dict[str, str]
+    participants: dict[str, bytes]
+    channels: dict[str, str]
+    seq: int = 0
+
+
+class RoomEvent(NamedTuple):
+    seq: int
+    message: bytes
+
+
+class RoomIndexEntry(NamedTuple):
+    room_key: str
+    participant_count: int
+    last_activity: float
+    has_password: bool
+
+
+ROOM_INDEXES = dict(size=ROOMS_BY_SIZE_KEY, recent=ROOMS_BY_ACTIVITY_KEY)
+PUBLIC_ROOM_INDEXES = dict(
+    size=PUBLIC_ROOMS_BY_SIZE_KEY, recent=PUBLIC_ROOMS_BY_ACTIVITY_KEY
+)
+
+
+class BaseRoomStore:
+    def __init__(self, room_key: str, client: Any):
+        self.client = client
+        self.room_key = room_key
+        self.meta_key = f"{room_key}:meta"
+        self.participants_key = f"{room_key}:participants"
+        self.channels_key = f"{room_key}:channels"
+        self.version_key = f"{room_key}:version"
+        self.leases_key = f"{room_key}:leases"
+        self.away_key = f"{room_key}:away"
+        self.events_key = f"{room_key}:events"
+        self.seq_key = f"{room_key}:seq"
+        self.join_script = self.client.register_script(JOIN_SCRIPT)
+        self.leave_script = self.client.register_script(LEAVE_SCRIPT)
+        self.drop_script = self.client.register_script(DROP_SCRIPT)
+        self.set_channel_script = self.client.register_script(SET_CHANNEL_SCRIPT)
+        self.remove_channel_script = self.client.register_script(REMOVE_CHANNEL_SCRIPT)
+        self.heartbeat_script = self.client.register_script(HEARTBEAT_SCRIPT)
+        self.set_media_script = self.client.register_script(SET_MEDIA_SCRIPT)
+        self.reap_script = self.client.register_script(REAP_SCRIPT)
+        self.away_script = self.client.register_script(AWAY_SCRIPT)
+        self.log_event_script = self.client.register_script(LOG_EVENT_SCRIPT)
+
+    @property
+    def keys(self):
+        return [
+            self.meta_key,
+            self.participants_key,
+            self.channels_key,
+            self.version_key,
+            self.leases_key,
+            ACTIVE_ROOMS_KEY,
+            self.away_key,
+            self.events_key,
+            self.seq_key,
+            ROOMS_BY_SIZE_KEY,
+            ROOMS_BY_ACTIVITY_KEY,
+            PUBLIC_ROOMS_BY_SIZE_KEY,
+            PUBLIC_ROOMS_BY_ACTIVITY_KEY,
+        ]
+
+    def pipeline_get(self):
+        pipe = self.client.pipeline(transaction=True)
+        pipe.hgetall(self.meta_key)
+        pipe.hgetall(self.participants_key)
+        pipe.hgetall(self.channels_key)
+        pipe.get(self.version_key)
+        pipe.get(self.seq_key)
+        return pipe
+
+    @staticmethod
+    def parse_state(meta, participants, channels, version, seq) -> RoomState | None:
+        if not meta:
+            return None
+        return RoomState(
+            int(version or 0),
+            pairs(meta),
+            raw_pairs(participants),
+            pairs(channels),
+            int(seq or 0),
+        )
+
+    @staticmethod
+    def join_args(
+        user_id: str,
+        password: str,
+        room_id: str,
+        create: bool,
+        participant: bytes | str,
+        channel_name: str,
+        lease_until: float,
+    ):
+        return [
+            user_id,
+            password,
+            room_id,
+            "1" if create else "0",
+            participant,
+            channel_name,
+            lease_until,
+            INVALIDATION_CHANNEL,
+        ]
+
+    @classmethod
+    def parse_join(cls, result: list) -> RoomState | bool | None:
+        """패스워드가 틀리면 False, 방이 없으면 None"""
+        if result[0] == 0:
+            return False
+        if result[0] == -1:
+            return None
+        return cls.parse_state(*result[1])
+
+    @classmethod
+    def parse_resume(cls, result: list) -> tuple[RoomState | bool | None, str]:
+        """parse_join 결과와 이전에 등록되어 있던 채널"""
+        if len(result) == 1:
+            return cls.parse_join(result), ""
+        return cls.parse_join(result), decode(result[2])
+
+    @classmethod
+    def parse_leave(cls, result: list) -> tuple[bool, RoomState | None]:
+        left, state = result
+        return bool(left), cls.parse_state(*state)
+
+    @classmethod
+    def parse_reap(cls, result: list) -> tuple[dict[str, str], RoomState | None]:
+        """만료되어 내보낸 user_id -> channel_name과 남은 방 상태"""
+        if len(result) == 1:
+            return {}, None
+        removed, state = result
+        return pairs(removed), cls.parse_state(*state)
+
+    def events_range(self, after: int, until: int):
+        return dict(name=self.events_key, min=f"{after + 1}-0", max=f"{until}-0")
+
+    @staticmethod
+    def parse_events(entries: list) -> list[RoomEvent]:
+        return [
+            RoomEvent(int(decode(entry_id).split("-")[0]), fields[b"message"])
+            for entry_id, fields in entries
+        ]
+
+
+class RoomStore(BaseRoomStore):
+    def __init__(self, room_key: str, client: Any | None = None):
+        super().__init__(room_key, client or get_redis())
+
+    @classmethod
+    def active_room_keys(cls, client: Any | None = None):
+        client = client or get_redis()
+        for meta_key in client.sscan_iter(ACTIVE_ROOMS_KEY, count=1000):
+            yield decode(meta_key).removesuffix(":meta")
+
+    @classmethod
+    def count_indexed(cls, protected: bool = False, client: Any | None = None) -> int:
+        """protected가 False면 패스워드가 없는 방만 셈"""
+        client = client or get_redis()
+        indexes = ROOM_INDEXES if protected else PUBLIC_ROOM_INDEXES
+        return client.zcard(indexes["recent"])
+
+    @classmethod
+    def list_indexed(
+        cls,
+        ordering: str,
+        start: int,
+        stop: int,
+        protected: bool = False,
+        client: Any | None = None,
+    ):
+        """
+        ordering(size|recent) 인덱스에서 큰 순서로 start~stop-1번째 방
+        protected가 False면 패스워드가 없는 방만 돌려줌
+        """
+        client = client or get_redis()
+        indexes = ROOM_INDEXES if protected else PUBLIC_ROOM_INDEXES
+        meta_keys = [
+            decode(key) for key in client.zrevrange(indexes[ordering], start, stop - 1)
+        ]
+        pipe = client.pipeline(transaction=False)
+        for meta_key in meta_keys:
+            pipe.zscore(ROOMS_BY_SIZE_KEY, meta_key)
+            pipe.zscore(ROOMS_BY_ACTIVITY_KEY, meta_key)
+            pipe.hget(meta_key, "password")
+        values = pipe.execute()
+        entries: list[RoomIndexEntry] = []
+        for i, meta_key in enumerate(meta_keys):
+            size, activity, password = values[i * 3 : i * 3 + 3]
+            if size is None or password is None:
+                # 조회하는 사이에 삭제된 방
+                continue
+            entries.append(
+                RoomIndexEntry(
+                    meta_key.removesuffix(":meta"),
+                    int(size),
+                    float(activity or 0),
+                    bool(password),
+                )
+            )
+        return entries
+
+    def get(self):
+        return self.parse_state(*self.pipeline_get().execute())
+
+    def join(
+        self,
+        user_id: str,
+        password: str,
+        room_id: str,
+        create: bool = True,
+        participant: bytes | str = "",
+        channel_name: str = "",
+        lease_until: float = 0,
+    ):
+        args = self.join_args(
+            user_id, password, room_id, create, participant, channel_name, lease_until
+        )
+        return self.parse_join(self.join_script(keys=self.keys, args=args))
+
+    def resume(
+        self,
+        user_id: str,
+        password: str,
+        room_id: str,
+        participant: bytes | str,
+        channel_name: str,
+        lease_until: float,
+    ):
+        args = self.join_args(
+            user_id, password, room_id, True, participant, channel_name, lease_until
+        )
+        return self.parse_resume(self.join_script(keys=self.keys, args=args))
+
+    def leave(self, user_id: str, channel_name: str = ""):
+        args = [user_id, channel_name, INVALIDATION_CHANNEL]
+        return self.parse_leave(self.leave_script(keys=self.keys, args=args))
+
+    def drop(self):
+        return self.drop_script(keys=self.keys, args=[INVALIDATION_CHANNEL])
+
+    def set_channel(self, user_id: str, channel_name: str):
+        args = [user_id, channel_name, INVALIDATION_CHANNEL]
+        return self.set_channel_script(keys=self.keys, args=args)
+
+    def get_version(self) -> int:
+        return int(self.client.get(self.version_key) or 0)
+
+    def get_channel(self, user_id: str) -> str | None:
+        if channel_name := self.client.hget(self.channels_key, user_id):
+            return decode(channel_name)
+        return None
+
+    def remove_channel(self, user_id: str, channel_name: str):
+        args = [user_id, channel_name, INVALIDATION_CHANNEL]
+        return self.remove_channel_script(keys=self.keys, args=args)
+
+    def set_media(self, user_id: str, field: str, value: bool):
+        args = [user_id, field, "1" if value else "0", INVALIDATION_CHANNEL]
+        return self.set_media_script(keys=self.keys, args=args)
+
+    def heartbeat(self, user_id: str, channel_name: str, lease_until: float):
+        args = [user_id, channel_name, lease_until, INVALIDATION_CHANNEL]
+        return bool(self.heartbeat_script(keys=self.keys, args=args))
+
+    def reap(self, now: float):
+        args = [now, INVALIDATION_CHANNEL]
+        return self.parse_reap(self.reap_script(keys=self.keys, args=args))
+
+    def away(self, user_id: str, channel_name: str, lease_until: float):
+        args = [user_id, channel_name, lease_until, INVALIDATION_CHANNEL]
+        return self.away_script(keys=self.keys, args=args)
+
+    def log_event(self, message: bytes, max_length: int) -> int:
+        args = [message, max_length, INVALIDATION_CHANNEL]
+        return self.log_event_script(keys=self.keys, args=args)
+
+    def events(self, after: int, until: int):
+        return self.parse_events(self.client.xrange(**self.events_range(after, until)))
+
+
+class AsyncRoomStore(BaseRoomStore):
+    def __init__(self, room_key: str, client: Any | None = None):
+        super().__init__(room_key, client or get_async_redis())
+
+    async def get(self):
+        return self.parse_state(*await self.pipeline_get().execute())
+
+    async def join(
+        self,
+        user_id: str,
+        password: str,
+        room_id: str,
+        create: bool = True,
+        participant: bytes | str = "",
+        channel_name: str = "",
+        lease_until: float = 0,
+    ):
+        args = self.join_args(
+            user_id, password, room_id, create, participant, channel_name, lease_until
+        )
+        return self.parse_join(await self.join_script(keys=self.keys, args=args))
+
+    async def resume(
+        self,
+        user_id: str,
+        password: str,
+        room_id: str,
+        participant: bytes | str,
+        channel_name: str,
+        lease_until: float,
+    ):
+        args = self.join_args(
+            user_id, password, room_id, True, participant, channel_name, lease_until
+        )
+        return self.parse_resume(await self.join_script(keys=self.keys, args=args))
+
+    async def leave(self, user_id: str, channel_name: str = ""):
+        args = [user_id, channel_name, INVALIDATION_CHANNEL]
+        return self.parse_leave(await self.leave_script(keys=self.keys, args=args))
+
+    async def drop(self):
+        return await self.drop_script(keys=self.keys, args=[INVALIDATION_CHANNEL])
+
+    async def set_channel(self, user_id: str, channel_name: str):
+        args = [user_id, channel_name, INVALIDATION_CHANNEL]
+        return await self.set_channel_script(keys=self.keys, args=args)
+
+    async def get_version(self) -> int:
+        return int(await self.client.get(self.version_key) or 0)
+
+    async def get_channel(self, user_id: str) -> str | None:
+        if channel_name := await self.client.hget(self.channels_key, user_id):
+            return decode(channel_name)
+        return None
+
+    async def remove_channel(self, user_id: str, channel_name: str):
+        args = [user_id, channel_name, INVALIDATION_CHANNEL]
+        return await self.remove_channel_script(keys=self.keys, args=args)
+
+    async def set_media(self, user_id: str, field: str, value: bool):
+        args = [user_id, field, "1" if value else "0", INVALIDATION_CHANNEL]
+        return await self.set_media_script(keys=self.keys, args=args)
+
+    async def heartbeat(self, user_id: str, channel_name: str, lease_until: float):
+        args = [user_id, channel_name, lease_until, INVALIDATION_CHANNEL]
+        return bool(await self.heartbeat_script(keys=self.keys, args=args))
+
+    async def reap(self, now: float):
+        args = [now, INVALIDATION_CHANNEL]
+        return self.parse_reap(await self.reap_script(keys=self.keys, args=args))
+
+    async def away(self, user_id: str, channel_name: str, lease_until: float):
+        args = [user_id, channel_name, lease_until, INVALIDATION_CHANNEL]
+        return await self.away_script(keys=self.keys, args=args)
+
+    async def log_event(self, message: bytes, max_length: int) -> int:
+        args = [message, max_length, INVALIDATION_CHANNEL]
+        return await self.log_event_script(keys=self.keys, args=args)
+
+    async def events(self, after: int, until: int):
+        entries = await self.client.xrange(**self.events_range(after, until))
+        return self.parse_events(entries)
@@ -0,0 +1,45 @@
+from asgiref.sync import async_to_sync
+from channels.layers import get_channel_layer
+
+from commons.celery import shared_task
+from .consumers import RoomConsumer
+from .services import RoomService
+
+
+def leave_message(service: RoomService, user_id: str):
+    message = dict(type="emit", data=dict(type="userdisconnected", sender=user_id))
+    # 컨슈머의 broadcast처럼 이벤트 로그에 남겨서 재접속한 참가자도 받게 함
+    if seq := service.log_event(message):
+        message = dict(message, data=dict(message["data"], seq=seq))
+    return message
+
+
+async def evict(room_name: str, removed: dict[str, str], messages: list[dict]):
+    channel_layer = get_channel_layer()
+    if not channel_layer:
+        return
+    group_name = RoomConsumer.get_group_name(room_name)
+    for channel_name in removed.values():
+        if channel_name:
+            await channel_layer.group_discard(group_name, channel_name)
+    for message in messages:
+        await channel_layer.group_send(group_name, message)
+
+
+@shared_task()
+def reap_ghost_participants():
+    """
+    워커가 죽거나 disconnect가 호출되지 않아 lease가 만료된 참가자를 방에서 내보냄
+    남은 참가자에게는 userdisconnected를 보내고, 비게 된 방은 스크립트에서 삭제됨
+    """
+    reaped = 0
+    for service in RoomService.active_rooms():
+        removed, participants = service.reap()
+        if not removed:
+            continue
+        messages = []
+        if participants:
+            messages = [leave_message(service, user_id) for user_id in removed]
+        async_to_sync(evict)(service.room_name, removed, messages)
+        reaped += len(removed)
+    return reaped
@@ -1,8 +1,23 @@
+import asyncio
+import io
+import json
+import tempfile
+import time
+
+import msgpack
+from asgiref.sync import async_to_sync
+from channels.routing import URLRouter
+from channels.testing import WebsocketCommunicator
 from django.core.cache import cache
+from django.core.management import call_command
+from django.test import override_settings
 from rest_framework import exceptions
 from base.test import TestCase
 from users.models import User
-from .services import RoomService
+from . import routings
+from .services import RoomService, AsyncRoomService
+from .stores import RoomStore
+from .tasks import reap_ghost_participants
 
 
 # Create your tests here.
@@ -59,3 +74,386 @@ class TestRooms(TestCase):
         self.assertEqual(r1, r2)
         with self.assertRaises(exceptions.ValidationError):
             self.service.create_room(str(self.user2.pk), "test12345")
+
+    def test_channel_directory(self):
+        user_id = str(self.user.pk)
+        self.service.create_room(user_id, "")
+        self.service.set_channel(user_id, "channel-1")
+        self.assertEqual(self.service.get_channel(user_id), "channel-1")
+        # 재접속으로 채널이 바뀐 뒤에 이전 연결이 끊겨도 새 채널은 유지
+        self.service.set_channel(user_id, "channel-2")
+        self.service.remove_channel(user_id, "channel-1")
+        self.assertEqual(self.service.get_channel(user_id), "channel-2")
+        self.service.remove_channel(user_id, "channel-2")
+        self.assertEqual(self.service.get_channel(user_id), None)
+
+    def test_join_and_leave(self):
+        participant = self.service.Participant(
+            user_id=str(self.user.pk), username="test", audio_on=False, video_on=False
+        )
+        participant2 = self.service.Participant(
+            user_id=str(self.user2.pk), username="test2", audio_on=False, video_on=False
+        )
+        room = self.service.join(participant, "1234", "channel-1")
+        self.assertNotEqual(room, False)
+        self.assertEqual(self.service.join(participant2, "wrong", "channel-2"), False)
+        room = self.service.join(participant2, "1234", "channel-2")
+        assert room
+        self.assertEqual(room.owner, participant.user_id)
+        self.assertEqual(len(room.participants), 2)
+        self.assertEqual(self.service.get_channel(participant2.user_id), "channel-2")
+
+        # 다시 참가하면 이전 이름과 미디어 상태가 남지 않음
+        rejoined = participant2.model_copy(
+            update=dict(username="renamed", audio_on=True, video_on=True)
+        )
+        room = self.service.join(rejoined, "1234", "channel-2")
+        assert room
+        self.assertEqual(room.participants, [participant, rejoined])
+        room = self.service.join(participant2, "1234", "channel-2")
+        assert room
+        self.assertEqual(room.participants, [participant, participant2])
+
+        # 이미 다른 채널로 재접속한 참가자는 이전 채널의 퇴장으로 나가지 않음
+        left, participants = self.service.remove_participant(
+            participant.user_id, "old-channel"
+        )
+        self.assertEqual(left, False)
+        self.assertEqual(len(participants), 2)
+
+        left, participants = self.service.remove_participant(
+            participant.user_id, "channel-1"
+        )
+        self.assertEqual(left, True)
+        self.assertEqual(participants, [participant2])
+
+        # 마지막 참가자가 나가면 방이 삭제됨
+        self.service.remove_participant(participant2.user_id, "channel-2")
+        self.assertEqual(self.service.get_room_info(), False)
+
+    async def test_async_service(self):
+        service = AsyncRoomService(self.service.room_name)
+        participant = service.Participant(
+            user_id="1", username="test", audio_on=False, video_on=False
+        )
+        room = await service.join(participant, "1234", "channel-1")
+        assert room
+        self.assertEqual(await service.get_channel("1"), "channel-1")
+        self.assertEqual(await service.authenticate("wrong"), False)
+        # sync 서비스와 같은 저장소를 사용
+        self.assertEqual(await service.get_room_info(), self.service.get_room_info())
+        # 다른 워커에서 바꾼 채널도 pub/sub를 기다리지 않고 버전으로 확인함
+        await service.store.set_channel("1", "channel-2")
+        self.assertEqual(await service.get_fresh_channels(), ["channel-2"])
+        await service.set_channel("1", "channel-1")
+        left, participants = await service.remove_participant("1", "channel-1")
+        self.assertEqual((left, participants), (True, []))
+        self.assertEqual(await service.authenticate("1234"), "empty")
+
+    def test_roster_cache_invalidation(self):
+        participant = self.service.Participant(
+            user_id="1", username="test", audio_on=False, video_on=False
+        )
+        self.service.join(participant, "", "channel-1")
+        room = self.service.get_room_info()
+        # 같은 워커에서는 캐시된 상태를 그대로 돌려줌
+        self.assertIs(self.service.get_room_info(), room)
+
+        # 다른 워커의 쓰기는 pub/sub 무효화로 반영됨
+        participant2 = participant.model_copy(update=dict(user_id="2"))
+        self.service.store.join("2", "", "", participant=participant2.model_dump_json())
+        for _ in range(20):
+            if (room := self.service.get_room_info()) and len(room.participants) == 2:
+                break
+            time.sleep(0.05)
+        assert room
+        self.assertEqual(len(room.participants), 2)
+
+    def test_signaling_benchmark(self):
+        with tempfile.NamedTemporaryFile(suffix=".json") as f:
+            call_command(
+                "signaling_benchmark",
+                rooms=2,
+                participants=3,
+                candidates=2,
+                layer="memory",
+                output=f.name,
+                stdout=io.StringIO(),
+            )
+            (result,) = json.load(f)["results"]
+        # 2개 방 x 3명 x 상대 2명 x (sdp 1 + candidate 2)
+        self.assertEqual(result["messages"], 36)
+        self.assertEqual(result["delivery_latency"]["count"], 36)
+        self.assertEqual(result["redis_round_trips_per_join"], 1)
+
+    def test_reap_ghost_participants(self):
+        participant = self.service.Participant(
+            user_id="1", username="test", audio_on=False, video_on=False
+        )
+        participant2 = participant.model_copy(update=dict(user_id="2"))
+        with override_settings(ROOM_PARTICIPANT_LEASE=-1):
+            # disconnect 없이 사라진 참가자
+            self.service.join(participant, "", "channel-1")
+        self.service.join(participant2, "", "channel-2")
+        self.assertIn(self.service.room_key, RoomStore.active_room_keys())
+
+        self.assertEqual(reap_ghost_participants(), 1)
+        room = self.service.get_room_info()
+        assert room
+        self.assertEqual([p.user_id for p in room.participants], ["2"])
+        # 재접속한 참가자가 받을 수 있도록 퇴장도 이벤트 로그에 남김
+        ((seq, message),) = self.service.store.events(0, 1)
+        self.assertEqual(
+            (seq, msgpack.unpackb(message)["data"]),
+            (1, dict(type="userdisconnected", sender="1")),
+        )
+        self.assertFalse(self.service.heartbeat("1", "channel-1"))
+        self.assertTrue(self.service.heartbeat("2", "channel-2"))
+
+        # 마지막 참가자까지 만료되면 방이 삭제됨
+        with override_settings(ROOM_PARTICIPANT_LEASE=-1):
+            self.assertTrue(self.service.heartbeat("2", "channel-2"))
+        self.assertEqual(reap_ghost_participants(), 1)
+        self.assertFalse(self.service.get_room_info())
+        self.assertNotIn(self.service.room_key, RoomStore.active_room_keys())
+
+    def test_set_media(self):
+        participant = self.service.Participant(
+            user_id="1", username="test", audio_on=False, video_on=False
+        )
+        self.service.join(participant, "", "channel-1")
+        self.assertTrue(self.service.set_media("1", "video", True))
+        # 같은 값이면 저장하지 않음
+        self.assertFalse(self.service.set_media("1", "video", True))
+        self.assertFalse(self.service.set_media("2", "video", True))
+        room = self.service.get_room_info()
+        assert room
+        self.assertEqual(
+            (room.participants[0].video_on, room.participants[0].audio_on),
+            (True, False),
+        )
+
+    @override_settings(
+        CHANNEL_LAYERS={"default": {"BACKEND": "channels.layers.InMemoryChannelLayer"}},
+        ROOM_RESUME_GRACE=0,
+    )
+    def test_stream_status_debounce(self):
+        app = URLRouter(routings.websocket_urlpatterns)
+
+        async def join(user_id: str):
+            communicator = WebsocketCommunicator(
+                app, f"/ws/rooms/{self.service.room_name}/"
+            )
+            await communicator.connect()
+            await communicator.send_json_to(
+                dict(
+                    type="authentication",
+                    password="",
+                    user_id=user_id,
+                    username=user_id,
+                )
+            )
+            return communicator, await communicator.receive_json_from()
+
+        async def run():
+            a, _ = await join("1")
+            b, _ = await join("2")
+            for status in [True, False, True]:
+                await a.send_json_to(
+                    dict(type="streamstatus", sender="1", media="video", status=status)
+                )
+            # 마지막 값만 한번 알림
+            self.assertEqual(
+                await b.receive_json_from(),
+                dict(
+                    type="streamstatus", sender="1", media="video", status=True, seq=1
+                ),
+            )
+            self.assertTrue(await b.receive_nothing(0.3))
+            # 새로 들어온 사람은 authentication 응답으로 현재 상태를 받음
+            c, auth = await join("3")
+            video = {p["user_id"]: p["video_on"] for p in auth["data"]}
+            self.assertEqual(video, {"1": True, "2": False, "3": False})
+            for communicator in [a, b, c]:
+                await communicator.disconnect()
+
+        async_to_sync(run)()
+
+    @override_settings(
+        CHANNEL_LAYERS={"default": {"BACKEND": "channels.layers.InMemoryChannelLayer"}},
+        ROOM_RESUME_GRACE=0,
+    )
+    def test_msgpack_payload(self):
+        app = URLRouter(routings.websocket_urlpatterns)
+
+        async def join(user_id: str, binary: bool):
+            communicator = WebsocketCommunicator(
+                app,
+                f"/ws/rooms/{self.service.room_name}/",
+                subprotocols=["webrtc.msgpack"] if binary else None,
+            )
+            await communicator.connect()
+            auth = dict(type="authentication", password="", user_id=user_id)
+            await send(communicator, binary, dict(auth, username=user_id))
+            await communicator.receive_from()
+            return communicator
+
+        async def send(communicator, binary: bool, content: dict):
+            if binary:
+                return await communicator.send_to(bytes_data=msgpack.packb(content))
+            await communicator.send_json_to(content)
+
+        async def run():
+            a = await join("1", True)
+            b = await join("2", False)
+            c = await join("3", True)
+            sdp = dict(type="sendsdp", sender="1", receiver="2", sdp="offer")
+            # msgpack으로 보내도 JSON처럼 검증된 필드만 전달됨
+            await send(a, True, dict(sdp, unknown="x"))
+            self.assertEqual(await b.receive_json_from(), sdp)
+            await send(b, False, dict(sdp, sender="2", receiver="3", unknown="x"))
+            received = msgpack.unpackb(await c.receive_from())
+            self.assertEqual(received, dict(sdp, sender="2", receiver="3"))
+            for communicator in [a, b, c]:
+                await communicator.disconnect()
+
+        async_to_sync(run)()
+
+    @override_settings(
+        CHANNEL_LAYERS={"default": {"BACKEND": "channels.layers.InMemoryChannelLayer"}},
+        ROOM_RESUME_GRACE=0.3,
+        ROOM_STREAM_STATUS_DEBOUNCE=0,
+    )
+    def test_resume_session(self):
+        app = URLRouter(routings.websocket_urlpatterns)
+
+        async def join(user_id: str, **resume):
+            communicator = WebsocketCommunicator(
+                app, f"/ws/rooms/{self.service.room_name}/"
+            )
+            await communicator.connect()
+            await communicator.send_json_to(
+                dict(
+                    type="authentication",
+                    password="",
+                    user_id=user_id,
+                    username=user_id,
+                    **resume,
+                )
+            )
+            return communicator, await communicator.receive_json_from()
+
+        def status(media: str):
+            return dict(type="streamstatus", sender="2", media=media, status=True)
+
+        async def run():
+            a, auth = await join("1")
+            self.assertEqual((auth["seq"], auth["resumed"]), (0, False))
+            b, _ = await join("2")
+            await b.send_json_to(status("video"))
+            self.assertEqual(await a.receive_json_from(), dict(status("video"), seq=1))
+
+            # 끊긴 동안의 이벤트는 로그에 남고 다른 참가자에게는 퇴장을 알리지 않음
+            await a.disconnect()
+            sdp = dict(type="sendsdp", sender="2", receiver="1", sdp="offer")
+            await b.send_json_to(status("audio"))
+            await b.send_json_to(sdp)
+            await asyncio.sleep(0.1)
+            a, auth = await join("1", resume_token=auth["resume_token"], last_seq=1)
+            self.assertEqual((auth["seq"], auth["resumed"]), (3, True))
+            missed = [await a.receive_json_from() for _ in range(2)]
+            self.assertEqual(missed, [dict(status("audio"), seq=2), dict(sdp, seq=3)])
+            self.assertTrue(await b.receive_nothing(0.5))
+
+            # 토큰 없이 다시 들어오면 이전 연결이 끊긴것으로 알림
+            await b.disconnect()
+            b, auth = await join("2", last_seq=3)
+            self.assertFalse(auth["resumed"])
+            self.assertEqual(
+                await a.receive_json_from(),
+                dict(type="userdisconnected", sender="2", seq=4),
+            )
+
+            # grace 기간 안에 돌아오지 않으면 퇴장시킴
+            await b.disconnect()
+            self.assertEqual(
+                await a.receive_json_from(1),
+                dict(type="userdisconnected", sender="2", seq=5),
+            )
+            room = await AsyncRoomService(self.service.room_name).get_room_info()
+            assert room
+            self.assertEqual([p.user_id for p in room.participants], ["1"])
+            await a.disconnect()
+            await asyncio.sleep(0.5)
+
+        async_to_sync(run)()
+
+        # 토큰은 heartbeat마다 새로 발급되므로 lease와 grace 기간이 지나면 쓸 수 없음
+        room = self.service.Room(password="", room_id="room", owner="1")
+        token = self.service.resume_token(room, "1")
+        self.assertTrue(self.service.check_resume_token(room, "1", token))
+        self.assertFalse(self.service.check_resume_token(room, "2", token))
+        with override_settings(ROOM_PARTICIPANT_LEASE=-1, ROOM_RESUME_GRACE=0):
+            self.assertFalse(self.service.check_resume_token(room, "1", token))
+
+    def test_room_directory(self):
+        participant = self.service.Participant(
+            user_id="1", username="test", audio_on=False, video_on=False
+        )
+        big = RoomService("test_big")
+        try:
+            for user_id in ["1", "2", "3"]:
+                big.join(participant.model_copy(update=dict(user_id=user_id)), "")
+            self.service.join(participant, "secret", "channel-1")
+
+            def listing(ordering: str):
+                resp = self.client.get("/rooms/", dict(ordering=ordering, limit=100))
+                self.assertEqual(resp.status_code, 200)
+                return [
+                    (room["name"], room["participant_count"], room["has_password"])
+                    for room in resp.json()["results"]
+                    if room["name"] in ["test", "test_big"]
+                ]
+
+            # 패스워드가 걸린 방은 기본적으로 보이지 않음
+            self.assertEqual(listing("size"), [("test_big", 3, False)])
+            self.assertEqual(listing("recent"), [("test_big", 3, False)])
+            with override_settings(ROOM_DIRECTORY_INCLUDE_PROTECTED=True):
+                self.assertEqual(
+                    listing("size"), [("test_big", 3, False), ("test", 1, True)]
+                )
+                self.assertEqual(
+                    listing("recent"), [("test", 1, True), ("test_big", 3, False)]
+                )
+                big.remove_participant("3")
+                self.assertEqual(
+                    listing("recent"), [("test_big", 2, False), ("test", 1, True)]
+                )
+            resp = self.client.get("/rooms/", dict(ordering="name"))
+            self.assertEqual(resp.status_code, 400)
+        finally:
+            big.drop_room()
+        self.service.drop_room()
+        self.assertEqual(listing("size"), [])
+
+    def test_participant_codec(self):
+        participant = self.service.Participant(
+            user_id="1", username="test", audio_on=False, video_on=True
+        )
+        self.service.join(participant, "", "channel-1")
+        stored = self.service.store.client.hget(self.service.store.participants_key, "1")
+        self.assertEqual(msgpack.unpackb(stored), ["1", "test", False, True])
+        # 이전 버전의 json 참가자도 읽히고, 상태가 바뀔때 msgpack으로 바뀜
+        legacy = participant.model_copy(update=dict(user_id="2"))
+        self.service.store.join("2", "", "", participant=legacy.model_dump_json())
+        self.service.forget(self.service.store.set_channel("2", "channel-2"))
+        room = self.service.get_room_info()
+        assert room
+        self.assertIn(legacy, room.participants)
+        self.assertTrue(self.service.set_media("2", "audio", True))
+        stored = self.service.store.client.hget(self.service.store.participants_key, "2")
+        self.assertEqual(msgpack.unpackb(stored), ["2", "test", True, True])
+
+        out = io.StringIO()
+        call_command("room_codec_benchmark", sizes="2", iterations=10, stdout=out)
+        self.assertIn("[msgpack] 2 participants", out.getvalue())
@@ -1,4 +1,5 @@
 from rest_framework import exceptions
+from rest_framework.pagination import LimitOffsetPagination
 from rest_framework.viewsets import ViewSet, GenericViewSet
 from rest_framework.response import Response
 from rest_framework.decorators import action
@@ -7,12 +8,34 @@ from commons.requests import Request
 
 from users.models import User
 
-from .services import RoomService
+from .services import RoomDirectory, RoomService
+
+
+class RoomPagination(LimitOffsetPagination):
+    default_limit = 20
+    max_limit = 100
 
 
 class RoomsViewSet(ViewSet):
     request: Request[User]
 
+    def list(self, *args, **kwargs):
+        # ?ordering=recent|size 로 최근 활동순/참가자 많은 순 정렬
+        ordering = self.request.query_params.get("ordering", "recent")
+        if ordering not in RoomDirectory.orderings:
+            raise exceptions.ValidationError(
+                dict(
+                    ordering=[
+                        f"{', '.join(RoomDirectory.orderings)} 중 하나여야 합니다"
+                    ]
+                )
+            )
+        paginator = RoomPagination()
+        page = paginator.paginate_queryset(
+            RoomDirectory(ordering), self.request, view=self
+        )
+        return paginator.get_paginated_response([room.model_dump() for room in page])
+
     @property
     def room_name(self):
         if name := self.kwargs.get("room"):
@@ -1,3 +1,11 @@
 sh dev.sh makemigrations
 sh dev.sh migrate
-uvicorn base.asgi:application --port 8000 --host 0.0.0.0 --workers $(($(awk '/^processor/{n+=1}END{print n}' /proc/cpuinfo)*$1+1)) --lifespan off --log-level debug
\ No newline at end of file
+if [ -n "$ROOM_AFFINITY_WORKERS" ]; then
+    # 방 단위 워커 고정(deploy.affinity.conf)을 위해 워커마다 포트를 따로 열어서 nginx가 직접 고르게 함
+    for i in $(seq 1 $ROOM_AFFINITY_WORKERS); do
+        uvicorn base.asgi:application --port $((8000+i)) --host 0.0.0.0 --workers 1 --lifespan off --log-level debug &
+    done
+    wait
+else
+    uvicorn base.asgi:application --port 8000 --host 0.0.0.0 --workers $(($(awk '/^processor/{n+=1}END{print n}' /proc/cpuinfo)*$1+1)) --lifespan off --log-level debug
+fi
\ No newline at end of file
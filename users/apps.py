@@ -6,6 +6,6 @@ class UsersConfig(AppConfig):
     name = "users"
 
     def ready(self) -> None:
-        from .signals import on_user_created
+        from .signals import on_user_created, on_user_saved
 
         return super().ready()
@@ -1,14 +1,51 @@
+import asyncio
 import json
-from typing import Any
+import logging
+from typing import Any, Iterable, Literal
+from typing_extensions import NotRequired, TypedDict
 from asgiref.sync import async_to_sync, sync_to_async
 
 
+from django.conf import settings
+
 from channels.layers import get_channel_layer
 from channels.generic.websocket import AsyncJsonWebsocketConsumer
+from rest_framework.exceptions import AuthenticationFailed
+
+from commons.layers import GroupSendResult, group_send_many
+from commons.metrics import (
+    connections,
+    instrument_router,
+    messages_sent,
+    timed_sync_to_async,
+)
+from commons.routers import MessageRouter
+
+from .stores import UserInbox, is_stream_id, presence
+
+
+class Authorization(TypedDict):
+    type: NotRequired[Literal["authorization"]]
+    access: str
+    # 마지막으로 받은 이벤트의 inbox_id. 없으면 ack로 저장된 id 이후의 이벤트를 보냄
+    last_id: NotRequired[str]
+
+
+class Ack(TypedDict):
+    type: Literal["ack"]
+    id: str
+
+
+logger = logging.getLogger(__name__)
+
+# 이전 클라이언트는 type 없이 access만 보냄
+router = instrument_router(MessageRouter(default="authorization"), "users")
 
 
 class UserConsumer(AsyncJsonWebsocketConsumer):
     signed = False
+    accepted = False
+    auth_timeout: asyncio.Task | None = None
 
     @staticmethod
     def get_group_name(user_id: int | str):
@@ -17,61 +54,158 @@ class UserConsumer(AsyncJsonWebsocketConsumer):
     async def connect(self):
         self.group_id = self.scope["url_route"]["kwargs"]["user_id"]
         self.group_name = self.get_group_name(self.group_id)
-        if self.channel_layer:
-            await self.channel_layer.group_add(self.group_name, self.channel_name)
+        # 그룹에는 인증이 끝난 뒤에 들어가서 인증 전의 소켓으로는 메세지가 가지 않음
         await self.accept()
+        self.accepted = True
+        connections.inc("users")
+        if settings.USER_AUTH_TIMEOUT > 0:
+            self.auth_timeout = asyncio.create_task(self.close_unauthorized())
+
+    async def close_unauthorized(self):
+        await asyncio.sleep(settings.USER_AUTH_TIMEOUT)
+        self.auth_timeout = None
+        if not self.signed:
+            await self.close(code=4001)
 
     async def disconnect(self, close_code):
+        if self.accepted:
+            self.accepted = False
+            connections.dec("users")
+        if self.auth_timeout:
+            self.auth_timeout.cancel()
+        if not self.signed:
+            return
         if self.channel_layer:
             await self.channel_layer.group_discard(self.group_name, self.channel_name)
+        if settings.USER_PRESENCE_TTL > 0:
+            await presence.remove(self.group_id)
 
     async def receive_json(self, content, **kwargs):
-        if not (access := content.get("access", None)):
+        await router.dispatch(self, content)
+
+    @router.route(Authorization)
+    async def handle_authorization(self, content: Authorization):
+        if not (access := content["access"]):
             return
         try:
             from commons.authentication import CustomJWTAuthentication
 
             auth = CustomJWTAuthentication()
-            if not (user := auth.get_cached_user(access)):
-                raw_token = auth.get_validated_token(access.encode())
-                user = await sync_to_async(auth.get_user)(raw_token)
-            if int(self.group_id) == user.pk:
-                self.signed = True
-            else:
-                await self.send(json.dumps(dict(type="authorization", result=False)))
-        except:
-            print("exception")
-            await self.send(json.dumps(dict(type="authorization", result=False)))
+            validated_token = auth.get_validated_token(access.encode())
+            # 워커 캐시에 없을때만 스레드에서 redis/DB를 조회함
+            if not (user := auth.get_cached_user(validated_token)):
+                user = await timed_sync_to_async(auth.get_user)(validated_token)
+            if int(self.group_id) != user.pk:
+                return await self.send_authorization_failed()
+        except AuthenticationFailed:
+            # 만료되었거나 잘못된 토큰, 비활성 유저
+            return await self.send_authorization_failed()
+        except Exception:
+            logger.exception("authorization failed for user %s", self.group_id)
+            return await self.send_authorization_failed()
+        if self.signed:
+            return
+        self.signed = True
+        if self.auth_timeout:
+            self.auth_timeout.cancel()
+            self.auth_timeout = None
+        if self.channel_layer:
+            await self.channel_layer.group_add(self.group_name, self.channel_name)
+        if settings.USER_PRESENCE_TTL > 0:
+            await presence.add(self.group_id)
+        await self.send_inbox(content.get("last_id"))
+
+    async def send_inbox(self, last_id: str | None):
+        """접속하지 않았던 동안 쌓인 이벤트를 하나의 프레임으로 보냄"""
+        if settings.USER_INBOX_SIZE <= 0:
+            return
+        inbox = self.get_inbox()
+        if not is_stream_id(last_id):
+            last_id = await inbox.last_ack(self.group_id)
+        if not last_id:
+            return
+        catchup = await inbox.read_after(self.group_id, last_id)
+        events = [dict(event.data, inbox_id=event.id) for event in catchup.events]
+        messages_sent.inc("users", "inbox")
+        await self.send(
+            json.dumps(dict(type="inbox", events=events, complete=catchup.complete))
+        )
+
+    @router.route(Ack)
+    async def handle_ack(self, content: Ack):
+        if self.signed and is_stream_id(content["id"]):
+            await self.get_inbox().ack(self.group_id, content["id"])
+
+    @staticmethod
+    def get_inbox():
+        return UserInbox(settings.USER_INBOX_SIZE, settings.USER_INBOX_TTL)
+
+    async def send_authorization_failed(self):
+        messages_sent.inc("users", "authorization")
+        await self.send(json.dumps(dict(type="authorization", result=False)))
 
     async def emit_event(self, event):
         if not self.signed:
             return
         data = event["data"]
+        messages_sent.inc("users", data.get("type", ""))
         await self.send(text_data=json.dumps(data))
 
+    @staticmethod
+    def message_event(message: dict):
+        return dict(type="message", message=message)
+
+    @staticmethod
+    def group_changed_event(message_group_id: int):
+        return dict(type="group", state="changed", id=message_group_id)
+
+    @staticmethod
+    def notification_event(message: dict):
+        return dict(type="notification", notification=message)
+
     @classmethod
-    def send_message(cls, user_id: int | str, message: dict):
-        layer = get_channel_layer()
-        if not layer:
-            return
-        async_to_sync(layer.group_send)(
-            cls.get_group_name(user_id),
-            dict(type="emit_event", data=dict(type="message", message=message)),
+    async def asend_events(cls, events: Iterable[tuple[int | str, dict]]):
+        """
+        (user_id, 이벤트) 여러개를 redis 왕복 몇번으로 보냄. 보낸 이벤트는 각 유저의 inbox에도 남음
+        접속중인 유저에게 간 수(delivered)와 접속이 없어 버려진 수(skipped)를 돌려줌
+        """
+        events = list(events)
+        if settings.USER_INBOX_SIZE > 0:
+            # 접속하지 않은 유저도 나중에 받을 수 있도록 inbox에 먼저 남기고 id를 붙여서 보냄
+            ids = await cls.get_inbox().append_many(events)
+            events = [
+                (user_id, dict(data, inbox_id=inbox_id))
+                for (user_id, data), inbox_id in zip(events, ids)
+            ]
+        if not (layer := get_channel_layer()):
+            return GroupSendResult(0, len(events))
+        offline = 0
+        if settings.USER_PRESENCE_TTL > 0:
+            # 접속중인 연결이 없는 유저는 그룹을 조회하지 않고 건너뜀
+            online = await presence.online(user_id for user_id, _ in events)
+            live = [event for event in events if str(event[0]) in online]
+            offline, events = len(events) - len(live), live
+        result = await group_send_many(
+            layer,
+            (
+                (cls.get_group_name(user_id), dict(type="emit_event", data=data))
+                for user_id, data in events
+            ),
         )
+        return GroupSendResult(result.delivered, result.skipped + offline)
 
     @classmethod
-    def send_group_changed_message(cls, user_id: int | str, message_group_id: int):
+    def send_events(cls, events: Iterable[tuple[int | str, dict]]):
+        """celery처럼 이벤트루프가 없는 곳에서 쓰는 asend_events"""
+        return async_to_sync(cls.asend_events)(list(events))
 
-        layer = get_channel_layer()
-        if not layer:
-            return
-        async_to_sync(layer.group_send)(
-            cls.get_group_name(user_id),
-            dict(
-                type="emit_event",
-                data=dict(type="group", state="changed", id=message_group_id),
-            ),
-        )
+    @classmethod
+    def send_message(cls, user_id: int | str, message: dict):
+        return cls.send_events([(user_id, cls.message_event(message))])
+
+    @classmethod
+    def send_group_changed_message(cls, user_id: int | str, message_group_id: int):
+        return cls.send_events([(user_id, cls.group_changed_event(message_group_id))])
 
     # @classmethod
     # def send_group_user_exit(cls, user_id: int, message_group_id: int, exit_user: int):
@@ -93,12 +227,4 @@ class UserConsumer(AsyncJsonWebsocketConsumer):
 
     @classmethod
     def send_notification(cls, user_id: int | str, message: dict):
-        layer = get_channel_layer()
-        if not layer:
-            return
-        async_to_sync(layer.group_send)(
-            cls.get_group_name(user_id),
-            dict(
-                type="emit_event", data=dict(type="notification", notification=message)
-            ),
-        )
+        return cls.send_events([(user_id, cls.notification_event(message))])
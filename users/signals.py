@@ -1,9 +1,13 @@
 from datetime import timedelta
 import time
 from django.utils import timezone
+from django.db import transaction
 from django.db.models.signals import post_save
 from django.dispatch import receiver
 from django_celery_beat.models import IntervalSchedule, PeriodicTask, PERIOD_CHOICES
+from rest_framework_simplejwt.settings import api_settings
+
+from commons.authentication import user_cache
 
 from .models import User
 from .tasks import delete_unregistered_user
@@ -16,3 +20,11 @@ def on_user_created(sender: type[User], instance: User, created: bool, **kwargs)
     delete_unregistered_user.apply_async(
         kwargs=dict(user_id=instance.pk), eta=timezone.localtime() + timedelta(hours=1)
     )
+
+
+@receiver(post_save, sender=User)
+def on_user_saved(sender: type[User], instance: User, **kwargs):
+    # 커밋 전에 다른 요청이 이전 값을 다시 캐싱할 수 있으므로 커밋 후에 한번 더 무효화함
+    user_id = getattr(instance, api_settings.USER_ID_FIELD)
+    user_cache.invalidate(user_id)
+    transaction.on_commit(lambda: user_cache.invalidate(user_id))
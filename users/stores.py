@@ -0,0 +1,194 @@
+import asyncio
+import math
+import re
+import time
+from typing import Any, Iterable, NamedTuple
+from uuid import uuid4
+
+import msgpack
+from redis.exceptions import RedisError
+
+from django.conf import settings
+
+from commons.lock import get_async_redis
+
+# 유저에게 보낸 이벤트를 접속 여부와 관계없이 남겨두는 redis 키
+# v1:users:{user_id}:inbox      capped stream. 재접속한 클라이언트가 놓친 이벤트를 받음
+# v1:users:{user_id}:inbox:ack  클라이언트가 마지막으로 확인(ack)한 stream id
+# v1:users:presence:workers     worker_id -> 마지막 heartbeat 시각. 살아있는 워커 목록
+# v1:users:presence:{worker_id} 워커에 인증된 연결이 있는 유저. user_id -> 연결 수
+PRESENCE_WORKERS_KEY = "v1:users:presence:workers"
+STREAM_ID = re.compile(r"^\d+-\d+$")
+
+
+def inbox_key(user_id: Any):
+    return f"v1:users:{user_id}:inbox"
+
+
+def ack_key(user_id: Any):
+    return f"v1:users:{user_id}:inbox:ack"
+
+
+def presence_key(worker_id: str):
+    return f"v1:users:presence:{worker_id}"
+
+
+def decode(value: bytes | str):
+    return value.decode() if isinstance(value, bytes) else value
+
+
+class InboxEvent(NamedTuple):
+    id: str
+    data: dict
+
+
+class Catchup(NamedTuple):
+    events: list[InboxEvent]
+    # False면 오래되어 지워진 이벤트가 있을 수 있으므로 클라이언트가 목록을 새로 받아야함
+    complete: bool
+
+
+class UserInbox:
+    def __init__(self, max_length: int, ttl: int, client: Any | None = None):
+        self.max_length = max_length
+        self.ttl = ttl
+        self.client = client or get_async_redis()
+
+    async def append_many(self, events: Iterable[tuple[Any, dict]]) -> list[str]:
+        """이벤트를 각 유저의 inbox에 pipeline 한번으로 넣고 stream id를 순서대로 돌려줌"""
+        pipe = self.client.pipeline(transaction=False)
+        count = 0
+        for user_id, data in events:
+            key = inbox_key(user_id)
+            pipe.xadd(
+                key,
+                dict(data=msgpack.packb(data)),
+                maxlen=self.max_length,
+                approximate=True,
+            )
+            pipe.expire(key, self.ttl)
+            count += 1
+        if not count:
+            return []
+        return [decode(entry_id) for entry_id in (await pipe.execute())[::2]]
+
+    async def read_after(self, user_id: Any, last_id: str) -> Catchup:
+        key = inbox_key(user_id)
+        pipe = self.client.pipeline(transaction=False)
+        pipe.xrange(key, min=f"({last_id}", max="+", count=self.max_length)
+        pipe.xrange(key, min="-", max="+", count=1)
+        pipe.xlen(key)
+        entries, oldest, length = await pipe.execute()
+        events = [
+            InboxEvent(decode(entry_id), msgpack.unpackb(fields[b"data"]))
+            for entry_id, fields in entries
+        ]
+        # 꽉 찬 inbox의 가장 오래된 이벤트가 last_id 이후라면 그 사이는 잘렸을 수 있음
+        trimmed = length >= self.max_length and bool(oldest)
+        complete = not trimmed or parse_id(decode(oldest[0][0])) <= parse_id(last_id)
+        return Catchup(events, complete)
+
+    async def ack(self, user_id: Any, last_id: str):
+        await self.client.set(ack_key(user_id), last_id, ex=self.ttl)
+
+    async def last_ack(self, user_id: Any) -> str | None:
+        if value := await self.client.get(ack_key(user_id)):
+            return decode(value)
+        return None
+
+
+def parse_id(stream_id: str):
+    ms, seq = stream_id.split("-")
+    return int(ms), int(seq)
+
+
+def is_stream_id(value: Any):
+    return isinstance(value, str) and bool(STREAM_ID.match(value))
+
+
+class PresenceRegistry:
+    """
+    워커마다 인증된 연결 수를 유저별로 세서 redis hash 하나에 저장함
+    heartbeat가 ttl/3마다 hash를 워커의 값으로 다시 쓰고 workers zset의 시각을 갱신하므로
+    죽은 워커의 연결은 ttl 안에 목록에서 빠짐
+    """
+
+    def __init__(self, ttl: float, worker_id: str | None = None):
+        self.ttl = ttl
+        self.worker_id = worker_id or uuid4().hex
+        self.key = presence_key(self.worker_id)
+        self.counts: dict[str, int] = {}
+        self.heartbeat_task: asyncio.Task | None = None
+
+    async def add(self, user_id: Any):
+        user_id = str(user_id)
+        self.counts[user_id] = self.counts.get(user_id, 0) + 1
+        pipe = get_async_redis().pipeline(transaction=False)
+        pipe.hincrby(self.key, user_id, 1)
+        self.touch(pipe)
+        await pipe.execute()
+        self.start()
+
+    async def remove(self, user_id: Any):
+        user_id = str(user_id)
+        if (count := self.counts.get(user_id, 0) - 1) > 0:
+            self.counts[user_id] = count
+            await get_async_redis().hincrby(self.key, user_id, -1)
+        else:
+            self.counts.pop(user_id, None)
+            await get_async_redis().hdel(self.key, user_id)
+
+    async def online(self, user_ids: Iterable[Any]) -> set[str]:
+        """주어진 유저 중 어느 워커에든 연결이 있는 유저"""
+        ids = list(dict.fromkeys(str(user_id) for user_id in user_ids))
+        client = get_async_redis()
+        workers = await client.zrangebyscore(
+            PRESENCE_WORKERS_KEY, time.time() - self.ttl, "+inf"
+        )
+        if not ids or not workers:
+            return set()
+        pipe = client.pipeline(transaction=False)
+        for worker_id in workers:
+            pipe.hmget(presence_key(decode(worker_id)), ids)
+        online = set[str]()
+        for counts in await pipe.execute():
+            online.update(user_id for user_id, count in zip(ids, counts) if count)
+        return online
+
+    async def is_online(self, user_id: Any):
+        return str(user_id) in await self.online([user_id])
+
+    def touch(self, pipe):
+        pipe.expire(self.key, math.ceil(self.ttl))
+        pipe.zadd(PRESENCE_WORKERS_KEY, {self.worker_id: time.time()})
+
+    def start(self):
+        loop = asyncio.get_running_loop()
+        task = self.heartbeat_task
+        if task and not task.done() and task.get_loop() is loop:
+            return
+        self.heartbeat_task = loop.create_task(self.heartbeat())
+
+    async def heartbeat(self):
+        while self.counts:
+            await asyncio.sleep(self.ttl / 3)
+            try:
+                await self.sync()
+            except (OSError, RedisError):
+                continue
+        self.heartbeat_task = None
+
+    async def sync(self):
+        # 중간에 실패한 증감이 있어도 워커가 알고 있는 값으로 맞춰짐
+        pipe = get_async_redis().pipeline(transaction=True)
+        pipe.delete(self.key)
+        if self.counts:
+            pipe.hset(self.key, mapping=self.counts)
+            self.touch(pipe)
+        else:
+            pipe.zrem(PRESENCE_WORKERS_KEY, self.worker_id)
+        pipe.zremrangebyscore(PRESENCE_WORKERS_KEY, 0, time.time() - self.ttl)
+        await pipe.execute()
+
+
+presence = PresenceRegistry(settings.USER_PRESENCE_TTL)
@@ -1,9 +1,12 @@
+import asyncio
 import base64
 import json
 from os import getenv
 from typing import Callable, ParamSpec, TypeVar
 
 import requests
+from asgiref.sync import async_to_sync
+from django.test import override_settings
 from base.test import TestCase
 
 from commons.authentication import CustomTokenObtainPairSerializer
@@ -74,6 +77,151 @@ class TestUserView(TestCase):
         self.assertEqual(resp.status_code, 200)
         self.assertEqual(resp.json()["bio"], "금지된")
 
+    def test_auth_cache(self):
+        from django.db import connection
+        from django.test import RequestFactory
+        from django.test.utils import CaptureQueriesContext
+
+        from commons.authentication import (
+            CustomJWTAuthentication,
+            token_cache,
+            user_cache,
+        )
+
+        token_cache.entries.clear()
+        # bulk_create로 만든 유저는 post_save가 없으므로 직접 비움
+        user_cache.invalidate(self.user.pk)
+        token_hits = token_cache.stats()["hits"]
+        redis_misses = user_cache.stats()["redis"]["misses"]
+        access, _ = self.client.login(self.user)
+        request = RequestFactory().get("/", HTTP_AUTHORIZATION=f"Bearer {access}")
+        auth = CustomJWTAuthentication()
+        auth.authenticate(request)
+        with CaptureQueriesContext(connection) as context:
+            user, token = auth.authenticate(request)  # type:ignore
+        # 두번째 요청은 토큰을 다시 검증하지 않고 유저도 DB에서 읽지 않음
+        self.assertEqual(user.pk, self.user.pk)
+        self.assertEqual(token_cache.stats()["hits"], token_hits + 1)
+        self.assertEqual(context.captured_queries, [])
+        self.assertEqual(auth.get_cached_user(token).pk, self.user.pk)
+        # 요청에서 유저를 바꿔도 캐시된 유저는 그대로임
+        user.bio = "요청에서 바꿈"
+        self.assertNotEqual(auth.get_cached_user(token).bio, "요청에서 바꿈")
+        self.assertIsNot(auth.get_cached_user(token), auth.get_cached_user(token))
+
+        # 저장되면 버전이 올라가서 다음 요청에 바로 반영됨
+        self.user.bio = "바뀐 소개"
+        self.user.save()
+        user, _ = auth.authenticate(request)  # type:ignore
+        self.assertEqual(user.bio, "바뀐 소개")
+        self.assertEqual(user_cache.stats()["redis"]["misses"], redis_misses + 2)
+
+    def test_inbox(self):
+        from channels.routing import URLRouter
+        from channels.testing import WebsocketCommunicator
+
+        from commons.authentication import user_cache
+        from commons.lock import get_redis
+
+        from .consumers import UserConsumer
+        from .routings import websocket_urlpatterns
+        from .stores import ack_key, inbox_key
+
+        get_redis().delete(inbox_key(self.user.pk), ack_key(self.user.pk))
+        user_cache.invalidate(self.user.pk)
+        access, _ = self.client.login(self.user)
+        app = URLRouter(websocket_urlpatterns)
+
+        async def connect(**authorization):
+            client = WebsocketCommunicator(app, f"/ws/users/{self.user.pk}/")
+            await client.connect()
+            await client.send_json_to(dict(access=access, **authorization))
+            return client
+
+        async def run():
+            # 접속하지 않은 동안 보낸 이벤트
+            await UserConsumer.asend_events(
+                [
+                    (self.user.pk, UserConsumer.notification_event(dict(id=i)))
+                    for i in range(3)
+                ]
+            )
+            client = await connect(last_id="0-0")
+            inbox = await client.receive_json_from()
+            self.assertEqual(inbox["type"], "inbox")
+            self.assertTrue(inbox["complete"])
+            self.assertEqual(
+                [event["notification"]["id"] for event in inbox["events"]], [0, 1, 2]
+            )
+            # 접속중에는 inbox_id가 붙어서 바로 옴
+            await UserConsumer.asend_events(
+                [(self.user.pk, UserConsumer.notification_event(dict(id=3)))]
+            )
+            live = await client.receive_json_from()
+            acked = inbox["events"][1]["inbox_id"]
+            await client.send_json_to(dict(type="ack", id=acked))
+            await asyncio.sleep(0.1)
+            await client.disconnect()
+
+            # last_id 없이 접속하면 ack 이후부터 받음
+            client = await connect()
+            inbox = await client.receive_json_from()
+            self.assertEqual(
+                [event["inbox_id"] for event in inbox["events"]][-1], live["inbox_id"]
+            )
+            self.assertEqual(len(inbox["events"]), 2)
+            await client.disconnect()
+
+        async_to_sync(run)()
+
+    @override_settings(USER_AUTH_TIMEOUT=0.2)
+    def test_presence(self):
+        from channels.routing import URLRouter
+        from channels.testing import WebsocketCommunicator
+
+        from commons.authentication import user_cache
+
+        from .consumers import UserConsumer
+        from .routings import websocket_urlpatterns
+        from .stores import presence
+
+        user_cache.invalidate(self.user.pk)
+        access, _ = self.client.login(self.user)
+        app = URLRouter(websocket_urlpatterns)
+
+        async def connect(user_id):
+            client = WebsocketCommunicator(app, f"/ws/users/{user_id}/")
+            await client.connect()
+            return client
+
+        async def run():
+            first, second = await connect(self.user.pk), await connect(self.user.pk)
+            for client in (first, second):
+                await client.send_json_to(dict(access=access))
+            # 인증하지 않은 소켓은 그룹에 없고 시간이 지나면 끊김
+            stranger = await connect(self.user2.pk)
+            await asyncio.sleep(0.1)
+            online = await presence.online([self.user.pk, self.user2.pk])
+            self.assertEqual(online, {str(self.user.pk)})
+            self.assertEqual(presence.counts[str(self.user.pk)], 2)
+            result = await UserConsumer.asend_events(
+                [
+                    (self.user.pk, UserConsumer.notification_event(dict(id=1))),
+                    (self.user2.pk, UserConsumer.notification_event(dict(id=2))),
+                ]
+            )
+            self.assertEqual((result.delivered, result.skipped), (1, 1))
+            self.assertEqual(
+                (await stranger.receive_output(1))["code"], 4001  # type:ignore
+            )
+
+            await first.disconnect()
+            self.assertTrue(await presence.is_online(self.user.pk))
+            await second.disconnect()
+            self.assertFalse(await presence.is_online(self.user.pk))
+
+        async_to_sync(run)()
+
     def test_profile_image(self):
         with open("./commons/cat.jpg", "rb") as clipped_file:
             clipped_image = clipped_file.read()